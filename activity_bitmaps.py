@@ -0,0 +1,289 @@
+"""
+activity_bitmaps.py
+
+Хранилище активности пользователей по дням в виде битовых карт.
+
+Пользователь получает плотный индекс 0..n-1 (в порядке первого появления,
+новые пользователи дописываются в конец), каждый день — битовая строка из
+uint64-слов, где бит i означает, что пользователь i был активен в этот день.
+Карта строится один раз по событиям, дополняется новыми порциями и
+сохраняется в .npz (1 бит на пользователя в день); DAU / WAU / MAU, stickiness, новые / вернувшиеся
+и N-дневный retention считаются объединениями / пересечениями строк и
+подсчётом бит, без повторного прохода по событиям.
+
+Структура — словарь:
+  - first_day: номер первого дня (дни от 1970-01-01), строка 0 в bits
+  - users:     pd.Index userid, позиция = индекс бита
+  - bits:      np.ndarray uint64 формы (число дней, число слов)
+
+Карта плотная: дни * пользователи / 8 байт независимо от того, сколько пользователей
+активно в день (сжатые контейнеры по блокам 2^16 пользователей выгоднее при доле
+активных в день меньше 1/16). Зато все метрики — побитовые операции над целыми строками.
+"""
+import os
+from datetime import date
+from typing import Sequence, Union
+import numpy as np
+import pandas as pd
+
+import data_cleaning as dc
+import cohorts as coh
+
+
+_WORD_BITS = 64
+
+
+def empty_activity_bitmaps() -> dict:
+    """
+    Пустое хранилище (ни дней, ни пользователей).
+    """
+    return {"first_day": 0, "users": pd.Index([]), "bits": np.zeros((0, 0), dtype=np.uint64)}
+
+
+def _popcount(words: np.ndarray) -> np.ndarray:
+    """
+    Число единичных бит в каждой строке (последняя ось).
+    """
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+    # numpy < 2.0: таблица на байт
+    table = np.array([bin(i).count("1") for i in range(256)], dtype=np.int64)
+    return table[words.view(np.uint8)].sum(axis=-1)
+
+
+def update_activity_bitmaps(
+    bitmaps: dict,
+    df: pd.DataFrame,
+    userid_col: str = "userid",
+    ts_col: str = "timestamp"
+) -> dict:
+    """
+    Добавляет активность из событий df (день по ts_col, пользователь по userid_col)
+    и возвращает новое хранилище; индексы уже известных пользователей не меняются.
+    События с NaN userid или NaT не учитываются.
+    """
+    ts = df[ts_col]
+    if not pd.api.types.is_datetime64_any_dtype(ts):
+        ts = dc.normalize_timestamps(ts)[0]
+    days = coh._day_numbers(ts)
+    user_codes, uniques = pd.factorize(df[userid_col])
+    valid = (user_codes >= 0) & (days != np.iinfo(np.int64).min)
+    if not valid.all():
+        user_codes, days = user_codes[valid], days[valid]
+
+    # коды порции -> плотные индексы хранилища, новые пользователи — в конец
+    old_users = bitmaps["users"]
+    positions = old_users.get_indexer(uniques) if len(old_users) else np.full(len(uniques), -1)
+    is_new = positions < 0
+    positions[is_new] = len(old_users) + np.arange(int(is_new.sum()))
+    users = old_users.append(pd.Index(np.asarray(uniques)[is_new])) if len(old_users) else pd.Index(np.asarray(uniques))
+    user_idx = positions[user_codes]
+
+    # диапазон дней и ширина в словах после добавления порции
+    old_bits = bitmaps["bits"]
+    old_first, old_n_days = bitmaps["first_day"], old_bits.shape[0]
+    if len(days):
+        first_day = min(int(days.min()), old_first) if old_n_days else int(days.min())
+        last_day = max(int(days.max()), old_first + old_n_days - 1) if old_n_days else int(days.max())
+    else:
+        first_day, last_day = old_first, old_first + old_n_days - 1
+    n_words = (len(users) + _WORD_BITS - 1) // _WORD_BITS
+    bits = np.zeros((max(last_day - first_day + 1, 0), n_words), dtype=np.uint64)
+    if old_n_days:
+        offset = old_first - first_day
+        bits[offset:offset + old_n_days, :old_bits.shape[1]] = old_bits
+
+    # уникальные пары (день, пользователь) -> слова; OR бит одного слова через reduceat
+    keys = np.sort((days - first_day) * (n_words * _WORD_BITS) + user_idx)
+    keys = keys[np.r_[True, keys[1:] != keys[:-1]]] if len(keys) else keys
+    words = keys // _WORD_BITS
+    values = np.left_shift(np.uint64(1), (keys % _WORD_BITS).astype(np.uint64))
+    if len(words):
+        starts = np.flatnonzero(np.r_[True, words[1:] != words[:-1]])
+        bits.reshape(-1)[words[starts]] |= np.bitwise_or.reduceat(values, starts)
+    return {"first_day": first_day, "users": users, "bits": bits}
+
+
+def build_activity_bitmaps(df: pd.DataFrame, userid_col: str = "userid", ts_col: str = "timestamp") -> dict:
+    """
+    Хранилище по всем событиям df (см. update_activity_bitmaps).
+    """
+    return update_activity_bitmaps(empty_activity_bitmaps(), df, userid_col=userid_col, ts_col=ts_col)
+
+
+def save_activity_bitmaps(bitmaps: dict, path: str) -> None:
+    """
+    Сохраняет хранилище в .npz (атомарно, через временный файл).
+    Без zlib: плотные битовые строки почти не сжимаются, а сжатие в разы медленнее записи.
+    """
+    users = np.asarray(bitmaps["users"])
+    if users.dtype == object:
+        users = users.astype(str)
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path, first_day=np.int64(bitmaps["first_day"]), users=users, bits=bitmaps["bits"])
+    os.replace(tmp_path, path)
+
+
+def load_activity_bitmaps(path: str) -> dict:
+    """
+    Загружает хранилище, сохранённое save_activity_bitmaps.
+    """
+    with np.load(path, allow_pickle=False) as data:
+        return {"first_day": int(data["first_day"]), "users": pd.Index(data["users"]), "bits": data["bits"]}
+
+
+def save_activity_bitmap_days(bitmaps: dict, directory: str, days=None) -> None:
+    """
+    Сохраняет хранилище в каталог по частям, чтобы дозагрузка переписывала только
+    изменённое: строка каждого дня — в {YYYY-MM-DD}.npy, userid — кусками
+    users_{начало}_{конец}.npy (индексы пользователей только дописываются, пишется
+    только ещё не сохранённый хвост). days — дни для записи (None — все дни хранилища).
+    """
+    os.makedirs(directory, exist_ok=True)
+    users = np.asarray(bitmaps["users"])
+    if users.dtype == object:
+        users = users.astype(str)
+    saved = [f for f in os.listdir(directory) if f.startswith("users_") and f.endswith(".npy")]
+    n_saved = max((int(f[:-len(".npy")].split("_")[2]) for f in saved), default=0)
+    if len(users) > n_saved:
+        _save_npy(os.path.join(directory, f"users_{n_saved:012d}_{len(users):012d}.npy"), users[n_saved:])
+
+    dates = activity_dates(bitmaps)
+    rows = np.arange(len(dates)) if days is None else coh._day_numbers(pd.DatetimeIndex(list(days))) - bitmaps["first_day"]
+    for row in rows[(rows >= 0) & (rows < len(dates))]:
+        _save_npy(os.path.join(directory, f"{dates[row]:%Y-%m-%d}.npy"), bitmaps["bits"][row])
+
+
+def _save_npy(path: str, values: np.ndarray) -> None:
+    tmp_path = path + ".tmp.npy"
+    np.save(tmp_path, values)
+    os.replace(tmp_path, path)
+
+
+def load_activity_bitmap_days(directory: str) -> dict:
+    """
+    Загружает хранилище, сохранённое save_activity_bitmap_days.
+    """
+    files = sorted(os.listdir(directory))
+    chunks = [np.load(os.path.join(directory, f), allow_pickle=False) for f in files if f.startswith("users_") and f.endswith(".npy")]
+    if not chunks:
+        return empty_activity_bitmaps()
+    users = pd.Index(np.concatenate(chunks))
+    day_files = [f for f in files if f.endswith(".npy") and not f.startswith("users_")]
+    day_numbers = coh._day_numbers([f[:-len(".npy")] for f in day_files])
+    first_day = int(day_numbers.min()) if len(day_files) else 0
+    n_days = int(day_numbers.max()) - first_day + 1 if len(day_files) else 0
+    bits = np.zeros((n_days, (len(users) + _WORD_BITS - 1) // _WORD_BITS), dtype=np.uint64)
+    # дни, сохранённые до появления новых пользователей, короче — хвост слов нулевой
+    for f, day in zip(day_files, day_numbers):
+        row = np.load(os.path.join(directory, f), allow_pickle=False)
+        bits[day - first_day, :len(row)] = row
+    return {"first_day": first_day, "users": users, "bits": bits}
+
+
+def activity_dates(bitmaps: dict) -> pd.DatetimeIndex:
+    """
+    Даты строк хранилища (непрерывный дневной диапазон).
+    """
+    first = np.datetime64(bitmaps["first_day"], "D")
+    return pd.DatetimeIndex(first + np.arange(bitmaps["bits"].shape[0]), name="date")
+
+
+def _day_index(bitmaps: dict, day: Union[str, date, pd.Timestamp]) -> int:
+    return int((pd.Timestamp(day).normalize() - activity_dates(bitmaps)[0]).days) if bitmaps["bits"].shape[0] else 0
+
+
+def rolling_union(bits: np.ndarray, window: int) -> np.ndarray:
+    """
+    Строка i — объединение строк i-window+1..i (в начале — сколько есть).
+    Удвоением окна: O(log window) проходов по карте вместо window.
+    """
+    out = bits.copy()
+    span = 1
+    while span * 2 <= window:
+        out[span:] |= out[:-span].copy()
+        span *= 2
+    rest = window - span
+    if rest > 0:
+        # [i-rest-span+1, i-rest] и [i-span+1, i] вместе покрывают окно длины span + rest
+        shifted = out[:-rest].copy()
+        out[rest:] |= shifted
+    return out
+
+
+def active_users(
+    bitmaps: dict,
+    start: Union[str, date, pd.Timestamp],
+    end: Union[str, date, pd.Timestamp]
+) -> int:
+    """
+    Число уникальных пользователей, активных в любой день из [start, end] (включительно).
+    """
+    n_days = bitmaps["bits"].shape[0]
+    lo = max(_day_index(bitmaps, start), 0)
+    hi = min(_day_index(bitmaps, end) + 1, n_days)
+    if lo >= hi:
+        return 0
+    return int(_popcount(np.bitwise_or.reduce(bitmaps["bits"][lo:hi], axis=0)))
+
+
+def daily_activity(bitmaps: dict, wau_days: int = 7, mau_days: int = 30) -> pd.DataFrame:
+    """
+    По каждому дню: dau, wau и mau (уникальные пользователи за wau_days / mau_days дней,
+    заканчивающихся этим днём), stickiness = dau / mau, new_users (первый день
+    активности в хранилище) и returning_users = dau - new_users.
+    """
+    bits = bitmaps["bits"]
+    dau = _popcount(bits)
+    seen = np.bitwise_or.accumulate(bits, axis=0) if len(bits) else bits
+    seen_before = np.zeros_like(bits)
+    seen_before[1:] = seen[:-1]
+    new_users = _popcount(bits & ~seen_before)
+    mau = _popcount(rolling_union(bits, mau_days))
+    result = pd.DataFrame({
+        "date": activity_dates(bitmaps),
+        "dau": dau,
+        "wau": _popcount(rolling_union(bits, wau_days)),
+        "mau": mau,
+        "stickiness": dau / np.where(mau > 0, mau, np.nan),
+        "new_users": new_users,
+        "returning_users": dau - new_users,
+    })
+    return result
+
+
+def retention_by_day(
+    bitmaps: dict,
+    periods: Sequence[int] = (1, 7, 30),
+    rolling: bool = False,
+    cohort: str = "new"
+) -> pd.DataFrame:
+    """
+    N-дневный retention по дням: для пользователей дня d (cohort="new" — впервые активных в d,
+    cohort="active" — всех активных в d) доля активных в день d+N (rolling=False)
+    или в любой день начиная с d+N (rolling=True, "unbounded" retention).
+
+    Возвращает date, cohort_users, retention_{N}d; если d+N за пределами данных — NaN.
+    """
+    if cohort not in ("new", "active"):
+        raise ValueError("cohort must be 'new' or 'active'")
+    bits = bitmaps["bits"]
+    n_days = len(bits)
+    if cohort == "new":
+        seen_before = np.zeros_like(bits)
+        if n_days:
+            seen_before[1:] = np.bitwise_or.accumulate(bits, axis=0)[:-1]
+        base = bits & ~seen_before
+    else:
+        base = bits
+    base_users = _popcount(base)
+    result = pd.DataFrame({"date": activity_dates(bitmaps), "cohort_users": base_users})
+
+    # для rolling: строка i — объединение дней i..конец
+    later = np.bitwise_or.accumulate(bits[::-1], axis=0)[::-1] if rolling and n_days else bits
+    for n in periods:
+        retained = np.full(n_days, np.nan)
+        if n < n_days:
+            retained[:n_days - n] = _popcount(base[:n_days - n] & later[n:])
+        result[f"retention_{n}d"] = retained / np.where(base_users > 0, base_users, np.nan)
+    return result
@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+"""
+benchmarks.py
+
+Бенчмарки публичных функций data_cleaning, feature_engineering, metrics и cohorts
+на синтетической телеметрии (synthetic_data) заданных объёмов.
+
+Для каждого объёма данные один раз генерируются в data_dir шардами CSV и
+переиспользуются следующими запусками. Входы функций (прочитанные, очищенные,
+отсортированные события, сессии, признаки, коды воронки и т.п.) собираются
+лениво и кэшируются на время прогона одного объёма: бенчмарк с фильтром
+по функции готовит только то, что ей нужно.
+
+Каждая функция вызывается repeat раз (сборка аргументов — вне замера, поэтому
+функции, меняющие вход на месте, получают свежую копию; генераторы
+дочитываются внутри замера). Результаты дописываются в CSV (results) с версией
+кода (git describe), чтобы сравнивать время между коммитами (compare).
+
+Usage:
+    python benchmarks.py run --sizes 100K,1M,10M --repeat 3
+    python benchmarks.py run --sizes 1M --filter metrics.,cohorts.
+    python benchmarks.py compare --base 7ed3984 --head HEAD
+    python benchmarks.py list
+"""
+import os
+import glob
+import inspect
+import argparse
+import subprocess
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Sequence
+import numpy as np
+import pandas as pd
+
+import data_cleaning as dc
+import feature_engineering as fe
+import metrics as mtr
+import cohorts as coh
+import profiling as prof
+import synthetic_data as sd
+from main import FUNNEL_STEPS, prepare_basic_event_values
+
+
+BENCHMARK_MODULES = [dc, fe, mtr, coh]
+DEFAULT_SIZES = "100K,1M,10M"
+# результаты и сгенерированные данные — в bench/ (в .gitignore), а не в корне репозитория
+DEFAULT_RESULTS = os.path.join("bench", "results.csv")
+DEFAULT_DATA_DIR = os.path.join("bench", "data")
+DEFAULT_SHARD_EVENTS = 2_000_000
+
+RESULT_COLUMNS = [
+    "commit", "run_at", "size", "events", "function", "repeats",
+    "wall_min_s", "wall_median_s", "cpu_median_s", "rss_peak_delta_mb", "rows_out",
+]
+
+
+def public_functions(modules: Sequence = BENCHMARK_MODULES) -> List[str]:
+    """
+    Имена module.function всех публичных функций модулей (объявленных в самом модуле).
+    """
+    names = []
+    for module in modules:
+        for name, func in inspect.getmembers(module, inspect.isfunction):
+            if not name.startswith("_") and func.__module__ == module.__name__:
+                names.append(f"{module.__name__}.{name}")
+    return names
+
+
+def code_version(repo_dir: Optional[str] = None) -> str:
+    """
+    Версия кода для результатов: git describe --always --dirty (короткий хэш коммита,
+    с суффиксом -dirty при незакоммиченных изменениях) или "unknown" вне git.
+    """
+    repo_dir = repo_dir or os.path.dirname(os.path.abspath(__file__))
+    try:
+        out = subprocess.run(
+            ["git", "describe", "--always", "--dirty"], cwd=repo_dir, capture_output=True, text=True, check=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return out.stdout.strip() or "unknown"
+
+
+def dataset_paths(n_events: int, data_dir: str = DEFAULT_DATA_DIR, seed: int = 0,
+                  shard_events: int = DEFAULT_SHARD_EVENTS, workers: Optional[int] = None) -> List[str]:
+    """
+    Шарды синтетических событий объёма n_events в data_dir/events_{n_events}_seed{seed};
+    генерируются при первом обращении (маркер _SUCCESS — набор записан целиком).
+    """
+    path = os.path.join(data_dir, f"events_{n_events}_seed{seed}")
+    marker = os.path.join(path, "_SUCCESS")
+    if not os.path.exists(marker):
+        print(f">>> Generating {n_events} synthetic events into {path}")
+        sd.write_synthetic_csv(path, n_events, shard_events=shard_events, seed=seed, workers=workers)
+        open(marker, "w").close()
+    return sorted(glob.glob(os.path.join(path, "part-*.csv")))
+
+
+def _consume(func: Callable, paths: List[str], **kwargs) -> int:
+    # генераторы кусков дочитываются внутри замера; результат — число строк
+    return sum(len(chunk) for path in paths for chunk in func(path, **kwargs))
+
+
+def _map_paths(func: Callable, paths: List[str], **kwargs) -> list:
+    return [func(path, **kwargs) for path in paths]
+
+
+def _parquet_copy(df: pd.DataFrame, paths: List[str]) -> str:
+    # прочитанные события того же набора в Parquet (вход read_telemetry_parquet), пишутся один раз
+    path = os.path.join(os.path.dirname(paths[0]), "events.parquet")
+    if not os.path.exists(path):
+        df.to_parquet(path + ".tmp", index=False)
+        os.replace(path + ".tmp", path)
+    return path
+
+
+def _step_map() -> Dict[str, int]:
+    return {action: i for i, action in enumerate(FUNNEL_STEPS)}
+
+
+def _funnel_codes(df: pd.DataFrame, entity_col: str = "sessionid") -> dict:
+    # входы funnel_depth / windowed_funnel_depth так же, как их готовит compute_windowed_funnel
+    df = dc.sort_by_session(df[[entity_col, "timestamp", "action", "userid"]], session_col=entity_col, ts_col="timestamp")
+    unique_steps = list(dict.fromkeys(FUNNEL_STEPS))
+    codes, _ = pd.factorize(df[entity_col], sort=True)
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if len(codes) else np.zeros(0, dtype=np.int64)
+    return {
+        "entity_codes": codes,
+        "action_codes": mtr.encode_actions(df["action"], unique_steps),
+        "ts": df["timestamp"].to_numpy(),
+        "step_codes": [unique_steps.index(s) for s in FUNNEL_STEPS],
+        "n_entities": int(codes.max()) + 1 if len(codes) else 0,
+        "entity_users": pd.Series(df["userid"].to_numpy()[starts]),
+    }
+
+
+def _reached(df: pd.DataFrame) -> pd.DataFrame:
+    # вход conversion_table: шаги пользователей не раньше их первого шага, день когорты — день первого шага
+    steps = df[df["action"].isin(FUNNEL_STEPS)]
+    first = steps["timestamp"].where(steps["action"] == FUNNEL_STEPS[0]).groupby(steps["userid"]).transform("min")
+    keep = steps["timestamp"] >= first
+    return pd.DataFrame({
+        "cohort_date": first[keep].dt.normalize(),
+        "action": steps["action"][keep],
+        "userid": steps["userid"][keep],
+    }).drop_duplicates(ignore_index=True)
+
+
+def _user_aggregates(df: pd.DataFrame) -> pd.DataFrame:
+    # по пользователю: первый / последний день, число сессий и событий (входы activity_segment)
+    users = df.groupby("userid", observed=True).agg(
+        first_visit=("timestamp", "min"), last_ts=("timestamp", "max"),
+        n_sessions=("sessionid", "nunique"), n_events=("timestamp", "size"),
+    )
+    users["first_visit"] = users["first_visit"].dt.normalize()
+    users["last_ts"] = users["last_ts"].dt.normalize()
+    return users.reset_index()
+
+
+# входы бенчмарков: имя -> функция (fixture) -> значение; fixture(name) собирает и кэширует
+FIXTURES: Dict[str, Callable] = {
+    "raw": lambda f: dc.read_telemetry_files(f("paths"), workers=f("workers")),
+    "raw_timestamps": lambda f: pd.concat(
+        [pd.read_csv(p, usecols=["timestamp"])["timestamp"] for p in f("paths")], ignore_index=True
+    ),
+    "parquet_path": lambda f: _parquet_copy(f("raw"), f("paths")),
+    # последние 7 дней данных: окно отбора при чтении
+    "window": lambda f: (str((f("raw")["timestamp"].max() - timedelta(days=6)).date()), str(f("raw")["timestamp"].max().date())),
+    "filled": lambda f: dc.safe_fill_category(f("raw"), col="category", fill_value="unknown"),
+    "parsed": lambda f: dc.ensure_sessions(dc.parse_timestamps(f("filled"), ts_col="timestamp")),
+    "sorted": lambda f: dc.sort_by_session(f("parsed"), session_col="sessionid", ts_col="timestamp"),
+    "aggregated": lambda f: dc.compute_session_aggregates(f("sorted"), keep_events=True),
+    "events": lambda f: f("aggregated")[0],
+    "sessions": lambda f: f("aggregated")[1],
+    "values": lambda f: prepare_basic_event_values(f("events")),
+    "stepped": lambda f: fe.compute_session_step_number(f("values")),
+    "shifted": lambda f: fe.add_session_shifts(f("stepped")),
+    "features": lambda f: fe.compute_basket_size_and_avg_time(f("shifted")),
+    "funnel_codes": lambda f: _funnel_codes(f("features")),
+    "funnel_depth": lambda f: mtr.funnel_depth(
+        f("funnel_codes")["entity_codes"], f("funnel_codes")["action_codes"],
+        f("funnel_codes")["step_codes"], f("funnel_codes")["n_entities"]
+    ),
+    "reached": lambda f: _reached(f("features")),
+    "ux_sketches": lambda f: mtr.build_ux_sketches(f("sessions")),
+    "users": lambda f: _user_aggregates(f("events")),
+    "date_now": lambda f: (f("events")["timestamp"].max() + timedelta(days=1)).date(),
+    "user_codes": lambda f: pd.factorize(f("events")["userid"]),
+}
+
+
+# функция -> сборка вызова (func, args, kwargs) из fixture; аргументы — как в main.py
+BENCHMARK_CASES: Dict[str, Callable] = {
+    # data_cleaning
+    "data_cleaning.peak_rss_mb": lambda f: (dc.peak_rss_mb, (), {}),
+    "data_cleaning.resolve_input_paths": lambda f: (
+        dc.resolve_input_paths, (os.path.join(os.path.dirname(f("paths")[0]), "*.csv"),), {}
+    ),
+    "data_cleaning.estimate_chunksize": lambda f: (_map_paths, (dc.estimate_chunksize, f("paths")), {"memory_budget_mb": 512}),
+    "data_cleaning.read_telemetry_csv": lambda f: (_map_paths, (dc.read_telemetry_csv, f("paths")), {}),
+    "data_cleaning.iter_telemetry_csv": lambda f: (
+        _consume, (dc.iter_telemetry_csv, f("paths")), {"chunksize": 500_000}
+    ),
+    "data_cleaning.sorted_start_offset": lambda f: (_map_paths, (dc.sorted_start_offset, f("paths")), {"since": f("window")[0]}),
+    "data_cleaning.read_telemetry_parquet": lambda f: (
+        dc.read_telemetry_parquet, (f("parquet_path"),), {"since": f("window")[0], "until": f("window")[1]}
+    ),
+    "data_cleaning.parquet_time_filters": lambda f: (
+        dc.parquet_time_filters, (f("parquet_path"),), {"since": f("window")[0], "until": f("window")[1]}
+    ),
+    "data_cleaning.read_telemetry_files": lambda f: (dc.read_telemetry_files, (f("paths"),), {"workers": f("workers")}),
+    "data_cleaning.normalize_timestamps": lambda f: (dc.normalize_timestamps, (f("raw_timestamps"),), {}),
+    "data_cleaning.compact_telemetry_dtypes": lambda f: (dc.compact_telemetry_dtypes, (f("raw").copy(),), {}),
+    "data_cleaning.safe_fill_category": lambda f: (dc.safe_fill_category, (f("raw"),), {"col": "category", "fill_value": "unknown"}),
+    "data_cleaning.parse_timestamps": lambda f: (dc.parse_timestamps, (f("filled"),), {"ts_col": "timestamp"}),
+    "data_cleaning.time_bounds": lambda f: (dc.time_bounds, f("window"), {}),
+    "data_cleaning.time_range_mask": lambda f: (dc.time_range_mask, (f("parsed")["timestamp"],) + f("window"), {}),
+    "data_cleaning.derive_date": lambda f: (dc.derive_date, (f("parsed")["timestamp"],), {}),
+    "data_cleaning.is_compact_date": lambda f: (dc.is_compact_date, (f("parsed"),), {}),
+    "data_cleaning.ensure_sessions": lambda f: (dc.ensure_sessions, (f("parsed"),), {"gap": "30min"}),
+    "data_cleaning.sessionize_by_inactivity": lambda f: (dc.sessionize_by_inactivity, (f("parsed"),), {"gap": "30min"}),
+    "data_cleaning.is_session_sorted": lambda f: (dc.is_session_sorted, (f("sorted"),), {}),
+    "data_cleaning.sort_by_session": lambda f: (dc.sort_by_session, (f("parsed"),), {}),
+    "data_cleaning.compute_session_aggregates": lambda f: (dc.compute_session_aggregates, (f("sorted"),), {"keep_events": True}),
+    "data_cleaning.safe_assign_column": lambda f: (
+        dc.safe_assign_column, (f("events"), f("events")["session_duration"], "session_duration_copy"), {}
+    ),
+    # feature_engineering
+    "feature_engineering.compute_session_step_number": lambda f: (fe.compute_session_step_number, (f("values"),), {}),
+    "feature_engineering.add_session_shifts": lambda f: (fe.add_session_shifts, (f("stepped"),), {}),
+    "feature_engineering.compute_basket_size_and_avg_time": lambda f: (fe.compute_basket_size_and_avg_time, (f("shifted"),), {}),
+    "feature_engineering.product_to_cart_transitions": lambda f: (fe.product_to_cart_transitions, (f("features"),), {}),
+    "feature_engineering.first_action_per_session": lambda f: (fe.first_action_per_session, (f("events"),), {}),
+    # metrics
+    "metrics.safe_divide": lambda f: (mtr.safe_divide, (1.0, 3.0), {}),
+    "metrics.encode_actions": lambda f: (mtr.encode_actions, (f("features")["action"], FUNNEL_STEPS), {}),
+    "metrics.funnel_depth": lambda f: (mtr.funnel_depth, (
+        f("funnel_codes")["entity_codes"], f("funnel_codes")["action_codes"],
+        f("funnel_codes")["step_codes"], f("funnel_codes")["n_entities"]
+    ), {}),
+    "metrics.windowed_funnel_depth": lambda f: (mtr.windowed_funnel_depth, (
+        f("funnel_codes")["entity_codes"], f("funnel_codes")["action_codes"], f("funnel_codes")["ts"],
+        f("funnel_codes")["step_codes"], f("funnel_codes")["n_entities"],
+        [None] + [np.timedelta64(30, "m")] * (len(FUNNEL_STEPS) - 1), np.timedelta64(24, "h")
+    ), {}),
+    "metrics.funnel_table": lambda f: (mtr.funnel_table, (f("funnel_depth"), f("funnel_codes")["entity_users"], FUNNEL_STEPS), {}),
+    "metrics.compute_funnel": lambda f: (mtr.compute_funnel, (f("features"), FUNNEL_STEPS), {}),
+    "metrics.compute_windowed_funnel": lambda f: (
+        mtr.compute_windowed_funnel, (f("features"), FUNNEL_STEPS), {"max_step_gap": {"checkout": "30min"}, "window": "24h"}
+    ),
+    "metrics.compute_kpis_by_date": lambda f: (mtr.compute_kpis_by_date, (f("features"),), {"confirmation_col": None}),
+    "metrics.compute_sankey_transitions": lambda f: (mtr.compute_sankey_transitions, (f("features"), _step_map()), {}),
+    "metrics.sankey_transition_counts": lambda f: (mtr.sankey_transition_counts, (f("features"), _step_map()), {}),
+    "metrics.compute_top_paths": lambda f: (mtr.compute_top_paths, (f("features"),), {"length": 3}),
+    "metrics.compute_conversion_daily": lambda f: (mtr.compute_conversion_daily, (f("features"), FUNNEL_STEPS), {"date_col": "date"}),
+    "metrics.conversion_table": lambda f: (mtr.conversion_table, (f("reached"), FUNNEL_STEPS), {}),
+    "metrics.build_ux_sketches": lambda f: (mtr.build_ux_sketches, (f("sessions"),), {}),
+    "metrics.ux_metrics_table": lambda f: (mtr.ux_metrics_table, (f("ux_sketches"),), {}),
+    # cohorts
+    "cohorts.activity_segment": lambda f: (coh.activity_segment, (
+        f("users")["first_visit"], f("users")["last_ts"], f("users")["n_sessions"], f("date_now")
+    ), {}),
+    "cohorts.user_activity_table": lambda f: (coh.user_activity_table, (
+        f("users")["userid"], f("users")["first_visit"], f("users")["last_ts"],
+        f("users")["n_sessions"], f("users")["n_events"], f("date_now")
+    ), {}),
+    "cohorts.build_user_activity": lambda f: (coh.build_user_activity, (f("events"),), {"date_now": f("date_now")}),
+    "cohorts.label_user_activity_segment": lambda f: (coh.label_user_activity_segment, (f("events"),), {"date_now": f("date_now")}),
+    "cohorts.cohort_month_retention": lambda f: (coh.cohort_month_retention, (f("events"),), {}),
+    "cohorts.retention_from_codes": lambda f: (coh.retention_from_codes, (
+        f("user_codes")[0], f("events")["timestamp"], len(f("user_codes")[1])
+    ), {}),
+}
+
+
+def _fixture_getter(cache: dict) -> Callable:
+    def fixture(name: str):
+        if name not in cache:
+            cache[name] = FIXTURES[name](fixture)
+        return cache[name]
+    return fixture
+
+
+def select_cases(patterns: Optional[Sequence[str]] = None) -> List[str]:
+    """
+    Имена бенчмарков, содержащие хотя бы одну из подстрок patterns (None — все),
+    в порядке BENCHMARK_CASES.
+    """
+    return [name for name in BENCHMARK_CASES if not patterns or any(p in name for p in patterns)]
+
+
+def time_case(name: str, fixture: Callable, repeat: int = 3) -> dict:
+    """
+    repeat замеров функции name (profiling.measure): минимум и медиана wall времени,
+    медиана CPU, наибольший рост пикового RSS, строки результата.
+    """
+    runs = []
+    for _ in range(repeat):
+        func, args, kwargs = BENCHMARK_CASES[name](fixture)
+        result, stats = prof.measure(func, *args, stage_name=name, **kwargs)
+        runs.append(stats)
+        del result
+    wall = np.array([r["wall_s"] for r in runs])
+    return {
+        "function": name,
+        "repeats": repeat,
+        "wall_min_s": float(wall.min()),
+        "wall_median_s": float(np.median(wall)),
+        "cpu_median_s": float(np.median([r["cpu_s"] for r in runs])),
+        "rss_peak_delta_mb": float(max(r["rss_peak_delta_mb"] for r in runs)),
+        "rows_out": runs[-1]["rows_out"],
+    }
+
+
+def run_benchmarks(
+    sizes: Sequence[int],
+    patterns: Optional[Sequence[str]] = None,
+    repeat: int = 3,
+    data_dir: str = DEFAULT_DATA_DIR,
+    results_path: Optional[str] = DEFAULT_RESULTS,
+    seed: int = 0,
+    workers: Optional[int] = None
+) -> pd.DataFrame:
+    """
+    Прогоняет выбранные бенчмарки на каждом объёме sizes (число событий) и
+    возвращает таблицу RESULT_COLUMNS; если задан results_path, строки дописываются
+    в этот CSV (после каждого объёма — прогон можно прервать без потери результатов).
+    """
+    names = select_cases(patterns)
+    commit = code_version()
+    run_at = datetime.now().isoformat(timespec="seconds")
+    tables = []
+    for n_events in sizes:
+        cache = {
+            "paths": dataset_paths(n_events, data_dir=data_dir, seed=seed, workers=workers),
+            "workers": workers,
+        }
+        fixture = _fixture_getter(cache)
+        rows = []
+        for name in names:
+            row = time_case(name, fixture, repeat=repeat)
+            print(f"{n_events:>12} {name:<55} min {row['wall_min_s']:9.4f}s  median {row['wall_median_s']:9.4f}s")
+            rows.append(dict(row, commit=commit, run_at=run_at, size=_format_size(n_events), events=n_events))
+        table = pd.DataFrame(rows, columns=RESULT_COLUMNS)
+        table["rows_out"] = table["rows_out"].astype("Int64")
+        if results_path:
+            os.makedirs(os.path.dirname(results_path) or ".", exist_ok=True)
+            table.to_csv(results_path, mode="a", index=False, header=not os.path.exists(results_path))
+        tables.append(table)
+        del cache, fixture
+    return pd.concat(tables, ignore_index=True) if tables else pd.DataFrame(columns=RESULT_COLUMNS)
+
+
+def _format_size(n_events: int) -> str:
+    for suffix, factor in (("G", 10 ** 9), ("M", 10 ** 6), ("K", 10 ** 3)):
+        if n_events >= factor and n_events % factor == 0:
+            return f"{n_events // factor}{suffix}"
+    return str(n_events)
+
+
+def _latest_runs(results: pd.DataFrame, commit: str) -> pd.DataFrame:
+    # последний прогон каждой (объём, функция) для версии кода, начинающейся с commit
+    rows = results[results["commit"].astype(str).str.startswith(commit)]
+    return rows.sort_values("run_at").drop_duplicates(["events", "function"], keep="last").set_index(["events", "function"])
+
+
+def compare_results(results: pd.DataFrame, base: str, head: str) -> pd.DataFrame:
+    """
+    Сравнение двух версий кода (префиксы commit из результатов) по последним прогонам:
+    size, function, base_s / head_s (минимум wall) и ratio = head_s / base_s;
+    строки, которые есть только в одной из версий, отбрасываются.
+    """
+    base_runs, head_runs = _latest_runs(results, base), _latest_runs(results, head)
+    table = pd.DataFrame({
+        "size": head_runs["size"],
+        "base_s": base_runs["wall_min_s"],
+        "head_s": head_runs["wall_min_s"],
+    }).dropna(subset=["base_s", "head_s"])
+    table["ratio"] = table["head_s"] / table["base_s"].where(table["base_s"] > 0)
+    return table.reset_index().sort_values(["events", "ratio"], ascending=[True, False], ignore_index=True)
+
+
+def _resolve_commit(ref: str) -> str:
+    # HEAD, ветки и теги -> короткий хэш (как в code_version); хэши и прочее — как есть
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", ref], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return ref
+    return out.stdout.strip() or ref
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of telemetry functions on synthetic data")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Run benchmarks and append results")
+    run_parser.add_argument("--sizes", type=str, default=DEFAULT_SIZES, help="Comma-separated event counts, e.g. 100K,1M,10M,500M")
+    run_parser.add_argument("--filter", type=str, default=None, help="Comma-separated substrings of benchmark names, e.g. metrics.,cohorts.")
+    run_parser.add_argument("--repeat", type=int, default=3, help="Timed calls per function")
+    run_parser.add_argument("--data-dir", type=str, default=DEFAULT_DATA_DIR, help="Directory for generated synthetic datasets")
+    run_parser.add_argument("--results", type=str, default=DEFAULT_RESULTS, help="CSV file the results are appended to")
+    run_parser.add_argument("--seed", type=int, default=0, help="Random seed of the synthetic data")
+    run_parser.add_argument("--workers", type=int, default=None, help="Processes for generating and reading shards (default: all cores)")
+
+    compare_parser = commands.add_parser("compare", help="Compare results of two commits")
+    compare_parser.add_argument("--base", type=str, required=True, help="Base commit (hash prefix or git ref)")
+    compare_parser.add_argument("--head", type=str, default="HEAD", help="Compared commit (hash prefix or git ref)")
+    compare_parser.add_argument("--results", type=str, default=DEFAULT_RESULTS, help="Results CSV")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="Report slowdowns above this share as regressions")
+
+    commands.add_parser("list", help="List benchmarks and public functions without one")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        run_benchmarks(
+            [sd.parse_size(s) for s in args.sizes.split(",")],
+            patterns=args.filter.split(",") if args.filter else None,
+            repeat=args.repeat, data_dir=args.data_dir, results_path=args.results,
+            seed=args.seed, workers=args.workers,
+        )
+        print(f"Results appended to {args.results}")
+    elif args.command == "compare":
+        table = compare_results(pd.read_csv(args.results), _resolve_commit(args.base), _resolve_commit(args.head))
+        print(table.to_string(index=False, float_format=lambda x: f"{x:.4f}"))
+        regressions = table[table["ratio"] > 1 + args.threshold]
+        print(f"Regressions above {args.threshold:.0%}: {len(regressions)} of {len(table)}")
+    else:
+        for name in BENCHMARK_CASES:
+            print(name)
+        missing = sorted(set(public_functions()) - set(BENCHMARK_CASES))
+        if missing:
+            print("Public functions without a benchmark:", ", ".join(missing))
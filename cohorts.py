@@ -4,9 +4,110 @@ cohorts.py
 Функции для когортного анализа и разметки активности пользователей (New/Returning/Churn-risk/Active).
 """
 from datetime import date, datetime, timedelta
-from typing import Optional
+from typing import Optional, Tuple
+import numpy as np
 import pandas as pd
 
+import data_cleaning as dc
+
+
+# порядок категорий activity_segment
+ACTIVITY_SEGMENTS = ["New", "Returning", "Churn-risk", "Active"]
+
+
+def _aggregate_user_activity(
+    df: pd.DataFrame,
+    first_visit_col: str = "user_first_visit_date",
+    userid_col: str = "userid",
+    session_col: str = "sessionid",
+    ts_col: str = "timestamp"
+) -> pd.DataFrame:
+    """
+    Один groupby по пользователю: first_visit (min first_visit_col, а если её нет — min ts_col),
+    last_ts, n_sessions (уникальные сессии), n_events. Индекс — userid.
+    """
+    ts = df[ts_col]
+    if not pd.api.types.is_datetime64_any_dtype(ts):
+        ts = dc.normalize_timestamps(ts)[0]
+    if first_visit_col in df.columns:
+        first_visit = df[first_visit_col]
+        if not pd.api.types.is_datetime64_any_dtype(first_visit):
+            first_visit = dc.normalize_timestamps(first_visit)[0]
+    else:
+        first_visit = ts
+    columns = pd.DataFrame({"first_visit": first_visit, "last_ts": ts, "sessionid": df[session_col]})
+    return columns.groupby(df[userid_col], observed=True).agg(
+        first_visit=("first_visit", "min"),
+        last_ts=("last_ts", "max"),
+        n_sessions=("sessionid", "nunique"),
+        n_events=("last_ts", "size"),
+    )
+
+
+def user_activity_table(
+    userid: pd.Series,
+    first_visit_day: pd.Series,
+    last_visit_date: pd.Series,
+    n_sessions: pd.Series,
+    n_events: pd.Series,
+    date_now: date,
+    compact: bool = False,
+    churn_days: int = 90,
+    active_min_sessions: int = 5,
+    active_recency_days: int = 30
+) -> pd.DataFrame:
+    """
+    Таблица с одной строкой на пользователя: userid, first_visit_day, last_visit_date,
+    n_sessions, n_events, activity_segment (категориальная, ACTIVITY_SEGMENTS).
+    Входные серии позиционно выровнены, даты — datetime64 (полночь дня);
+    compact=False переводит даты в python date, как label_user_activity_segment.
+    """
+    first_visit_day = pd.Series(np.asarray(first_visit_day))
+    last_visit_date = pd.Series(np.asarray(last_visit_date))
+    n_sessions = pd.Series(np.asarray(n_sessions))
+    segment = activity_segment(
+        first_visit_day, last_visit_date, n_sessions, date_now=date_now,
+        churn_days=churn_days, active_min_sessions=active_min_sessions, active_recency_days=active_recency_days
+    )
+    return pd.DataFrame({
+        "userid": np.asarray(userid),
+        "first_visit_day": first_visit_day if compact else first_visit_day.dt.date,
+        "last_visit_date": last_visit_date if compact else last_visit_date.dt.date,
+        "n_sessions": n_sessions,
+        "n_events": np.asarray(n_events),
+        "activity_segment": pd.Categorical(segment, categories=ACTIVITY_SEGMENTS),
+    })
+
+
+def build_user_activity(
+    df: pd.DataFrame,
+    first_visit_col: str = "user_first_visit_date",
+    userid_col: str = "userid",
+    session_col: str = "sessionid",
+    ts_col: str = "timestamp",
+    date_now: Optional[date] = None,
+    churn_days: int = 90,
+    active_min_sessions: int = 5,
+    active_recency_days: int = 30
+) -> pd.DataFrame:
+    """
+    Измерение пользователей: одна строка на userid (см. user_activity_table), один groupby
+    по событиям вместо трансформаций на каждую строку. Правила сегментов — как в
+    label_user_activity_segment; first_visit_day — минимум first_visit_col по пользователю
+    (если колонки нет — первый timestamp). Пользователи с NaN userid не попадают.
+    Даты — datetime64, если колонка date во входном df компактная, иначе python date.
+    """
+    if date_now is None:
+        date_now = datetime.utcnow().date()
+    compact = "date" in df.columns and pd.api.types.is_datetime64_any_dtype(df["date"])
+    users = _aggregate_user_activity(df, first_visit_col=first_visit_col, userid_col=userid_col, session_col=session_col, ts_col=ts_col)
+    table = user_activity_table(
+        users.index, users["first_visit"].dt.normalize(), users["last_ts"].dt.normalize(),
+        users["n_sessions"], users["n_events"], date_now=date_now, compact=compact,
+        churn_days=churn_days, active_min_sessions=active_min_sessions, active_recency_days=active_recency_days
+    )
+    return table.rename(columns={"userid": userid_col})
+
 
 def label_user_activity_segment(
     df: pd.DataFrame,
@@ -25,46 +126,81 @@ def label_user_activity_segment(
       - Active: n_sessions >= active_min_sessions and last_visit_date >= date_now - active_recency_days
 
     Возвращает копию df с колонками: first_visit_day, last_visit_date, n_sessions, activity_segment.
+    Даты сравниваются как datetime64 (полночь дня); если во входном df колонка date
+    компактная (datetime64), first_visit_day/last_visit_date/date тоже остаются datetime64,
+    иначе — python date.
+
+    Пользовательские поля считаются один раз по пользователю (как build_user_activity)
+    и раздаются событиям по userid; если нужна только таблица пользователей,
+    build_user_activity обходится без копии событий.
     """
     df_local = df.copy()
     if date_now is None:
         date_now = datetime.utcnow().date()
+    compact = "date" in df_local.columns and pd.api.types.is_datetime64_any_dtype(df_local["date"])
+    users = _aggregate_user_activity(df_local, first_visit_col=first_visit_col, ts_col=ts_col)
+    user_index = df_local["userid"]
 
-    # гарантируем, что first_visit_col является datetime
-    if first_visit_col not in df_local.columns and "userid" in df_local.columns and ts_col in df_local.columns:
-        # вычисляем first_visit если отсутствует
-        first_visit = df_local.groupby("userid")[ts_col].transform("min")
-        df_local[first_visit_col] = first_visit
+    def by_user(values: pd.Series):
+        # раздача по userid: у событий с NaN userid поля пользователя пустые
+        return values.reindex(user_index).array
 
-    if first_visit_col in df_local.columns and not pd.api.types.is_datetime64_any_dtype(df_local[first_visit_col]):
-        df_local[first_visit_col] = pd.to_datetime(df_local[first_visit_col], errors="coerce")
-    # сравнивать по дню
-    df_local["first_visit_day"] = df_local[first_visit_col].dt.date
+    # вычисляем first_visit если отсутствует
+    if first_visit_col not in df_local.columns:
+        df_local[first_visit_col] = by_user(users["first_visit"])
+    first_visit_day = pd.Series(by_user(users["first_visit"].dt.normalize()), index=df_local.index)
+    df_local["first_visit_day"] = first_visit_day if compact else first_visit_day.dt.date
 
     # ensure timestamp and date fields
     if ts_col in df_local.columns and not pd.api.types.is_datetime64_any_dtype(df_local[ts_col]):
-        df_local[ts_col] = pd.to_datetime(df_local[ts_col], errors="coerce")
-    df_local["date"] = df_local[ts_col].dt.date
+        df_local[ts_col] = dc.normalize_timestamps(df_local[ts_col])[0]
+    day = df_local[ts_col].dt.normalize()
+    df_local["date"] = day if compact else day.dt.date
+
+    last_visit_date = pd.Series(by_user(users["last_ts"].dt.normalize()), index=df_local.index)
+    df_local["last_visit_date"] = last_visit_date if compact else last_visit_date.dt.date
+    df_local["n_sessions"] = by_user(users["n_sessions"])
+
+    segment = activity_segment(
+        users["first_visit"].dt.normalize(), users["last_ts"].dt.normalize(), users["n_sessions"], date_now=date_now,
+        churn_days=churn_days, active_min_sessions=active_min_sessions, active_recency_days=active_recency_days
+    )
+    df_local["activity_segment"] = by_user(segment.astype(pd.CategoricalDtype(ACTIVITY_SEGMENTS)))
+    return df_local
 
-    # last_visit_date per user
-    df_local["last_visit_date"] = df_local.groupby("userid")["date"].transform("max")
-    df_local["n_sessions"] = df_local.groupby("userid")["sessionid"].transform("nunique")
 
+def activity_segment(
+    first_visit_day: pd.Series,
+    last_visit_date: pd.Series,
+    n_sessions: pd.Series,
+    date_now: date,
+    churn_days: int = 90,
+    active_min_sessions: int = 5,
+    active_recency_days: int = 30
+) -> pd.Series:
+    """
+    Правила сегментации (см. label_user_activity_segment) над уже посчитанными
+    first_visit_day / last_visit_date (datetime64, полночь дня) и n_sessions.
+    Работает и для событий, и для таблицы с одной строкой на пользователя.
+    """
+    today = pd.Timestamp(date_now)
     # default
-    df_local["activity_segment"] = "Returning"
+    segment = pd.Series("Returning", index=n_sessions.index, dtype=object)
     # new
-    df_local.loc[df_local["first_visit_day"] == date_now, "activity_segment"] = "New"
+    segment[first_visit_day == today] = "New"
     # churn risk
-    df_local.loc[df_local["last_visit_date"] < (date_now - timedelta(days=churn_days)), "activity_segment"] = "Churn-risk"
+    segment[last_visit_date < (today - timedelta(days=churn_days))] = "Churn-risk"
     # active
-    df_local.loc[
-        (df_local["n_sessions"] >= active_min_sessions) & (df_local["last_visit_date"] >= (date_now - timedelta(days=active_recency_days))),
-        "activity_segment"
-    ] = "Active"
-    return df_local
+    segment[(n_sessions >= active_min_sessions) & (last_visit_date >= (today - timedelta(days=active_recency_days)))] = "Active"
+    return segment
 
 
-def cohort_month_retention(df: pd.DataFrame, userid_col: str = "userid", ts_col: str = "timestamp") -> pd.DataFrame:
+def cohort_month_retention(
+    df: pd.DataFrame,
+    userid_col: str = "userid",
+    ts_col: str = "timestamp",
+    with_matrix: bool = False
+):
     """
     Базовый расчет удержания по когортам по месяцу начала:
       - определяем first_timestamp для каждого пользователя
@@ -75,32 +211,124 @@ def cohort_month_retention(df: pd.DataFrame, userid_col: str = "userid", ts_col:
 
     Возвращаем DataFrame с колонками:
       ['cohort_month', 'cohort_lifetime_days', 'retained_users', 'cohort_size']
+    with_matrix=True — (retention, matrix), см. retention_from_codes.
+
+    Без merge событий с пользователями: пользователи и дни кодируются целыми числами
+    (см. retention_from_codes).
     """
-    df_local = df.copy()
-    if ts_col not in df_local.columns:
+    if ts_col not in df.columns:
         raise ValueError(f"{ts_col} not present in df")
-    if not pd.api.types.is_datetime64_any_dtype(df_local[ts_col]):
-        df_local[ts_col] = pd.to_datetime(df_local[ts_col], errors="coerce")
-
-    first_ts = df_local.groupby(userid_col)[ts_col].min().rename("first_timestamp").reset_index()
-    df_local = df_local.merge(first_ts, on=userid_col, how="left")
-    df_local["cohort_month"] = df_local["first_timestamp"].dt.to_period("M").dt.to_timestamp()
-    df_local["cohort_lifetime_days"] = (df_local[ts_col] - df_local["cohort_month"]).dt.days
-
-    retained = (
-        df_local.groupby(["cohort_month", "cohort_lifetime_days"])[userid_col]
-        .nunique()
-        .reset_index()
-        .rename(columns={userid_col: "retained_users"})
-    )
+    ts = df[ts_col]
+    if not pd.api.types.is_datetime64_any_dtype(ts):
+        ts = dc.normalize_timestamps(ts)[0]
+    user_codes, n_users = _user_codes(df[userid_col])
+    return retention_from_codes(user_codes, ts, n_users, with_matrix=with_matrix)
 
-    cohort_sizes = (
-        first_ts.groupby(first_ts["first_timestamp"].dt.to_period("M").dt.to_timestamp())  # index is timestamp
-        .size()
-        .rename("cohort_size")
-        .reset_index()
-        .rename(columns={"first_timestamp": "cohort_month"})
-    )
 
-    retention = retained.merge(cohort_sizes, on="cohort_month", how="left")
-    return retention
+def _user_codes(values: pd.Series) -> Tuple[np.ndarray, int]:
+    """
+    Целые коды пользователей 0..n-1 (-1 для NaN) и n. Категории и целые id с небольшим
+    разбросом кодируются без хэширования (коды могут включать id без событий).
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.cat.codes.to_numpy(), len(values.cat.categories)
+    if pd.api.types.is_integer_dtype(values.dtype) and len(values) and not isinstance(values.dtype, pd.api.extensions.ExtensionDtype):
+        lo, hi = int(values.min()), int(values.max())
+        if hi - lo < 2 * len(values):
+            return values.to_numpy().astype(np.int64) - lo, hi - lo + 1
+    codes, uniques = pd.factorize(values)
+    return codes, len(uniques)
+
+
+def _day_numbers(values, unit: str = "D") -> np.ndarray:
+    """
+    Номер дня (unit="D") или начала месяца в днях (unit="M") от 1970-01-01 как int64,
+    по локальному времени для tz-aware; NaT -> минимальный int64.
+    """
+    values = pd.DatetimeIndex(values)
+    if values.tz is not None:
+        values = values.tz_localize(None)
+    return values.to_numpy().astype(f"datetime64[{unit}]").astype("datetime64[D]").astype(np.int64)
+
+
+def retention_from_codes(
+    user_codes: np.ndarray,
+    ts,
+    n_users: int,
+    first_ts=None,
+    with_matrix: bool = False
+):
+    """
+    Retention по месячным когортам на целочисленных ключах.
+
+    user_codes — код пользователя 0..n_users-1 каждого события (-1 — без пользователя, не считается);
+    ts — время событий; first_ts — первый timestamp каждого пользователя (позиция = код),
+    по умолчанию — минимум ts по событиям пользователя.
+    Когорта — месяц first_ts (целый id), день жизни события — номер его дня минус номер дня
+    начала месяца когорты (то же, что (ts - cohort_month).dt.days). Уникальные тройки
+    (когорта, день, пользователь) считаются по парам (день, пользователь): когорта
+    пользователя одна. Пары отмечаются в битовой карте, если она не больше 256 МБ,
+    иначе дедуплицируются сортировкой int64-ключей.
+
+    Возвращает таблицу как cohort_month_retention; with_matrix=True — (retention, matrix),
+    matrix — плотная матрица когорта x день жизни с retained_users (0, если никто не вернулся).
+    """
+    nat = np.iinfo(np.int64).min
+    user_codes = np.asarray(user_codes)
+    event_days = _day_numbers(ts)
+    valid = (user_codes >= 0) & (event_days != nat)
+    users = user_codes
+    if not valid.all():
+        users, event_days = user_codes[valid], event_days[valid]
+
+    # месяц когорты пользователя как номер дня его начала (NaT — пользователь без когорты)
+    if first_ts is None:
+        first_days = np.full(n_users, np.iinfo(np.int64).max)
+        np.minimum.at(first_days, users, event_days)
+        first_days[first_days == np.iinfo(np.int64).max] = nat
+        first_months = np.where(first_days != nat, first_days.astype("datetime64[D]").astype("datetime64[M]").astype("datetime64[D]").astype(np.int64), nat)
+    else:
+        first_months = _day_numbers(first_ts, unit="M")
+    has_cohort = first_months != nat
+    month_codes = np.full(n_users, -1, dtype=np.int64)
+    month_codes[has_cohort], month_start_days = pd.factorize(first_months[has_cohort], sort=True)
+    n_months = len(month_start_days)
+
+    event_cohorts = month_codes[users]
+    in_cohort = event_cohorts >= 0
+    all_valid = bool(valid.all() and in_cohort.all())
+    if not in_cohort.all():
+        users, event_days, event_cohorts = users[in_cohort], event_days[in_cohort], event_cohorts[in_cohort]
+    lifetime = event_days - month_start_days[event_cohorts]
+
+    n_days = int(lifetime.max()) + 1 if len(lifetime) else 1
+    keys = lifetime * max(n_users, 1) + users
+    if n_days * n_users <= 1 << 28:
+        seen = np.zeros(n_days * max(n_users, 1), dtype=bool)
+        seen[keys] = True
+        pairs = np.flatnonzero(seen)
+    else:
+        pairs = np.sort(keys)
+        pairs = pairs[np.r_[True, pairs[1:] != pairs[:-1]]] if len(pairs) else pairs
+    pair_days, pair_users = np.divmod(pairs, max(n_users, 1))
+    counts = np.bincount(month_codes[pair_users] * n_days + pair_days, minlength=n_months * n_days)
+    cohort_size = np.bincount(month_codes[has_cohort], minlength=n_months)
+
+    present = np.flatnonzero(counts)
+    cohort_idx, day = np.divmod(present, n_days)
+    months = pd.DatetimeIndex(month_start_days.astype("datetime64[D]"))
+    retention = pd.DataFrame({
+        "cohort_month": months[cohort_idx],
+        # как .dt.days: при NaT во времени событий или когорт дни получались float
+        "cohort_lifetime_days": day if all_valid else day.astype(float),
+        "retained_users": counts[present],
+        "cohort_size": cohort_size[cohort_idx],
+    })
+    if not with_matrix:
+        return retention
+    matrix = pd.DataFrame(
+        counts.reshape(n_months, n_days),
+        index=pd.Index(months, name="cohort_month"),
+        columns=pd.RangeIndex(n_days, name="cohort_lifetime_days"),
+    )
+    return retention, matrix
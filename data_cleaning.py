@@ -5,81 +5,712 @@ data_cleaning.py
 
 Функции возвращают чистые DataFrame и/или сессионные агрегаты.
 """
-from typing import Tuple, Optional
+import os
+import sys
+import csv
+import glob
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Tuple, Optional, Iterator, Dict, Sequence, List, Union
+import numpy as np
 import pandas as pd
 
+try:
+    from pandas.tseries.api import guess_datetime_format
+except ImportError:  # pandas < 2.2
+    from pandas._libs.tslibs.parsing import guess_datetime_format
 
-def read_telemetry_csv(path: str, ts_col: str = "timestamp", drop_unnamed: bool = True) -> pd.DataFrame:
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# сколько строк читаем, чтобы оценить размер строки при подборе chunksize
+_SAMPLE_ROWS = 10_000
+
+# компактная схема: строковые колонки с малым числом значений -> category,
+# идентификаторы -> минимальный целый тип (или category для строковых id)
+COMPACT_CATEGORICAL_COLS = ("action", "category")
+COMPACT_ID_COLS = ("userid", "sessionid")
+
+# двоичный поиск начала диапазона в отсортированном файле останавливается на блоке такого размера
+_SEEK_BLOCK_BYTES = 1 << 16
+_COMPRESSED_SUFFIXES = (".gz", ".bz2", ".zip", ".xz", ".zst", ".tar")
+# кусок чтения отсортированного файла по диапазону: сколько строк может быть прочитано сверх until
+_SORTED_CHUNK_ROWS = 100_000
+
+
+def peak_rss_mb() -> float:
     """
-    Прочитать CSV и привести timestamp к datetime.
-    Удаляет 'Unnamed: 0' если есть.
+    Пиковый RSS текущего процесса в мегабайтах (ru_maxrss); NaN, где модуля resource нет (Windows).
+    """
+    if resource is None:
+        return float("nan")
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдаёт килобайты, macOS — байты
+    if sys.platform == "darwin":
+        return rss / (1024 * 1024)
+    return rss / 1024
+
+
+def normalize_timestamps(values: pd.Series, fmt: Optional[str] = None) -> Tuple[pd.Series, dict]:
+    """
+    Разбор timestamp-строк с errors="coerce", но быстрее pd.to_datetime по всей колонке:
+      - формат определяется один раз (по первому непустому значению), если не передан fmt;
+      - разбираются только уникальные строки (в телеметрии значения с точностью
+        до секунды сильно повторяются), результат раскладывается обратно по кодам.
+
+    Уже datetime-колонка возвращается как есть: тип datetime64 и есть признак
+    нормализованной колонки, по нему остальные функции пропускают повторное приведение.
+
+    Возвращает (series, stats), stats = {"format", "unique_values", "coerced_to_nat"},
+    где coerced_to_nat — число непустых значений, которые не удалось разобрать.
+    """
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values, {"format": None, "unique_values": None, "coerced_to_nat": 0}
+    codes, uniques = pd.factorize(values)
+    if fmt is None and len(uniques) and isinstance(uniques[0], str):
+        fmt = guess_datetime_format(uniques[0])
+    parsed = pd.to_datetime(pd.Index(uniques), format=fmt, errors="coerce")
+    out = pd.Series(parsed.take(codes, allow_fill=True, fill_value=pd.NaT), index=values.index, name=values.name)
+    coerced = int(parsed.isna()[codes[codes >= 0]].sum())
+    return out, {"format": fmt, "unique_values": len(uniques), "coerced_to_nat": coerced}
+
+
+def derive_date(ts: pd.Series, compact: bool = False) -> pd.Series:
+    """
+    Колонка date из timestamp: python date (по умолчанию)
+    или datetime64, обрезанный до дня (compact=True, 8 байт на строку вместо объекта date).
+    """
+    if compact:
+        return ts.dt.normalize()
+    return ts.dt.date
+
+
+def is_compact_date(df: pd.DataFrame, date_col: str = "date") -> bool:
+    """
+    True, если date_col хранится в компактном виде (datetime64, а не python date).
+    """
+    return date_col in df.columns and pd.api.types.is_datetime64_any_dtype(df[date_col])
+
+
+def time_bounds(since=None, until=None) -> Tuple[Optional[pd.Timestamp], Optional[pd.Timestamp]]:
+    """
+    Диапазон времени [lo, hi) по границам since / until (строки, date, Timestamp;
+    None — без ограничения). Обе границы включительно; until без времени (полночь)
+    означает весь этот день: until="2024-03-07" -> hi = 2024-03-08 00:00.
+    """
+    lo = pd.Timestamp(since) if since is not None else None
+    hi = None
+    if until is not None:
+        hi = pd.Timestamp(until)
+        hi = hi + pd.Timedelta(days=1) if hi == hi.normalize() else hi + pd.Timedelta(1, "ns")
+    if lo is not None and hi is not None and lo >= hi:
+        raise ValueError("since must not be later than until")
+    return lo, hi
+
+
+def _align_bound(bound: Optional[pd.Timestamp], tz) -> Optional[pd.Timestamp]:
+    # граница без часового пояса — в поясе колонки; для naive-колонки пояс границы снимается
+    if bound is None:
+        return None
+    if tz is not None and bound.tz is None:
+        return bound.tz_localize(tz)
+    if tz is None and bound.tz is not None:
+        return bound.tz_convert(None)
+    return bound
+
+
+def time_range_mask(ts: pd.Series, since=None, until=None) -> np.ndarray:
+    """
+    Булева маска событий с timestamp в диапазоне since .. until (см. time_bounds).
+    NaT в диапазон не попадает.
+    """
+    lo, hi = time_bounds(since, until)
+    tz = getattr(ts.dtype, "tz", None)
+    mask = np.ones(len(ts), dtype=bool)
+    if lo is not None:
+        mask &= (ts >= _align_bound(lo, tz)).to_numpy(dtype=bool, na_value=False)
+    if hi is not None:
+        mask &= (ts < _align_bound(hi, tz)).to_numpy(dtype=bool, na_value=False)
+    return mask
+
+
+def compact_telemetry_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Приводит колонки событий к компактной схеме (in place, возвращает тот же df):
+      - action, category -> category
+      - userid, sessionid -> минимальный целый тип; строковые id -> category (словарное кодирование)
+    """
+    for col in COMPACT_CATEGORICAL_COLS:
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype("category")
+    for col in COMPACT_ID_COLS:
+        if col not in df.columns:
+            continue
+        if pd.api.types.is_integer_dtype(df[col]):
+            df[col] = pd.to_numeric(df[col], downcast="integer")
+        elif pd.api.types.is_object_dtype(df[col]) or pd.api.types.is_string_dtype(df[col]):
+            df[col] = df[col].astype("category")
+    return df
+
+
+def _clean_telemetry_chunk(
+    df: pd.DataFrame,
+    ts_col: str = "timestamp",
+    drop_unnamed: bool = True,
+    compact: bool = False,
+    ts_format: Optional[str] = None,
+    since=None,
+    until=None
+) -> pd.DataFrame:
+    """
+    Очистка одного куска CSV: удаление 'Unnamed: 0', приведение timestamp, колонка date.
+    При compact=True колонки приводятся к компактной схеме.
+    since / until — оставить только события из этого диапазона (см. time_bounds); строки
+    отбрасываются сразу после разбора timestamp, до остальной очистки.
+    Статистика разбора timestamp (см. normalize_timestamps) кладётся в df.attrs["timestamp_stats"].
     """
-    df = pd.read_csv(path)
     if drop_unnamed and "Unnamed: 0" in df.columns:
         df = df.drop(columns=["Unnamed: 0"])
     # приведение timestamp
     if ts_col in df.columns:
-        df[ts_col] = pd.to_datetime(df[ts_col], errors="coerce")
-        df["date"] = df[ts_col].dt.date
+        parsed, stats = normalize_timestamps(df[ts_col], fmt=ts_format)
+        df[ts_col] = parsed
+        if since is not None or until is not None:
+            df = df[time_range_mask(parsed, since, until)].reset_index(drop=True)
+        df.attrs["timestamp_stats"] = stats
+        df["date"] = derive_date(df[ts_col], compact=compact)
     else:
+        if since is not None or until is not None:
+            raise ValueError(f"{ts_col} is required to filter by since / until")
         df["date"] = pd.NaT
+    if compact:
+        compact_telemetry_dtypes(df)
     return df
 
 
+def _concat_chunks(chunks: list) -> pd.DataFrame:
+    """
+    Склеивает очищенные куски. У категориальных колонок категории объединяются
+    заранее, иначе concat превратил бы их обратно в object.
+    Статистика разбора timestamp суммируется по кускам.
+    """
+    first = chunks[0]
+    for col in first.columns:
+        if not isinstance(first[col].dtype, pd.CategoricalDtype):
+            continue
+        if not all(isinstance(c[col].dtype, pd.CategoricalDtype) for c in chunks):
+            continue
+        categories = pd.api.types.union_categoricals([c[col] for c in chunks], sort_categories=True).categories
+        for c in chunks:
+            c[col] = c[col].cat.set_categories(categories)
+    stats = [c.attrs["timestamp_stats"] for c in chunks if "timestamp_stats" in c.attrs]
+    for c in chunks:
+        c.attrs.pop("timestamp_stats", None)
+    out = pd.concat(chunks, ignore_index=True)
+    if stats:
+        out.attrs["timestamp_stats"] = {
+            "format": stats[0]["format"],
+            "unique_values": None,
+            "coerced_to_nat": sum(s["coerced_to_nat"] for s in stats),
+        }
+    return out
+
+
+def estimate_chunksize(path: str, memory_budget_mb: float, dtype: Optional[Dict[str, str]] = None) -> int:
+    """
+    Подбирает число строк в куске так, чтобы один разобранный кусок занимал
+    не больше memory_budget_mb. Размер строки оценивается по первым строкам файла.
+    """
+    sample = pd.read_csv(path, nrows=_SAMPLE_ROWS, dtype=dtype)
+    if sample.empty:
+        return _SAMPLE_ROWS
+    bytes_per_row = sample.memory_usage(deep=True).sum() / len(sample)
+    return max(1, int(memory_budget_mb * 1024 * 1024 / bytes_per_row))
+
+
+def _usecols(columns: Optional[Sequence[str]], ts_col: str):
+    # проекция при разборе CSV: только нужные колонки + timestamp; отсутствующие в файле пропускаются
+    if columns is None:
+        return None
+    wanted = set(columns) | {ts_col}
+    return lambda col: col in wanted
+
+
+def _csv_header(line: bytes) -> List[str]:
+    # имена колонок как у read_csv: пустое имя -> "Unnamed: <позиция>"
+    names = next(csv.reader([line.decode("utf-8-sig")]))
+    return [name or f"Unnamed: {i}" for i, name in enumerate(names)]
+
+
+def _line_timestamp(f, position: int) -> Optional[pd.Timestamp]:
+    # timestamp первой разбираемой строки начиная с текущей позиции файла (до 100 строк); None — не нашли
+    for _ in range(100):
+        line = f.readline()
+        if not line:
+            return None
+        fields = next(csv.reader([line.decode("utf-8")]), [])
+        if position < len(fields):
+            ts = pd.to_datetime(fields[position], errors="coerce")
+            if not pd.isna(ts):
+                return ts
+    return None
+
+
+def sorted_start_offset(path: str, since, ts_col: str = "timestamp") -> Tuple[int, List[str]]:
+    """
+    Для CSV, отсортированного по ts_col: смещение (в байтах) начала строки, до которого все
+    события раньше since, и имена колонок из заголовка. Двоичный поиск по смещениям файла
+    читает несколько строк вместо всего файла (строки не должны содержать перевод строки
+    внутри кавычек, файл — без сжатия). Если колонки ts_col нет — смещение начала данных.
+    """
+    lo_bound, _ = time_bounds(since, None)
+    with open(path, "rb") as f:
+        names = _csv_header(f.readline())
+        lo, hi = f.tell(), os.fstat(f.fileno()).st_size
+        if ts_col not in names or lo_bound is None:
+            return lo, names
+        position = names.index(ts_col)
+        # инвариант: все строки, начинающиеся до lo, раньше since
+        while hi - lo > _SEEK_BLOCK_BYTES:
+            mid = (lo + hi) // 2
+            f.seek(mid)
+            f.readline()
+            line_start = f.tell()
+            ts = _line_timestamp(f, position) if line_start < hi else None
+            if ts is not None and ts < _align_bound(lo_bound, ts.tz):
+                lo = line_start
+            else:
+                hi = mid
+    return lo, names
+
+
+def iter_telemetry_csv(
+    path: str,
+    ts_col: str = "timestamp",
+    drop_unnamed: bool = True,
+    chunksize: Optional[int] = None,
+    memory_budget_mb: Optional[float] = None,
+    dtype: Optional[Dict[str, str]] = None,
+    compact: bool = False,
+    columns: Optional[Sequence[str]] = None,
+    since=None,
+    until=None,
+    time_sorted: bool = False
+) -> Iterator[pd.DataFrame]:
+    """
+    Потоково читает CSV кусками и отдаёт уже очищенные куски
+    (та же очистка, что и в read_telemetry_csv).
+
+    Размер куска задаётся chunksize (строки) или memory_budget_mb;
+    если не задано ни то ни другое — используется бюджет 256 МБ (для отсортированного
+    файла с until — куски по 100 000 строк, чтобы не читать лишнее после until).
+    Пиковая память определяется размером куска, а не размером файла.
+    Формат timestamp определяется по первому куску и переиспользуется для остальных.
+
+    columns — разбирать только эти колонки (и ts_col); since / until — только события
+    из диапазона (см. time_bounds). time_sorted=True — файл отсортирован по ts_col
+    (например, выгрузка за период): чтение начинается с куска, где начинается since
+    (sorted_start_offset), и заканчивается на первом куске, дошедшем до until.
+    """
+    if chunksize is None and memory_budget_mb is None and time_sorted and until is not None:
+        chunksize = _SORTED_CHUNK_ROWS
+    if chunksize is None:
+        chunksize = estimate_chunksize(path, memory_budget_mb or 256, dtype=dtype)
+    usecols = _usecols(columns, ts_col)
+    _, hi = time_bounds(since, until)
+    ts_format = None
+    source, read_kwargs = path, {}
+    if time_sorted and since is not None and not path.endswith(_COMPRESSED_SUFFIXES):
+        # с начала диапазона: файл открыт на найденном смещении, имена колонок — из заголовка
+        offset, names = sorted_start_offset(path, since, ts_col=ts_col)
+        source = open(path, "rb")
+        source.seek(offset)
+        read_kwargs = {"header": None, "names": names}
+    try:
+        with pd.read_csv(source, chunksize=chunksize, dtype=dtype, usecols=usecols, **read_kwargs) as reader:
+            for chunk in reader:
+                # последний кусок отсортированного файла — тот, что дошёл до until
+                last = None
+                if time_sorted and hi is not None and len(chunk) and ts_col in chunk.columns:
+                    last = pd.to_datetime(chunk[ts_col].iloc[-1], format=ts_format, errors="coerce")
+                chunk = _clean_telemetry_chunk(
+                    chunk, ts_col=ts_col, drop_unnamed=drop_unnamed, compact=compact, ts_format=ts_format,
+                    since=since, until=until
+                )
+                ts_format = ts_format or chunk.attrs.get("timestamp_stats", {}).get("format")
+                yield chunk
+                if last is not None and not pd.isna(last) and last >= _align_bound(hi, last.tz):
+                    return
+    finally:
+        if source is not path:
+            source.close()
+
+
+def read_telemetry_csv(
+    path: str,
+    ts_col: str = "timestamp",
+    drop_unnamed: bool = True,
+    chunksize: Optional[int] = None,
+    memory_budget_mb: Optional[float] = None,
+    dtype: Optional[Dict[str, str]] = None,
+    compact: bool = False,
+    columns: Optional[Sequence[str]] = None,
+    since=None,
+    until=None,
+    time_sorted: bool = False
+) -> pd.DataFrame:
+    """
+    Прочитать CSV и привести timestamp к datetime.
+    Удаляет 'Unnamed: 0' если есть.
+
+    Если задан chunksize или memory_budget_mb, файл читается кусками через
+    iter_telemetry_csv и куски склеиваются; dtype передаётся в read_csv,
+    чтобы типы колонок совпадали во всех кусках.
+
+    compact=True включает компактную схему (см. compact_telemetry_dtypes):
+    category для action/category, узкие целые id, date как datetime64 (полночь дня).
+
+    Отбор при разборе (см. iter_telemetry_csv): columns — только эти колонки (ts_col
+    читается всегда, отсутствующие в файле пропускаются); since / until — только события
+    из диапазона, строки вне его отбрасываются сразу после разбора timestamp;
+    time_sorted=True — файл отсортирован по времени, читается кусками только
+    участок диапазона.
+    """
+    ranged = since is not None or until is not None
+    if chunksize is None and memory_budget_mb is None and not (time_sorted and ranged):
+        df = pd.read_csv(path, dtype=dtype, usecols=_usecols(columns, ts_col))
+        return _clean_telemetry_chunk(df, ts_col=ts_col, drop_unnamed=drop_unnamed, compact=compact, since=since, until=until)
+    chunks = list(iter_telemetry_csv(
+        path, ts_col=ts_col, drop_unnamed=drop_unnamed,
+        chunksize=chunksize, memory_budget_mb=memory_budget_mb, dtype=dtype, compact=compact,
+        columns=columns, since=since, until=until, time_sorted=time_sorted
+    ))
+    if not chunks:
+        # пустой файл (или диапазон после конца отсортированного файла): пустой фрейм с той же схемой
+        df = pd.read_csv(path, dtype=dtype, usecols=_usecols(columns, ts_col), nrows=0)
+        return _clean_telemetry_chunk(df, ts_col=ts_col, drop_unnamed=drop_unnamed, compact=compact, since=since, until=until)
+    return _concat_chunks(chunks)
+
+
+def read_telemetry_parquet(
+    path: str,
+    ts_col: str = "timestamp",
+    drop_unnamed: bool = True,
+    compact: bool = False,
+    columns: Optional[Sequence[str]] = None,
+    since=None,
+    until=None,
+    **_csv_kwargs
+) -> pd.DataFrame:
+    """
+    Прочитать события из Parquet (например, cleaned_events, записанный main.py --format parquet)
+    с той же очисткой, что и read_telemetry_csv. columns — проекция колонок при чтении;
+    since / until при timestamp-колонке в файле передаются в фильтр pyarrow: группы строк,
+    у которых min / max timestamp вне диапазона, не читаются. Параметры чтения CSV
+    (chunksize, dtype, ...) игнорируются.
+    """
+    import pyarrow.parquet as pq
+
+    names = pq.read_schema(path).names
+    names = [n for n in names if columns is None or n in set(columns) | {ts_col}]
+    df = pd.read_parquet(path, columns=names, filters=parquet_time_filters(path, ts_col, since, until))
+    return _clean_telemetry_chunk(df, ts_col=ts_col, drop_unnamed=drop_unnamed, compact=compact, since=since, until=until)
+
+
+def parquet_time_filters(path: str, ts_col: str = "timestamp", since=None, until=None) -> Optional[list]:
+    """
+    Фильтр pd.read_parquet(filters=...) по диапазону since .. until, если ts_col в файле
+    хранится как timestamp (иначе None — строки отбираются после разбора). По статистике
+    min / max pyarrow пропускает группы строк вне диапазона целиком.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if since is None and until is None:
+        return None
+    schema = pq.read_schema(path)
+    if ts_col not in schema.names or not pa.types.is_timestamp(schema.field(ts_col).type):
+        return None
+    tz = schema.field(ts_col).type.tz
+    lo, hi = (_align_bound(b, tz) for b in time_bounds(since, until))
+    return [f for f in ((ts_col, ">=", lo), (ts_col, "<", hi)) if f[2] is not None] or None
+
+
+def resolve_input_paths(paths: Union[str, Sequence[str]]) -> List[str]:
+    """
+    Список входных файлов: каталог -> все *.csv в нём (если их нет — *.parquet),
+    glob-шаблон -> совпадения, путь к файлу -> [путь], список -> как есть. Каталог и шаблон
+    сортируются по имени, чтобы порядок шардов (и итогового фрейма) был детерминированным.
+    """
+    if not isinstance(paths, str):
+        return list(paths)
+    if os.path.isdir(paths):
+        files = sorted(glob.glob(os.path.join(paths, "*.csv"))) or sorted(glob.glob(os.path.join(paths, "*.parquet")))
+    elif any(ch in paths for ch in "*?["):
+        files = sorted(glob.glob(paths))
+    else:
+        return [paths]
+    if not files:
+        raise FileNotFoundError(f"No input files match {paths}")
+    return files
+
+
+def read_telemetry_files(
+    paths: Union[str, Sequence[str]],
+    workers: Optional[int] = None,
+    **read_kwargs
+) -> pd.DataFrame:
+    """
+    Читает несколько CSV-шардов (каталог, glob или список путей) и склеивает их
+    в один очищенный фрейм в порядке resolve_input_paths.
+
+    Каждый шард читается и очищается read_telemetry_csv (read_kwargs передаются туда,
+    в т.ч. columns / since / until), файлы .parquet — read_telemetry_parquet,
+    в отдельном процессе ProcessPoolExecutor; workers — число процессов
+    (None — по числу ядер, 1 — последовательно, без пула).
+    """
+    files = resolve_input_paths(paths)
+    readers = [
+        partial(read_telemetry_parquet if f.endswith(".parquet") else read_telemetry_csv, f, **read_kwargs)
+        for f in files
+    ]
+    if len(files) == 1 or workers == 1:
+        frames = [reader() for reader in readers]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # порядок результатов — порядок файлов, независимо от того, какой шард готов первым
+            frames = [future.result() for future in [pool.submit(reader) for reader in readers]]
+    if len(frames) == 1:
+        return frames[0]
+    return _concat_chunks(frames)
+
+
 def parse_timestamps(df: pd.DataFrame, ts_col: str = "timestamp") -> pd.DataFrame:
     """
     Гарантирует тип datetime для timestamp и создает колонку date (python date).
+    Если date уже в компактном виде (datetime64), он сохраняется.
     Возвращаем копию.
     """
     df = df.copy()
     if ts_col in df.columns:
         if not pd.api.types.is_datetime64_any_dtype(df[ts_col]):
-            df[ts_col] = pd.to_datetime(df[ts_col], errors="coerce")
-        df["date"] = df[ts_col].dt.date
+            parsed, stats = normalize_timestamps(df[ts_col])
+            df[ts_col] = parsed
+            df.attrs["timestamp_stats"] = stats
+        df["date"] = derive_date(df[ts_col], compact=is_compact_date(df))
     else:
         df["date"] = pd.NaT
     return df
 
 
+def is_session_sorted(df: pd.DataFrame, session_col: str = "sessionid", ts_col: str = "timestamp") -> bool:
+    """
+    Проверяет за O(n), что df уже отсортирован по (session_col, ts_col)
+    так же, как это делает sort_values: сессии не убывают, внутри сессии
+    время не убывает, NaT — в конце сессии.
+    """
+    if session_col not in df.columns or ts_col not in df.columns:
+        return False
+    if not pd.api.types.is_datetime64_any_dtype(df[ts_col]):
+        return False
+    sess = df[session_col]
+    # строки с NaN-сессией sort_values уводит в конец — такой случай просто пересортируем
+    if sess.isna().any() or not sess.is_monotonic_increasing:
+        return False
+    ts = df[ts_col]
+    if ts.dt.tz is not None:
+        ts = ts.dt.tz_convert(None)
+    ts = ts.to_numpy().view("i8")
+    # NaT хранится как минимальный int64, а при сортировке стоит последним
+    ts = np.where(ts == np.iinfo(np.int64).min, np.iinfo(np.int64).max, ts)
+    codes = sess.cat.codes.to_numpy() if isinstance(sess.dtype, pd.CategoricalDtype) else sess.to_numpy()
+    same_session = codes[1:] == codes[:-1]
+    return bool(np.all(ts[1:][same_session] >= ts[:-1][same_session]))
+
+
+def sort_by_session(df: pd.DataFrame, session_col: str = "sessionid", ts_col: str = "timestamp") -> pd.DataFrame:
+    """
+    Упорядочивает события по (session_col, ts_col) и гарантирует datetime в ts_col.
+
+    Если df уже упорядочен (is_session_sorted), он возвращается как есть, без копии —
+    так main.py сортирует события один раз, а session-aware функции из
+    feature_engineering и metrics повторно не сортируют. Сортировка стабильная.
+    """
+    if ts_col in df.columns and not pd.api.types.is_datetime64_any_dtype(df[ts_col]):
+        df = df.assign(**{ts_col: normalize_timestamps(df[ts_col])[0]})
+    if is_session_sorted(df, session_col=session_col, ts_col=ts_col):
+        return df
+    sort_cols = [c for c in (session_col, ts_col) if c in df.columns]
+    return df.sort_values(sort_cols, kind="stable")
+
+
+def sessionize_by_inactivity(
+    df: pd.DataFrame,
+    userid_col: str = "userid",
+    ts_col: str = "timestamp",
+    session_col: str = "sessionid",
+    gap: Optional[str] = "30min",
+    max_duration: Optional[str] = None,
+    split_existing: bool = False
+) -> pd.DataFrame:
+    """
+    Назначает session_col по паузам активности, когда sessionid нет или ему нельзя доверять.
+
+    Новая сессия начинается, если сменился пользователь или пауза с предыдущим
+    событием пользователя больше gap (например, "30min"). Один проход:
+    сортировка + diff + cumsum, без groupby. Пользователь и время кодируются
+    в один int64-ключ, поэтому сортировка — один argsort; порядок событий
+    с одинаковым временем на номер сессии не влияет, стабильность не нужна.
+
+    split_existing=True — не пересобирать сессии по userid, а только резать
+    существующие session_col по gap и/или max_duration.
+    max_duration (например, "12h") — сессия дополнительно режется на окна этой
+    длины, отсчитанные от её начала.
+
+    События без пользователя/сессии или с NaT получают <NA>. Номера сессий — 0..k-1
+    в порядке (пользователь, время). Возвращает копию df (shallow) с новой session_col.
+    """
+    key_col = session_col if split_existing else userid_col
+    if key_col not in df.columns:
+        raise ValueError(f"Column {key_col} not found in df")
+    ts = df[ts_col]
+    if not pd.api.types.is_datetime64_any_dtype(ts):
+        ts = normalize_timestamps(ts)[0]
+    if ts.dt.tz is not None:
+        ts = ts.dt.tz_convert(None)
+
+    key_codes, key_uniques = pd.factorize(df[key_col], sort=True)
+    t_values = ts.to_numpy()
+    t = t_values.view("i8")
+    # gap/max_duration переводим в единицы колонки (ns, us, ...), а не колонку в ns
+    tick = pd.Timedelta(1, unit=np.datetime_data(t_values.dtype)[0])
+    valid = np.flatnonzero((key_codes >= 0) & ts.notna().to_numpy())
+    time_codes, time_uniques = pd.factorize(t[valid], sort=True)
+    if len(key_uniques) * max(len(time_uniques), 1) < np.iinfo(np.int64).max:
+        order = valid[np.argsort(key_codes[valid].astype(np.int64) * len(time_uniques) + time_codes)]
+    else:
+        order = valid[np.lexsort((t[valid], key_codes[valid]))]
+    keys, times = key_codes[order], t[order]
+
+    starts = np.ones(len(order), dtype=bool)
+    starts[1:] = keys[1:] != keys[:-1]
+    if gap is not None:
+        starts[1:] |= np.diff(times) > pd.Timedelta(gap) // tick
+    session_ids = np.cumsum(starts) - 1
+
+    if max_duration is not None and len(order):
+        # окно внутри сессии: (t - начало сессии) // max_duration
+        session_start = times[np.flatnonzero(starts)][session_ids]
+        window = (times - session_start) // (pd.Timedelta(max_duration) // tick)
+        starts[1:] |= window[1:] != window[:-1]
+        session_ids = np.cumsum(starts) - 1
+
+    out = np.full(len(df), -1, dtype=np.int64)
+    out[order] = session_ids
+    df_out = df.copy(deep=False)
+    if len(order) == len(df):
+        df_out[session_col] = pd.Series(out, index=df.index)
+    else:
+        df_out[session_col] = pd.Series(out, index=df.index).astype("Int64").mask(out < 0)
+    return df_out
+
+
+def ensure_sessions(
+    df: pd.DataFrame,
+    userid_col: str = "userid",
+    ts_col: str = "timestamp",
+    session_col: str = "sessionid",
+    gap: Optional[str] = None,
+    max_duration: Optional[str] = None
+) -> pd.DataFrame:
+    """
+    Гарантирует наличие session_col (см. sessionize_by_inactivity):
+      - session_col нет -> сессии по паузам (gap, по умолчанию 30 минут);
+      - задан gap -> session_col пересобирается по паузам;
+      - задан только max_duration -> существующие сессии режутся по длительности;
+      - иначе df возвращается как есть.
+    """
+    if session_col not in df.columns or gap is not None:
+        return sessionize_by_inactivity(
+            df, userid_col=userid_col, ts_col=ts_col, session_col=session_col,
+            gap=gap or "30min", max_duration=max_duration
+        )
+    if max_duration is not None:
+        return sessionize_by_inactivity(
+            df, userid_col=userid_col, ts_col=ts_col, session_col=session_col,
+            gap=None, max_duration=max_duration, split_existing=True
+        )
+    return df
+
+
 def compute_session_aggregates(
     df: pd.DataFrame,
     session_col: str = "sessionid",
     ts_col: str = "timestamp",
-    keep_events: bool = True
+    keep_events: bool = True,
+    broadcast_cols: Sequence[str] = ("session_duration",),
+    with_actions: bool = False
 ) -> Tuple[pd.DataFrame, pd.DataFrame]:
     """
     Вычисляет таблицу сессий:
       session_start, session_end, session_duration (в секундах), events_count
+      (+ first_action, last_action при with_actions=True — в том же groupby)
     И возвращает:
-      - events_df (если keep_events=True) — оригинальный df с колонкой session_duration (подмножество колонок сессий замержено),
+      - events_df (если keep_events=True) — df с колонками сессий из broadcast_cols
+        (по умолчанию только session_duration),
       - sessions_df — DataFrame со сессионными агрегатами.
 
+    Сессионные значения разносятся по событиям без merge и без полной копии df:
+    позиция сессии каждого события ищется по индексу sessions (get_indexer),
+    значения берутся take по этим позициям. Порядок и индекс событий сохраняются.
+
     ВАЖНО: сессии вычисляются по session_col, поэтому session_col должен присутствовать.
     """
     if session_col not in df.columns:
         raise ValueError(f"Column {session_col} not found in df")
 
-    df_local = df.copy()
-    # гарантируем datetime
+    # гарантируем datetime (без копии остальных колонок)
+    df_local = df
     if ts_col in df_local.columns and not pd.api.types.is_datetime64_any_dtype(df_local[ts_col]):
-        df_local[ts_col] = pd.to_datetime(df_local[ts_col], errors="coerce")
-
-    sessions = (
-        df_local.groupby(session_col, as_index=False)
-        .agg(
-            session_start=(ts_col, "min"),
-            session_end=(ts_col, "max"),
-            events_count=(ts_col, "count")
-        )
+        df_local = df_local.assign(**{ts_col: normalize_timestamps(df_local[ts_col])[0]})
+
+    aggs = dict(
+        session_start=(ts_col, "min"),
+        session_end=(ts_col, "max"),
+        events_count=(ts_col, "count"),
     )
+    sessions = df_local.groupby(session_col, as_index=False, observed=True).agg(**aggs)
     sessions["session_duration"] = (sessions["session_end"] - sessions["session_start"]).dt.total_seconds().fillna(0)
-    # merge session_duration обратно в события (выравнивание по sessionid)
-    if keep_events:
-        df_out = df_local.merge(sessions[[session_col, "session_duration"]], on=session_col, how="left")
-        return df_out, sessions
-    else:
+    if with_actions:
+        # первое / последнее событие сессии по времени — позиционно по границам сессий
+        # в упорядоченной проекции (groupby first/last пропустили бы NaN в action)
+        source = sort_by_session(df_local[[session_col, ts_col, "action"]], session_col=session_col, ts_col=ts_col)
+        codes = pd.Index(sessions[session_col]).get_indexer(source[session_col])
+        rows = np.flatnonzero(codes >= 0)
+        starts = rows[np.r_[True, codes[rows[1:]] != codes[rows[:-1]]]] if len(rows) else rows
+        ends = np.r_[rows[np.searchsorted(rows, starts[1:]) - 1], rows[-1:]] if len(rows) else rows
+        first_pos = np.full(len(sessions), -1, dtype=np.int64)
+        last_pos = np.full(len(sessions), -1, dtype=np.int64)
+        first_pos[codes[starts]] = starts
+        last_pos[codes[starts]] = ends
+        actions = source["action"].array
+        sessions["first_action"] = pd.api.extensions.take(actions, first_pos, allow_fill=True)
+        sessions["last_action"] = pd.api.extensions.take(actions, last_pos, allow_fill=True)
+
+    if not keep_events:
         return df_local, sessions
 
+    # выравнивание по sessionid: позиция сессии для каждого события (-1 -> NaN)
+    positions = pd.Index(sessions[session_col]).get_indexer(df_local[session_col])
+    df_out = df_local.copy(deep=False)
+    for col in broadcast_cols:
+        values = pd.api.extensions.take(sessions[col].array, positions, allow_fill=True)
+        df_out[col] = pd.Series(values, index=df_out.index)
+    return df_out, sessions
+
 
 def safe_fill_category(df: pd.DataFrame, col: str = "category", fill_value: str = "unknown") -> pd.DataFrame:
     """
@@ -87,6 +718,8 @@ def safe_fill_category(df: pd.DataFrame, col: str = "category", fill_value: str
     """
     df = df.copy()
     if col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype) and fill_value not in df[col].cat.categories:
+            df[col] = df[col].cat.add_categories([fill_value])
         df[col] = df[col].fillna(fill_value)
     return df
 
@@ -0,0 +1,286 @@
+"""
+distinct_sketches.py
+
+Приближённый подсчёт уникальных значений (пользователей, сессий, покупателей)
+на HyperLogLog-скетчах.
+
+Скетч — 2**precision однобайтовых регистров; для каждой группы (день,
+день + категория / сегмент и т.п.) хранится своя строка регистров. Скетчи
+объединяются поэлементным максимумом, поэтому недельные / месячные и любые
+диапазонные оценки собираются из дневных скетчей без возврата к событиям.
+Относительная ошибка оценки ~ 1.04 / sqrt(2**precision): 0.8% при precision=14.
+
+Набор скетчей — словарь:
+  - keys:      pd.DataFrame ключей групп (по строке на группу)
+  - registers: np.ndarray uint8 формы (число групп, 2**precision)
+"""
+from datetime import date
+from typing import List, Optional, Sequence, Union
+import numpy as np
+import pandas as pd
+
+import sketch_storage as ss
+
+
+DEFAULT_PRECISION = 14
+MIN_PRECISION = 4
+MAX_PRECISION = 18
+
+
+def _check_precision(precision: int) -> None:
+    if not MIN_PRECISION <= precision <= MAX_PRECISION:
+        raise ValueError(f"precision must be in [{MIN_PRECISION}, {MAX_PRECISION}]")
+
+
+def sketch_precision(sketches: dict) -> int:
+    """
+    precision набора скетчей (по числу регистров).
+    """
+    return int(sketches["registers"].shape[1]).bit_length() - 1
+
+
+def hash_values(values: pd.Series) -> np.ndarray:
+    """
+    64-битные хэши значений (uint64). Значение хэшируется одинаково независимо
+    от ширины целого типа и от того, category это или нет, поэтому скетчи
+    обычной и компактной схемы совместимы. Целые значения во float-колонке
+    (userid, прочитанный как float64 из-за пропусков) хэшируются как int64:
+    1.0 и 1 дают один хэш; дробные значения хэшируются как float.
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        # категории хэшируются как обычные значения и раскладываются по кодам
+        hashes = pd.util.hash_pandas_object(values, index=False).to_numpy(copy=True)
+        codes = values.cat.codes.to_numpy()
+        known = codes >= 0
+        if known.any():
+            hashes[known] = hash_values(pd.Series(values.cat.categories))[codes[known]]
+        return hashes
+    if isinstance(values.dtype, np.dtype) and values.dtype.kind == "i" and values.dtype.itemsize < 8:
+        # хэш берётся от байтов значения: отрицательные узкие целые расширяются до int64
+        values = values.astype(np.int64)
+    hashes = pd.util.hash_pandas_object(values, index=False).to_numpy(copy=True)
+    if pd.api.types.is_float_dtype(values.dtype):
+        x = values.to_numpy(dtype=np.float64, na_value=np.nan)
+        integral = np.isfinite(x) & (x == np.round(x)) & (np.abs(x) < 2.0 ** 63)
+        if integral.any():
+            hashes[integral] = pd.util.hash_pandas_object(pd.Series(x[integral].astype(np.int64)), index=False).to_numpy()
+    return hashes
+
+
+def _bit_length(x: np.ndarray, bits: int = 64) -> np.ndarray:
+    # до 53 бит значение точно представимо в float64: длина — показатель frexp
+    if bits <= 53:
+        return np.frexp(x.astype(np.float64))[1].astype(np.int64)
+    # иначе размазываем старший бит вниз и считаем единицы
+    x = x.copy()
+    for shift in (1, 2, 4, 8, 16, 32):
+        x |= x >> np.uint64(shift)
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(x).astype(np.int64)
+    table = np.array([bin(i).count("1") for i in range(256)], dtype=np.int64)
+    return table[x.view(np.uint8).reshape(-1, 8)].sum(axis=1)
+
+
+def register_updates(hashes: np.ndarray, precision: int):
+    """
+    Для каждого хэша: номер регистра (старшие precision бит) и ранг —
+    позиция первой единицы в оставшихся битах (1..64 - precision + 1).
+    """
+    q = 64 - precision
+    idx = (hashes >> np.uint64(q)).astype(np.int64)
+    rest = hashes & np.uint64((1 << q) - 1)
+    rank = (q + 1 - _bit_length(rest, q)).astype(np.uint8)
+    return idx, rank
+
+
+def build_sketches(
+    df: pd.DataFrame,
+    value_col: str,
+    keys: Union[str, List[str]] = "date",
+    precision: int = DEFAULT_PRECISION,
+    mask: Optional[pd.Series] = None
+) -> dict:
+    """
+    Скетчи уникальных значений value_col по группам keys (отсортированы по ключам).
+    mask — учитывать только строки, где mask истинна (например, заказы для покупателей).
+    Строки с NaN в value_col или в ключах не учитываются.
+    """
+    _check_precision(precision)
+    keys = [keys] if isinstance(keys, str) else list(keys)
+    grouped = df.groupby(keys, sort=True, observed=True, dropna=True)
+    # строки с NaN в ключах получают NaN вместо номера группы
+    codes = grouped.ngroup().fillna(-1).to_numpy(dtype=np.int64)
+    key_frame = grouped.size().index.to_frame(index=False)
+
+    values = df[value_col]
+    valid = (codes >= 0) & values.notna().to_numpy()
+    if mask is not None:
+        valid &= mask.to_numpy(dtype=bool)
+    if not valid.all():
+        codes, values = codes[valid], values[valid]
+
+    m = 1 << precision
+    registers = np.zeros((len(key_frame), m), dtype=np.uint8)
+    if len(codes):
+        idx, rank = register_updates(hash_values(values), precision)
+        np.maximum.at(registers.reshape(-1), codes * m + idx, rank)
+    return {"keys": key_frame, "registers": registers}
+
+
+def merge_sketches(a: dict, b: dict) -> dict:
+    """
+    Объединение двух наборов скетчей с одинаковыми колонками ключей и precision:
+    группы с совпадающими ключами сливаются (максимум регистров), остальные добавляются.
+    """
+    if a["registers"].shape[1] != b["registers"].shape[1]:
+        raise ValueError("sketches have different precision")
+    keys = pd.concat([a["keys"], b["keys"]], ignore_index=True)
+    return union_sketches({"keys": keys, "registers": np.concatenate([a["registers"], b["registers"]])}, list(keys.columns))
+
+
+def union_sketches(sketches: dict, keys: Optional[List[str]] = None) -> dict:
+    """
+    Объединяет скетчи групп с одинаковыми значениями keys (подмножество колонок ключей),
+    например keys=["date"] сворачивает скетчи (date, category) в дневные.
+    keys=None или [] — один скетч на весь набор.
+    """
+    registers = sketches["registers"]
+    if not keys:
+        merged = registers.max(axis=0, keepdims=True) if len(registers) else np.zeros((1, registers.shape[1]), dtype=np.uint8)
+        return {"keys": pd.DataFrame(index=range(1)), "registers": merged}
+    grouped = sketches["keys"].groupby(keys, sort=True, observed=True, dropna=False)
+    codes = grouped.ngroup().to_numpy()
+    key_frame = grouped.size().index.to_frame(index=False)
+    order = np.argsort(codes, kind="stable")
+    starts = np.flatnonzero(np.r_[True, codes[order][1:] != codes[order][:-1]]) if len(codes) else codes
+    merged = np.maximum.reduceat(registers[order], starts, axis=0) if len(codes) else registers
+    return {"keys": key_frame, "registers": merged}
+
+
+def _sigma(x: np.ndarray) -> np.ndarray:
+    # sigma(x) = x + sum_k x^(2^k) * 2^(k-1); x = 1 -> inf (все регистры пустые)
+    empty = x == 1
+    x = np.where(empty, 0.0, x)
+    result = x.copy()
+    y = 1.0
+    for _ in range(64):
+        x = x * x
+        result += x * y
+        y *= 2
+    return np.where(empty, np.inf, result)
+
+
+def _tau(x: np.ndarray) -> np.ndarray:
+    # tau(x) = (1 - x - sum_k (1 - x^(2^-k))^2 * 2^-k) / 3
+    x = x.astype(float)
+    result = 1 - x
+    y = 1.0
+    for _ in range(64):
+        x = np.sqrt(x)
+        y /= 2
+        result -= (1 - x) ** 2 * y
+    return result / 3
+
+
+def estimate_registers(registers: np.ndarray) -> np.ndarray:
+    """
+    Оценки числа уникальных значений по строкам регистров.
+
+    Улучшенная оценка Ertl (2017): несмещённа во всём диапазоне, включая малые
+    количества, без эмпирических таблиц поправок HLL++.
+    """
+    n, m = registers.shape
+    if n == 0:
+        return np.zeros(0)
+    q = 64 - (m.bit_length() - 1)
+    # гистограмма значений регистров по каждой строке
+    counts = np.bincount(
+        (np.arange(n, dtype=np.int64)[:, None] * (q + 2) + registers).reshape(-1),
+        minlength=n * (q + 2)
+    ).reshape(n, q + 2).astype(float)
+    z = m * _tau(1 - counts[:, q + 1] / m)
+    for k in range(q, 0, -1):
+        z = (z + counts[:, k]) * 0.5
+    z += m * _sigma(counts[:, 0] / m)
+    alpha = 0.5 / np.log(2)
+    return alpha * m * m / z
+
+
+def estimate(sketches: dict) -> pd.DataFrame:
+    """
+    Ключи групп и оценка числа уникальных значений (колонка estimate).
+    """
+    result = sketches["keys"].copy()
+    result["estimate"] = estimate_registers(sketches["registers"])
+    return result
+
+
+def _daily_registers(sketches: dict, date_col: str):
+    # дневные скетчи на непрерывном диапазоне дат (дни без событий — пустые регистры)
+    daily = union_sketches(sketches, [date_col])
+    dates = pd.DatetimeIndex(pd.to_datetime(daily["keys"][date_col]))
+    if not len(dates):
+        return pd.DatetimeIndex([], name=date_col), daily["registers"]
+    full = pd.date_range(dates.min(), dates.max(), freq="D", name=date_col)
+    registers = np.zeros((len(full), daily["registers"].shape[1]), dtype=np.uint8)
+    registers[full.get_indexer(dates)] = daily["registers"]
+    return full, registers
+
+
+def rolling_max(registers: np.ndarray, window: int) -> np.ndarray:
+    """
+    Строка i — объединение (максимум) строк i-window+1..i; удвоением окна,
+    O(log window) проходов вместо window.
+    """
+    out = registers.copy()
+    span = 1
+    while span * 2 <= window:
+        np.maximum(out[span:], out[:-span].copy(), out=out[span:])
+        span *= 2
+    rest = window - span
+    if rest > 0:
+        np.maximum(out[rest:], out[:-rest].copy(), out=out[rest:])
+    return out
+
+
+def rolling_estimates(sketches: dict, windows: Sequence[int] = (1, 7, 30), date_col: str = "date") -> pd.DataFrame:
+    """
+    По каждому дню: оценка уникальных значений за окна из windows дней,
+    заканчивающиеся этим днём (колонки distinct_{N}d). Окно 1 — дневная оценка,
+    7 / 30 — WAU / MAU для скетчей пользователей.
+    """
+    dates, registers = _daily_registers(sketches, date_col)
+    result = pd.DataFrame({date_col: dates})
+    for window in windows:
+        result[f"distinct_{window}d"] = estimate_registers(rolling_max(registers, window))
+    return result
+
+
+def range_estimate(
+    sketches: dict,
+    start: Union[str, date, pd.Timestamp],
+    end: Union[str, date, pd.Timestamp],
+    date_col: str = "date"
+) -> float:
+    """
+    Оценка уникальных значений за дни [start, end] (включительно).
+    """
+    dates = pd.to_datetime(sketches["keys"][date_col])
+    in_range = ((dates >= pd.Timestamp(start)) & (dates <= pd.Timestamp(end))).to_numpy()
+    merged = union_sketches({"keys": sketches["keys"][in_range], "registers": sketches["registers"][in_range]})
+    return float(estimate_registers(merged["registers"])[0])
+
+
+def save_sketches(sketches: dict, path: str) -> None:
+    """
+    Сохраняет набор скетчей в .npz (формат — см. sketch_storage).
+    """
+    ss.save_sketch_arrays(path, sketches["keys"], {"registers": sketches["registers"]})
+
+
+def load_sketches(path: str) -> dict:
+    """
+    Загружает набор скетчей, сохранённый save_sketches.
+    """
+    keys, arrays = ss.load_sketch_arrays(path)
+    return {"keys": keys, "registers": arrays["registers"]}
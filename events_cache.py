@@ -0,0 +1,194 @@
+"""
+events_cache.py
+
+Кэш очищенных событий в колоночном формате (Parquet) между запусками.
+
+Чтение CSV, заполнение category, разбор timestamp и сессионные агрегаты
+выполняются один раз; результат сохраняется в parquet-файлы, ключ которых —
+отпечаток входного файла (путь, размер, mtime) и параметры очистки.
+Следующие запуски читают готовые типизированные события (с выбором колонок).
+"""
+import os
+import re
+import json
+import hashlib
+from typing import Tuple, Optional, List
+import pandas as pd
+
+import data_cleaning as dc
+
+
+# увеличивать при изменении логики очистки, чтобы старые кэши не переиспользовались
+CACHE_VERSION = 1
+
+
+def file_fingerprint(path: str) -> dict:
+    """
+    Отпечаток файла: абсолютный путь, размер и время модификации (нс).
+    """
+    st = os.stat(path)
+    return {"path": os.path.abspath(path), "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def cache_key(path: str, **params) -> str:
+    """
+    Ключ кэша: sha1 от отпечатков входных файлов (path может быть каталогом или glob,
+    см. data_cleaning.resolve_input_paths), параметров очистки и CACHE_VERSION.
+    """
+    files = [file_fingerprint(p) for p in dc.resolve_input_paths(path)]
+    payload = {"version": CACHE_VERSION, "files": files, "params": params}
+    raw = json.dumps(payload, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha1(raw).hexdigest()[:16]
+
+
+def cache_paths(cache_dir: str, path: str, key: str) -> Tuple[str, str]:
+    """
+    Пути parquet-файлов событий и сессий для данного ключа.
+    """
+    stem = os.path.splitext(os.path.basename(path.rstrip("/\\")))[0]
+    # каталог или glob-шаблон -> безопасное имя файла
+    stem = re.sub(r"[^\w.-]+", "_", stem) or "events"
+    return (
+        os.path.join(cache_dir, f"{stem}-{key}.events.parquet"),
+        os.path.join(cache_dir, f"{stem}-{key}.sessions.parquet"),
+    )
+
+
+def _write_parquet(df: pd.DataFrame, path: str) -> None:
+    # пишем во временный файл и переименовываем, чтобы прерванный запуск не оставил битый кэш
+    tmp_path = path + ".tmp"
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def _select_range(
+    events: pd.DataFrame,
+    sessions: pd.DataFrame,
+    ts_col: str,
+    session_col: str,
+    since,
+    until,
+    session_gap: Optional[str] = None
+):
+    """
+    События диапазона [since, until] из полного кэша с той же семантикой, что чтение
+    с since / until без кэша: вход — только события окна, поэтому сессии (по паузам,
+    если задан session_gap) и их агрегаты пересчитываются по окну.
+    """
+    if since is None and until is None:
+        return events, sessions
+    events = events[dc.time_range_mask(events[ts_col], since, until)].reset_index(drop=True)
+    if session_gap is not None:
+        events = dc.ensure_sessions(events, ts_col=ts_col, session_col=session_col, gap=session_gap)
+    events = dc.sort_by_session(events, session_col=session_col, ts_col=ts_col)
+    return dc.compute_session_aggregates(events, session_col=session_col, ts_col=ts_col, keep_events=True)
+
+
+def clean_events(
+    path: str,
+    ts_col: str = "timestamp",
+    session_col: str = "sessionid",
+    fill_value: str = "unknown",
+    compact: bool = False,
+    chunksize: Optional[int] = None,
+    memory_budget_mb: Optional[float] = None,
+    session_gap: Optional[str] = None,
+    max_session_duration: Optional[str] = None,
+    workers: Optional[int] = None,
+    since=None,
+    until=None
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Шаги 1-4 main.py без кэша: read_telemetry_files, safe_fill_category,
+    parse_timestamps, ensure_sessions, sort_by_session, compute_session_aggregates.
+    path — файл, каталог или glob-шаблон шардов. Возвращает (events_df, sessions_df).
+    since / until — читать только события диапазона (сессии строятся по ним).
+    """
+    df = dc.read_telemetry_files(
+        path, workers=workers, ts_col=ts_col,
+        chunksize=chunksize, memory_budget_mb=memory_budget_mb, compact=compact, since=since, until=until
+    )
+    df = dc.safe_fill_category(df, col="category", fill_value=fill_value)
+    df = dc.parse_timestamps(df, ts_col=ts_col)
+    df = dc.ensure_sessions(df, ts_col=ts_col, session_col=session_col, gap=session_gap, max_duration=max_session_duration)
+    df = dc.sort_by_session(df, session_col=session_col, ts_col=ts_col)
+    return dc.compute_session_aggregates(df, session_col=session_col, ts_col=ts_col, keep_events=True)
+
+
+def load_clean_events(
+    path: str,
+    cache_dir: str,
+    columns: Optional[List[str]] = None,
+    ts_col: str = "timestamp",
+    session_col: str = "sessionid",
+    fill_value: str = "unknown",
+    compact: bool = False,
+    chunksize: Optional[int] = None,
+    memory_budget_mb: Optional[float] = None,
+    session_gap: Optional[str] = None,
+    max_session_duration: Optional[str] = None,
+    workers: Optional[int] = None,
+    since=None,
+    until=None
+) -> Tuple[pd.DataFrame, pd.DataFrame, bool]:
+    """
+    То же, что clean_events, но через parquet-кэш в cache_dir.
+
+    columns — какие колонки событий читать (проекция на уровне parquet; отсутствующие
+    в событиях пропускаются); None — все колонки. Возвращает (events_df, sessions_df, cache_hit).
+    since / until — только события из диапазона (см. data_cleaning.time_bounds), результат
+    тот же, что у clean_events с since / until: сессии и их агрегаты считаются по событиям
+    окна (сессия, начатая до since, обрезается). Кэш всегда хранит весь вход; при попадании
+    диапазон передаётся в фильтр parquet (группы строк вне диапазона не читаются).
+    Сессии, порезанные по max_session_duration без session_gap, по окну из кэша
+    не восстановить (исходные sessionid в нём не хранятся) — такой запрос читает вход мимо кэша.
+    chunksize / memory_budget_mb / workers влияют только на чтение CSV и в ключ не входят.
+    """
+    key = cache_key(
+        path, ts_col=ts_col, session_col=session_col, fill_value=fill_value, compact=compact,
+        session_gap=session_gap, max_session_duration=max_session_duration
+    )
+    events_path, sessions_path = cache_paths(cache_dir, path, key)
+
+    ranged = since is not None or until is not None
+    if ranged and max_session_duration is not None and session_gap is None:
+        events, sessions = clean_events(
+            path, ts_col=ts_col, session_col=session_col, fill_value=fill_value,
+            compact=compact, chunksize=chunksize, memory_budget_mb=memory_budget_mb,
+            max_session_duration=max_session_duration, workers=workers, since=since, until=until
+        )
+        if columns is not None:
+            events = events[[c for c in columns if c in events.columns]]
+        return events, sessions, False
+    # для пересчёта сессий окна нужны время и сессия события (и userid для сессий по паузам)
+    read_columns = columns
+    if columns is not None and ranged:
+        read_columns = list(dict.fromkeys(list(columns) + [ts_col, session_col, "userid"]))
+
+    if os.path.exists(events_path) and os.path.exists(sessions_path):
+        if read_columns is not None:
+            import pyarrow.parquet as pq
+
+            available = set(pq.read_schema(events_path).names)
+            read_columns = [c for c in read_columns if c in available]
+        events = pd.read_parquet(
+            events_path, columns=read_columns, filters=dc.parquet_time_filters(events_path, ts_col, since, until)
+        )
+        sessions = pd.read_parquet(sessions_path)
+        events, sessions = _select_range(events, sessions, ts_col, session_col, since, until, session_gap)
+        if columns is not None:
+            events = events[[c for c in columns if c in events.columns]]
+        return events, sessions, True
+
+    events, sessions = clean_events(
+        path, ts_col=ts_col, session_col=session_col, fill_value=fill_value,
+        compact=compact, chunksize=chunksize, memory_budget_mb=memory_budget_mb,
+        session_gap=session_gap, max_session_duration=max_session_duration, workers=workers
+    )
+    os.makedirs(cache_dir, exist_ok=True)
+    _write_parquet(events, events_path)
+    _write_parquet(sessions, sessions_path)
+    events, sessions = _select_range(events, sessions, ts_col, session_col, since, until, session_gap)
+    if columns is not None:
+        events = events[[c for c in columns if c in events.columns]]
+    return events, sessions, False
@@ -3,10 +3,16 @@ feature_engineering.py
 
 Создание признаков: сдвиги внутри сессий, product->cart transitions,
 basket size, average times и другие session-aware признаки.
+
+Все функции принимают события в любом порядке, но если df уже отсортирован
+по (session_col, ts_col) (см. data_cleaning.sort_by_session), повторной
+сортировки не происходит.
 """
 from typing import List, Optional
 import pandas as pd
 
+import data_cleaning as dc
+
 
 def add_session_shifts(df: pd.DataFrame, session_col: str = "sessionid", ts_col: str = "timestamp") -> pd.DataFrame:
     """
@@ -15,14 +21,14 @@ def add_session_shifts(df: pd.DataFrame, session_col: str = "sessionid", ts_col:
     """
     if session_col not in df.columns:
         raise ValueError(f"{session_col} not found in df")
-    df = df.copy()
-    if ts_col in df.columns and not pd.api.types.is_datetime64_any_dtype(df[ts_col]):
-        df[ts_col] = pd.to_datetime(df[ts_col], errors="coerce")
-    df = df.sort_values([session_col, ts_col])
-    df["prev_action_in_session"] = df.groupby(session_col)["action"].shift(1)
-    df["next_action_in_session"] = df.groupby(session_col)["action"].shift(-1)
-    df["prev_ts_in_session"] = df.groupby(session_col)[ts_col].shift(1)
-    df["next_ts_in_session"] = df.groupby(session_col)[ts_col].shift(-1)
+    df = dc.sort_by_session(df, session_col=session_col, ts_col=ts_col).copy(deep=False)
+    # один groupby на обе колонки вместо отдельного на каждый сдвиг
+    grouped = df.groupby(session_col, observed=True, sort=False)[["action", ts_col]]
+    prev, nxt = grouped.shift(1), grouped.shift(-1)
+    df["prev_action_in_session"] = prev["action"]
+    df["next_action_in_session"] = nxt["action"]
+    df["prev_ts_in_session"] = prev[ts_col]
+    df["next_ts_in_session"] = nxt[ts_col]
     return df
 
 
@@ -30,11 +36,8 @@ def compute_session_step_number(df: pd.DataFrame, session_col: str = "sessionid"
     """
     Вычисляет порядковый номер события внутри сессии (1,2,3,...).
     """
-    df = df.copy()
-    if ts_col in df.columns and not pd.api.types.is_datetime64_any_dtype(df[ts_col]):
-        df[ts_col] = pd.to_datetime(df[ts_col], errors="coerce")
-    df = df.sort_values([session_col, ts_col])
-    df["session_step_number"] = df.groupby(session_col).cumcount() + 1
+    df = dc.sort_by_session(df, session_col=session_col, ts_col=ts_col).copy(deep=False)
+    df["session_step_number"] = df.groupby(session_col, observed=True, sort=False).cumcount() + 1
     return df
 
 
@@ -59,24 +62,21 @@ def compute_basket_size_and_avg_time(df: pd.DataFrame, session_col: str = "sessi
     Ранее использовался diff() по всем cart/checkout событиям, что включало
     checkout->checkout и искажало метрику.
     """
-    df = df.copy()
-    if ts_col in df.columns and not pd.api.types.is_datetime64_any_dtype(df[ts_col]):
-        df[ts_col] = pd.to_datetime(df[ts_col], errors="coerce")
-    df = df.sort_values([session_col, ts_col])
+    df = dc.sort_by_session(df, session_col=session_col, ts_col=ts_col).copy(deep=False)
 
     # product -> cart inside session
-    df["product_to_cart"] = ((df["action"] == "cart") & (df.groupby(session_col)["action"].shift(1) == "product")).astype(int)
+    df["product_to_cart"] = ((df["action"] == "cart") & (df.groupby(session_col, observed=True, sort=False)["action"].shift(1) == "product")).astype(int)
     # basket size per session
-    df["basket_size"] = df.groupby(session_col)["product_to_cart"].transform("sum")
+    df["basket_size"] = df.groupby(session_col, observed=True, sort=False)["product_to_cart"].transform("sum")
 
     # average time between cart and next checkout inside session
     # только учитываем пары cart -> checkout
-    df_cart_checkout = df[df["action"].isin(["cart", "checkout"])].copy()
-    df_cart_checkout = df_cart_checkout.sort_values([session_col, ts_col])
+    # подмножество отсортированного df остаётся отсортированным — пересортировка не нужна
+    df_cart_checkout = df.loc[df["action"].isin(["cart", "checkout"]), [session_col, ts_col, "action"]]
 
     # prev action and prev timestamp inside session (only among cart/checkout rows)
-    df_cart_checkout["prev_action_in_session"] = df_cart_checkout.groupby(session_col)["action"].shift(1)
-    df_cart_checkout["prev_ts_in_session"] = df_cart_checkout.groupby(session_col)[ts_col].shift(1)
+    prev = df_cart_checkout.groupby(session_col, observed=True, sort=False)[["action", ts_col]].shift(1)
+    df_cart_checkout = df_cart_checkout.assign(prev_action_in_session=prev["action"], prev_ts_in_session=prev[ts_col])
 
     # Рассчитываем время ТОЛЬКО для строк, где текущий action == 'checkout' и prev_action == 'cart'
     mask_cart_to_checkout = (
@@ -88,7 +88,7 @@ def compute_basket_size_and_avg_time(df: pd.DataFrame, session_col: str = "sessi
     ).dt.total_seconds()
 
     # Усредняем только по этим корректным парам
-    avg_time = df_cart_checkout.groupby(session_col)["time_from_cart_to_checkout"].mean()
+    avg_time = df_cart_checkout.groupby(session_col, observed=True)["time_from_cart_to_checkout"].mean()
 
     df["avg_time_between_cart_and_checkout"] = df[session_col].map(avg_time).fillna(0)
     return df
@@ -100,8 +100,6 @@ def first_action_per_session(df: pd.DataFrame, session_col: str = "sessionid", t
     """
     if session_col not in df.columns:
         raise ValueError(f"{session_col} not found")
-    df_local = df.copy()
-    if ts_col in df_local.columns and not pd.api.types.is_datetime64_any_dtype(df_local[ts_col]):
-        df_local[ts_col] = pd.to_datetime(df_local[ts_col], errors="coerce")
-    firsts = df_local.sort_values([session_col, ts_col]).groupby(session_col).first().reset_index()
+    df_local = dc.sort_by_session(df, session_col=session_col, ts_col=ts_col)
+    firsts = df_local.groupby(session_col, observed=True).first().reset_index()
     return firsts
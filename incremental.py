@@ -0,0 +1,481 @@
+"""
+incremental.py
+
+Инкрементальный пересчёт витрин при дозагрузке телеметрии.
+
+Вместо пересчёта funnel / KPI / Sankey / конверсий / активности / retention
+по всей истории хранятся частичные агрегаты (каталоги parquet-партиций в state_dir):
+  - kpi_days:         date, orders_count, gmv (аддитивные суммы по дням)
+  - user_days:        date, userid, is_buyer (кто был активен / покупал в день)
+  - session_days:     date, sessionid, userid
+  - sessions:         сессионные агрегаты + достигнутая глубина воронки и последнее событие
+  - transitions:      уникальные тройки (action, next_action, userid) для Sankey
+  - users:            userid, first_ts, last_ts, conv_first_ts (первый шаг воронки), n_events
+  - conversion_pairs: userid, action — шаги, сделанные не раньше conv_first_ts
+  - product_to_cart:  переходы product -> cart
+  - kpis, retention:  готовые таблицы, в них переписываются только затронутые даты / когорты
+  - activity_bitmaps: битовые карты активности пользователей по дням (см. activity_bitmaps)
+
+Таблицы с датой в ключе разбиты на файлы по дням (retention — по когортам),
+таблицы пользователей и сессий — на N_BUCKETS файлов по хэшу userid / sessionid.
+Новая порция событий обновляет только затронутые даты, сессии и пользователей,
+и на диск переписываются только партиции, в которые она попала.
+
+Ограничение: партиционирована только запись. load_state читает все партиции, а
+обновление и build_outputs работают с полными таблицами (фильтры _replace_rows,
+retention когорт порции по всем их дням, Sankey и число сессий по всем тройкам /
+session_days). Поэтому запуск на одну дату всё равно стоит O(истории) по чтению и
+памяти, хотя в разы дешевле полного пересчёта по событиям: вместо событий читаются
+агрегаты. Частичная загрузка мало что даст без других агрегатов: порция за день
+задевает почти все хэш-корзины пользователей, а выходы sessions / activity_users /
+transitions_product_to_cart сами по себе содержат всю историю.
+Требование: события пользователя в новой порции не раньше уже загруженных
+(дозагрузка по времени); иначе update_state падает с ValueError, и состояние
+нужно пересобрать с нуля. События с NaT в timestamp не учитываются.
+"""
+import os
+import json
+from datetime import date, datetime
+from typing import Dict, List, Optional
+import numpy as np
+import pandas as pd
+
+import data_cleaning as dc
+import metrics as mtr
+import cohorts as coh
+import activity_bitmaps as ab
+
+
+# увеличивать при изменении схемы состояния
+STATE_VERSION = 4
+# число файлов-партиций таблиц пользователей и сессий
+N_BUCKETS = 64
+
+_STATE_COLUMNS = {
+    "kpi_days": ["date", "orders_count", "gmv"],
+    "user_days": ["date", "userid", "is_buyer"],
+    "session_days": ["date", "sessionid", "userid"],
+    "sessions": [
+        "sessionid", "userid", "session_start", "session_end", "events_count",
+        "funnel_depth", "last_action", "last_userid",
+    ],
+    "transitions": ["action", "next_action", "userid"],
+    "users": ["userid", "first_ts", "last_ts", "conv_first_ts", "n_events"],
+    "conversion_pairs": ["userid", "action"],
+    "product_to_cart": ["userid", "sessionid", "prev_action_in_session", "action", "timestamp"],
+    "kpis": ["date", "orders_count", "gmv", "sessions_count", "buyers_count", "dau"],
+    "retention": ["cohort_month", "cohort_lifetime_days", "retained_users", "cohort_size"],
+}
+
+# таблица -> (колонка ключа партиции, "date" — файл на день, "bucket" — файл на хэш-корзину)
+_PARTITIONS = {
+    "kpi_days": ("date", "date"),
+    "user_days": ("date", "date"),
+    "session_days": ("date", "date"),
+    "sessions": ("sessionid", "bucket"),
+    "transitions": ("userid", "bucket"),
+    "users": ("userid", "bucket"),
+    "conversion_pairs": ("userid", "bucket"),
+    "product_to_cart": ("userid", "bucket"),
+    "kpis": ("date", "date"),
+    "retention": ("cohort_month", "date"),
+}
+
+
+def _plain(values: pd.Series) -> pd.Series:
+    # категориальные колонки в состоянии храним как обычные значения, чтобы порции склеивались
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.astype(values.cat.categories.dtype)
+    return values
+
+
+def _append(old: pd.DataFrame, new: pd.DataFrame) -> pd.DataFrame:
+    # пустая таблица из свежего состояния не должна портить типы колонок new
+    if old.empty:
+        return new.reset_index(drop=True)
+    return pd.concat([old, new], ignore_index=True)
+
+
+def _replace_rows(old: pd.DataFrame, new: pd.DataFrame, key: str, keys) -> pd.DataFrame:
+    # строки old с затронутыми ключами заменяются на new
+    return _append(old[~old[key].isin(keys)], new)
+
+
+def _partition_keys(values, kind: str) -> np.ndarray:
+    """
+    Имена файлов-партиций для значений ключа: день (YYYY-MM-DD) или номер хэш-корзины.
+    Хэш — по строковому виду ключа, он не зависит от dtype колонки после чтения parquet.
+    """
+    values = pd.Series(values)
+    if kind == "date":
+        return pd.to_datetime(values).dt.strftime("%Y-%m-%d").to_numpy(dtype=object)
+    buckets = pd.util.hash_array(values.astype(str).to_numpy(dtype=object)) % N_BUCKETS
+    return np.char.mod("%03d", buckets.astype(np.int64)).astype(object)
+
+
+def _touch(touched: Dict[str, set], name: str, values) -> None:
+    # отмечает партиции таблицы name, в которые попадают ключи values
+    touched.setdefault(name, set()).update(_partition_keys(values, _PARTITIONS[name][1]))
+
+
+def _load_partitions(directory: str, columns: List[str]) -> pd.DataFrame:
+    files = sorted(f for f in os.listdir(directory) if f.endswith(".parquet")) if os.path.isdir(directory) else []
+    if not files:
+        return pd.DataFrame(columns=columns)
+    return pd.concat([pd.read_parquet(os.path.join(directory, f)) for f in files], ignore_index=True)
+
+
+def _save_partitions(table: pd.DataFrame, directory: str, name: str, parts: Optional[set]) -> None:
+    """
+    Пишет партиции parts таблицы в directory (None — все, с удалением лишних файлов);
+    партиция, в которой не осталось строк, удаляется.
+    """
+    os.makedirs(directory, exist_ok=True)
+    column, kind = _PARTITIONS[name]
+    keys = _partition_keys(table[column], kind)
+    if parts is None:
+        parts = set(keys) | {f[:-len(".parquet")] for f in os.listdir(directory) if f.endswith(".parquet")}
+    mask = np.isin(keys, list(parts))
+    written = set()
+    for key, part in table[mask].groupby(keys[mask], sort=False):
+        path = os.path.join(directory, f"{key}.parquet")
+        part.to_parquet(path + ".tmp", index=False)
+        os.replace(path + ".tmp", path)
+        written.add(key)
+    for key in parts - written:
+        path = os.path.join(directory, f"{key}.parquet")
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def load_state(state_dir: str, config: dict) -> Dict[str, pd.DataFrame]:
+    """
+    Загружает состояние из state_dir (пустые таблицы, если его ещё нет) — все партиции
+    всех таблиц, см. ограничение в описании модуля.
+    Если состояние собрано с другими параметрами (шаги воронки и т.п.), бросает ValueError.
+    """
+    meta_path = os.path.join(state_dir, "meta.json")
+    if os.path.exists(meta_path):
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != STATE_VERSION or meta.get("config") != config:
+            raise ValueError(f"State in {state_dir} was built with other parameters; rebuild it from full history")
+    state = {name: _load_partitions(os.path.join(state_dir, name), columns) for name, columns in _STATE_COLUMNS.items()}
+    path = os.path.join(state_dir, "activity_bitmaps")
+    state["activity_bitmaps"] = ab.load_activity_bitmap_days(path) if os.path.isdir(path) else ab.empty_activity_bitmaps()
+    return state
+
+
+def save_state(
+    state: Dict[str, pd.DataFrame],
+    state_dir: str,
+    config: dict,
+    touched: Optional[Dict[str, set]] = None
+) -> None:
+    """
+    Сохраняет таблицы состояния и meta.json в state_dir.
+    touched — {таблица: имена партиций} для записи только изменённых партиций
+    (таблицы, которых нет в touched, не пишутся); None — записать всё состояние.
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    for name, table in state.items():
+        parts = None if touched is None else touched.get(name)
+        if touched is not None and not parts:
+            continue
+        directory = os.path.join(state_dir, name)
+        if name == "activity_bitmaps":
+            ab.save_activity_bitmap_days(table, directory, days=parts)
+        else:
+            _save_partitions(table, directory, name, parts)
+    with open(os.path.join(state_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({"version": STATE_VERSION, "config": config}, f, ensure_ascii=False, indent=2)
+
+
+def _update_sessions(
+    state: Dict[str, pd.DataFrame],
+    touched: Dict[str, set],
+    ev: pd.DataFrame,
+    steps: List[str],
+    step_map: Dict[str, int],
+    require_step_increase: bool
+) -> None:
+    """
+    Обновляет sessions / transitions / product_to_cart / session_days по новой порции
+    и отмечает изменённые партиции в touched.
+    ev отсортирован по (sessionid, timestamp). Продолжающиеся сессии стыкуются
+    с сохранённой глубиной воронки и последним событием.
+    """
+    sess_old = state["sessions"].set_index("sessionid")
+    session_codes, session_ids = pd.factorize(ev["sessionid"], sort=True)
+    n = len(ev)
+    starts = np.flatnonzero(np.r_[True, session_codes[1:] != session_codes[:-1]])
+    ends = np.r_[starts[1:] - 1, n - 1]
+    actions = ev["action"].to_numpy()
+    users = ev["userid"].to_numpy()
+    ts = ev["timestamp"].to_numpy()
+
+    continuing = session_ids.isin(sess_old.index)
+    prev = sess_old.reindex(session_ids)
+
+    # воронка: жадный автомат продолжает с сохранённой глубины
+    unique_steps = list(dict.fromkeys(steps))
+    action_codes = mtr.encode_actions(ev["action"], unique_steps)
+    step_codes = [unique_steps.index(s) for s in steps]
+    initial = prev["funnel_depth"].fillna(0).to_numpy(dtype=np.int64)
+    depth = mtr.funnel_depth(session_codes, action_codes, step_codes, len(session_ids), initial_depth=initial)
+
+    new_sessions = pd.DataFrame({
+        "sessionid": session_ids,
+        "userid": np.where(continuing, prev["userid"].to_numpy(dtype=object), users[starts]),
+        "session_start": np.where(continuing, prev["session_start"].to_numpy(), ts[starts]),
+        "session_end": ts[ends],
+        "events_count": (ends - starts + 1) + prev["events_count"].fillna(0).to_numpy(dtype=np.int64),
+        "funnel_depth": depth,
+        "last_action": actions[ends],
+        "last_userid": users[ends],
+    })
+    new_sessions["session_start"] = pd.to_datetime(new_sessions["session_start"])
+
+    # соседние пары внутри порции + стык с последним сохранённым событием сессии
+    same_session = session_codes[1:] == session_codes[:-1]
+    boundary = starts[continuing]
+    pairs = pd.DataFrame({
+        "action": np.r_[actions[:-1][same_session], prev["last_action"].to_numpy(dtype=object)[continuing]],
+        "next_action": np.r_[actions[1:][same_session], actions[boundary]],
+        "userid": np.r_[users[:-1][same_session], prev["last_userid"].to_numpy(dtype=object)[continuing]],
+    })
+    current_step = pairs["action"].map(step_map).astype(float)
+    next_step = pairs["next_action"].map(step_map).astype(float)
+    keep = current_step.notna() & next_step.notna()
+    if require_step_increase:
+        keep &= next_step >= current_step
+    transitions = _append(state["transitions"], pairs[keep]).drop_duplicates()
+
+    # product -> cart: предыдущее событие в сессии (в т.ч. из прошлых порций)
+    prev_action = pd.Series(actions, dtype=object).shift(1).to_numpy(copy=True)
+    prev_action[starts] = np.where(continuing, prev["last_action"].to_numpy(dtype=object), None)
+    mask = (actions == "cart") & (prev_action == "product")
+    product_to_cart = pd.DataFrame({
+        "userid": users[mask],
+        "sessionid": ev["sessionid"].to_numpy()[mask],
+        "prev_action_in_session": prev_action[mask],
+        "action": actions[mask],
+        "timestamp": ts[mask],
+    })
+
+    session_days = pd.DataFrame({"date": ev["timestamp"].dt.normalize(), "sessionid": ev["sessionid"], "userid": ev["userid"]}).drop_duplicates()
+    affected_days = session_days["date"].unique()
+    old_days = state["session_days"]
+    touched_days = old_days[old_days["date"].isin(affected_days)]
+
+    state["sessions"] = _replace_rows(sess_old.reset_index(), new_sessions, "sessionid", session_ids)
+    state["transitions"] = transitions
+    state["product_to_cart"] = _append(state["product_to_cart"], product_to_cart)
+    state["session_days"] = _replace_rows(old_days, _append(touched_days, session_days).drop_duplicates(), "date", affected_days)
+    _touch(touched, "sessions", session_ids)
+    _touch(touched, "transitions", pairs.loc[keep, "userid"])
+    _touch(touched, "product_to_cart", product_to_cart["userid"])
+    _touch(touched, "session_days", affected_days)
+
+
+def _update_days(state: Dict[str, pd.DataFrame], touched: Dict[str, set], ev: pd.DataFrame, orders_action: str) -> np.ndarray:
+    """
+    Обновляет kpi_days / user_days и пересчитывает kpis для затронутых дат
+    (их партиции отмечаются в touched). Возвращает затронутые даты.
+    """
+    day = ev["timestamp"].dt.normalize()
+    is_order = (ev["action"] == orders_action).to_numpy()
+    gmv = ev["checkout_value"] if "checkout_value" in ev.columns else 0.0
+    kpi_days = pd.DataFrame({"date": day, "orders_count": is_order.astype(np.int64), "gmv": gmv}).groupby("date", as_index=False).sum()
+    user_days = pd.DataFrame({"date": day, "userid": ev["userid"], "is_buyer": is_order}).groupby(["date", "userid"], as_index=False)["is_buyer"].max()
+    affected = kpi_days["date"].unique()
+
+    old = state["kpi_days"]
+    merged = _append(old[old["date"].isin(affected)], kpi_days).groupby("date", as_index=False).sum()
+    state["kpi_days"] = _replace_rows(old, merged, "date", affected)
+
+    old = state["user_days"]
+    merged = _append(old[old["date"].isin(affected)], user_days).groupby(["date", "userid"], as_index=False)["is_buyer"].max()
+    state["user_days"] = _replace_rows(old, merged, "date", affected)
+
+    # KPI только по затронутым датам
+    ud = state["user_days"][state["user_days"]["date"].isin(affected)]
+    sd = state["session_days"][state["session_days"]["date"].isin(affected)]
+    kpis = state["kpi_days"][state["kpi_days"]["date"].isin(affected)].set_index("date")
+    kpis["sessions_count"] = sd.groupby("date")["sessionid"].nunique()
+    kpis["buyers_count"] = ud[ud["is_buyer"].astype(bool)].groupby("date").size()
+    kpis["dau"] = ud.groupby("date").size()
+    kpis = kpis.fillna({"sessions_count": 0, "buyers_count": 0, "dau": 0}).astype({"sessions_count": "int64", "buyers_count": "int64", "dau": "int64"})
+    state["kpis"] = _replace_rows(state["kpis"], kpis.reset_index(), "date", affected)
+    for name in ("kpi_days", "user_days", "kpis"):
+        _touch(touched, name, affected)
+    return affected
+
+
+def _check_order(state: Dict[str, pd.DataFrame], ev: pd.DataFrame) -> None:
+    """
+    Новая порция должна продолжать историю каждого пользователя по времени.
+    """
+    users = state["users"]
+    if users.empty:
+        return
+    batch_first = ev.groupby("userid")["timestamp"].min()
+    last_ts = pd.to_datetime(users.set_index("userid")["last_ts"]).reindex(batch_first.index)
+    late = batch_first < last_ts
+    if late.any():
+        raise ValueError(
+            f"{int(late.sum())} users have events earlier than already loaded ones; "
+            "incremental update needs time-ordered batches, rebuild the state from full history"
+        )
+
+
+def _update_users(state: Dict[str, pd.DataFrame], touched: Dict[str, set], ev: pd.DataFrame, steps: List[str]) -> None:
+    """
+    Обновляет users / conversion_pairs и пересчитывает retention для затронутых когорт
+    (по уже обновлённым user_days); изменённые партиции отмечаются в touched.
+    """
+    grouped = ev.groupby("userid")["timestamp"]
+    batch = pd.DataFrame({"first_ts": grouped.min(), "last_ts": grouped.max(), "n_events": grouped.size()})
+    batch["conv_first_ts"] = ev[ev["action"] == steps[0]].groupby("userid")["timestamp"].min()
+
+    old = state["users"].set_index("userid")
+    # pd.to_datetime: у пустого состояния колонки ещё object
+    prev = old.reindex(batch.index)
+    prev_ts = prev[["first_ts", "conv_first_ts"]].apply(pd.to_datetime)
+    batch["first_ts"] = prev_ts["first_ts"].fillna(batch["first_ts"])
+    batch["conv_first_ts"] = prev_ts["conv_first_ts"].fillna(batch["conv_first_ts"])
+    batch["n_events"] += pd.to_numeric(prev["n_events"]).fillna(0).astype("int64")
+    state["users"] = _replace_rows(old.reset_index(), batch.rename_axis("userid").reset_index(), "userid", batch.index)
+
+    # шаги, сделанные не раньше первого шага воронки
+    step_events = ev[ev["action"].isin(steps)]
+    conv_first = batch["conv_first_ts"].reindex(step_events["userid"]).to_numpy()
+    reached = step_events.loc[step_events["timestamp"].to_numpy() >= conv_first, ["userid", "action"]]
+    state["conversion_pairs"] = _append(state["conversion_pairs"], reached).drop_duplicates()
+
+    # retention только для когорт пользователей из порции
+    users = state["users"]
+    cohort_month = users["first_ts"].dt.to_period("M").dt.to_timestamp()
+    affected = cohort_month[users["userid"].isin(batch.index)].unique()
+    cohort_users = users.loc[cohort_month.isin(affected), ["userid", "first_ts"]]
+    ud = state["user_days"][state["user_days"]["userid"].isin(cohort_users["userid"])]
+    user_codes = pd.Index(cohort_users["userid"]).get_indexer(ud["userid"])
+    retained = coh.retention_from_codes(user_codes, pd.to_datetime(ud["date"]), len(cohort_users), first_ts=cohort_users["first_ts"])
+    state["retention"] = _replace_rows(state["retention"], retained, "cohort_month", affected)
+    _touch(touched, "users", batch.index)
+    _touch(touched, "conversion_pairs", reached["userid"])
+    _touch(touched, "retention", affected)
+
+
+def update_state(
+    events: pd.DataFrame,
+    state_dir: str,
+    steps: List[str],
+    step_map: Optional[Dict[str, int]] = None,
+    require_step_increase: bool = True,
+    orders_action: str = "checkout",
+    session_col: str = "sessionid",
+    userid_col: str = "userid",
+    ts_col: str = "timestamp"
+) -> Dict[str, pd.DataFrame]:
+    """
+    Добавляет новую порцию очищенных событий (после шага 5 main.py) в состояние
+    в state_dir и сохраняет его. Возвращает обновлённое состояние.
+
+    step_map по умолчанию — позиция шага в steps (как в main.py).
+    """
+    if step_map is None:
+        step_map = {action: i for i, action in enumerate(steps)}
+    config = {
+        "steps": list(steps),
+        "step_map": dict(step_map),
+        "require_step_increase": require_step_increase,
+        "orders_action": orders_action,
+    }
+    state = load_state(state_dir, config)
+
+    cols = [c for c in (session_col, userid_col, ts_col, "action", "checkout_value") if c in events.columns]
+    ev = events.loc[events[ts_col].notna(), cols].rename(columns={session_col: "sessionid", userid_col: "userid", ts_col: "timestamp"})
+    ev = ev.assign(**{c: _plain(ev[c]) for c in ("sessionid", "userid", "action")})
+
+    # порядок важен: session_days (из сессий) нужны для KPI по дням,
+    # user_days (из дней) — для retention
+    _check_order(state, ev)
+    touched = {}
+    with_session = ev[ev["sessionid"].notna()]
+    _update_sessions(state, touched, dc.sort_by_session(with_session, session_col="sessionid", ts_col="timestamp"), steps, step_map, require_step_increase)
+    _update_days(state, touched, ev, orders_action)
+    _update_users(state, touched, ev, steps)
+    state["activity_bitmaps"] = ab.update_activity_bitmaps(state["activity_bitmaps"], ev)
+    touched["activity_bitmaps"] = set(ev["timestamp"].dt.normalize().unique())
+
+    save_state(state, state_dir, config, touched=touched)
+    return state
+
+
+def build_outputs(
+    state: Dict[str, pd.DataFrame],
+    steps: List[str],
+    date_now: Optional[date] = None
+) -> Dict[str, pd.DataFrame]:
+    """
+    Собирает из состояния те же таблицы, что main.py пишет при полном пересчёте:
+    sessions, transitions_product_to_cart, funnel, kpis_by_date, sankey,
+    conversion_daily, cohort_retention, activity_daily, retention_by_day, а также
+    activity_users — сегменты активности по одной строке на пользователя (событийные таблицы
+    cleaned_events / activity_labeled без полной истории не строятся).
+    Таблицы строятся по полному состоянию (O(истории), но без событий).
+    """
+    if date_now is None:
+        date_now = datetime.utcnow().date()
+
+    sessions = state["sessions"].sort_values("sessionid").reset_index(drop=True)
+    sessions_out = sessions[["sessionid", "session_start", "session_end", "events_count"]].copy()
+    sessions_out["session_duration"] = (sessions["session_end"] - sessions["session_start"]).dt.total_seconds().fillna(0)
+
+    p2c = state["product_to_cart"].sort_values(["sessionid", "timestamp"], kind="stable").reset_index(drop=True)
+
+    funnel = mtr.funnel_table(sessions["funnel_depth"].to_numpy(dtype=np.int64), sessions["userid"], steps)
+
+    kpis = state["kpis"].sort_values("date").reset_index(drop=True)
+    orders = kpis["orders_count"]
+    kpis["aov"] = (kpis["gmv"] / orders.where(orders > 0)).astype(float)
+    kpis["date"] = pd.to_datetime(kpis["date"]).dt.date
+
+    sankey = (
+        state["transitions"].groupby(["action", "next_action"])["userid"].nunique()
+        .reset_index(name="users")
+        .sort_values(["action", "next_action"])
+        .reset_index(drop=True)
+    )
+
+    # как при полном пересчёте (groupby по userid) — строки по возрастанию userid
+    users = state["users"].sort_values("userid").set_index("userid")
+    pairs = state["conversion_pairs"]
+    reached = pd.DataFrame({
+        "cohort_date": users["conv_first_ts"].reindex(pairs["userid"]).dt.normalize().to_numpy(),
+        "action": pairs["action"].to_numpy(),
+        "userid": pairs["userid"].to_numpy(),
+    })
+    conversion_daily = mtr.conversion_table(reached, steps)
+
+    retention = state["retention"].sort_values(["cohort_month", "cohort_lifetime_days"]).reset_index(drop=True)
+
+    n_sessions = state["session_days"].groupby("userid")["sessionid"].nunique()
+    activity = coh.user_activity_table(
+        users.index, users["first_ts"].dt.normalize(), users["last_ts"].dt.normalize(),
+        n_sessions.reindex(users.index).fillna(0).astype("int64"), users["n_events"], date_now=date_now
+    )
+
+    return {
+        "sessions.csv": sessions_out,
+        "transitions_product_to_cart.csv": p2c,
+        "funnel.csv": funnel,
+        "kpis_by_date.csv": kpis,
+        "sankey.csv": sankey,
+        "conversion_daily.csv": conversion_daily,
+        "activity_users.csv": activity,
+        "cohort_retention.csv": retention,
+        "activity_daily.csv": ab.daily_activity(state["activity_bitmaps"]),
+        "retention_by_day.csv": ab.retention_by_day(state["activity_bitmaps"]),
+    }
@@ -10,6 +10,18 @@ main.py
 
 Usage:
     python main.py --input dataset_telemetry.csv --output ./output
+    python main.py --input dataset_telemetry.csv --memory-budget-mb 512   # потоковое чтение кусками
+    python main.py --input dataset_telemetry.csv --compact                # компактные типы колонок
+    python main.py --input dataset_telemetry.csv --cache-dir ./.cache     # кэш очищенных событий в parquet
+    python main.py --input dataset_telemetry.csv --session-gap 30min      # сессии по паузам активности
+    python main.py --input "shards/*.csv" --workers 8                     # шарды в пуле процессов
+    python main.py --input day_2024-03-01.csv --state-dir ./state         # инкрементальная дозагрузка
+    python main.py --input dataset_telemetry.csv --label-events           # сегменты активности на каждом событии
+    python main.py --input dataset_telemetry.csv --approx-distinct        # уникальные через HyperLogLog-скетчи
+    python main.py --input dataset_telemetry.csv --profile                # профиль этапов: profile.json / profile.csv
+    python main.py --input dataset_telemetry.csv --profile-alloc          # + пик выделенной памяти (tracemalloc, медленнее)
+    python main.py --input dataset_telemetry.csv --format parquet         # результаты в Parquet (zstd), запись в пуле потоков
+    python main.py --input events_sorted.csv --since 2024-03-01 --until 2024-03-07 --sorted-input  # только окно дат
 """
 import os
 import argparse
@@ -22,6 +34,24 @@ import data_cleaning as dc
 import feature_engineering as fe
 import metrics as mtr
 import cohorts as coh
+import events_cache as ec
+import incremental as inc
+import activity_bitmaps as ab
+import distinct_sketches as ds
+import quantile_sketches as qs
+import pipeline as pl
+import profiling as prof
+import output_writers as ow
+
+
+# шаги воронки (порядок важен)
+FUNNEL_STEPS = ["search", "product", "category", "mainpage", "cart", "checkout", "confirmation"]
+
+# колонки, без которых не считаются сессии и метрики: читаются всегда, даже если не указаны в --columns
+REQUIRED_COLUMNS = ["userid", "sessionid", "timestamp", "action"]
+
+# результаты с одной строкой на событие: к ним применяется --event-columns
+EVENT_OUTPUTS = ["cleaned_events.csv", "activity_labeled.csv"]
 
 
 def ensure_output_dir(path: str):
@@ -43,115 +73,426 @@ def prepare_basic_event_values(df: pd.DataFrame) -> pd.DataFrame:
     return df
 
 
-def main(input_path: str, output_dir: str):
-    print(">>> Starting demo main.py")
-    ensure_output_dir(output_dir)
+def save_outputs(
+    out_files: dict,
+    output_dir: str,
+    output_format: str = "csv",
+    compression: str = None,
+    event_columns: list = None,
+    workers: int = None
+):
+    """
+    Сохраняет таблицы в output_dir (DataFrame -> CSV / Parquet / Feather, остальное -> текст),
+    файлы пишутся одновременно в пуле потоков (см. output_writers.save_outputs).
+    event_columns — колонки событийных результатов (EVENT_OUTPUTS), None — все.
+    """
+    columns = {fname: event_columns for fname in EVENT_OUTPUTS} if event_columns else None
+    return ow.save_outputs(out_files, output_dir, fmt=output_format, compression=compression, columns=columns, workers=workers)
+
 
+def write_profile(report: dict, output_dir: str):
+    """
+    Сохраняет профиль запуска (profile.json / profile.csv) и печатает сводку;
+    report=None — профилирование выключено.
+    """
+    if report is None:
+        return
+    table = prof.save_report(report, output_dir)
+    meta = report["meta"]
+    print(f">>> Profile: total {meta['total_wall_s']:.2f} s wall, {meta['total_cpu_s']:.2f} s CPU, peak RSS {meta['peak_rss_mb']:.1f} MB")
+    print(prof.summary_table(table))
+
+
+def read_and_clean(
+    input_path: str,
+    chunksize: int = None,
+    memory_budget_mb: float = None,
+    compact: bool = False,
+    session_gap: str = None,
+    max_session_duration: str = None,
+    workers: int = None,
+    report: dict = None,
+    columns: list = None,
+    since: str = None,
+    until: str = None,
+    sorted_input: bool = False
+):
+    """
+    Шаги 1-4: чтение, заполнение category, разбор timestamp, сессии, сессионные агрегаты.
+    report — отчёт profiling (None — без замеров).
+    columns / since / until — отбор колонок и диапазона времени при разборе входа,
+    sorted_input — вход отсортирован по timestamp (см. data_cleaning.read_telemetry_csv).
+    """
     # 1) Read & basic cleaning
     print(f">>> Reading file: {input_path}")
-    df = dc.read_telemetry_csv(input_path)
+    with prof.stage(report, "read") as st:
+        df = dc.read_telemetry_files(
+            input_path, workers=workers, chunksize=chunksize, memory_budget_mb=memory_budget_mb, compact=compact,
+            columns=columns, since=since, until=until, time_sorted=sorted_input
+        )
+        st["rows_out"] = len(df)
     print("Initial shape:", df.shape)
+    ts_stats = df.attrs.get("timestamp_stats")
+    if ts_stats:
+        print(f"Timestamps: format={ts_stats['format']!r}, coerced to NaT: {ts_stats['coerced_to_nat']}")
+    print(f"Events frame memory: {df.memory_usage(deep=True).sum() / 1024 ** 2:.1f} MB")
+    print(f"Peak RSS after read: {dc.peak_rss_mb():.1f} MB")
 
     # 2) Fill category NaNs
-    df = dc.safe_fill_category(df, col="category", fill_value="unknown")
+    with prof.stage(report, "fill", rows_in=len(df)) as st:
+        df = dc.safe_fill_category(df, col="category", fill_value="unknown")
+        st["rows_out"] = len(df)
 
     # 3) Ensure timestamp parsing and date col
-    df = dc.parse_timestamps(df, ts_col="timestamp")
+    with prof.stage(report, "parse", rows_in=len(df)) as st:
+        df = dc.parse_timestamps(df, ts_col="timestamp")
+        st["rows_out"] = len(df)
+
+    # 3a) sessionize by inactivity gap if sessionid is missing or untrusted
+    with prof.stage(report, "sessionize", rows_in=len(df)) as st:
+        df = dc.ensure_sessions(df, session_col="sessionid", ts_col="timestamp", gap=session_gap, max_duration=max_session_duration)
+        st["rows_out"] = len(df)
     print("Timestamp parsed. Sample:")
     print(df[["userid", "sessionid", "timestamp", "date", "action"]].head(3).to_string(index=False))
 
+    # 3b) sort once by session/time: session-aware functions below detect the order and skip re-sorting
+    with prof.stage(report, "sort", rows_in=len(df)) as st:
+        df = dc.sort_by_session(df, session_col="sessionid", ts_col="timestamp")
+        st["rows_out"] = len(df)
+
     # 4) session aggregates (session_duration at session level and merged back)
-    df, sessions = dc.compute_session_aggregates(df, session_col="sessionid", ts_col="timestamp", keep_events=True)
+    with prof.stage(report, "session_aggregates", rows_in=len(df)) as st:
+        df, sessions = dc.compute_session_aggregates(df, session_col="sessionid", ts_col="timestamp", keep_events=True)
+        st["rows_out"] = len(sessions)
     print("Sessions computed:", sessions.shape)
     print(sessions.head(3).to_string(index=False))
+    return df, sessions
+
+
+def _kpis_stage(df: pd.DataFrame, approx_distinct: bool, precision: int):
+    # 11) KPI by date; with approx_distinct distinct counts come from daily HyperLogLog sketches,
+    # which are saved and rolled up to WAU / MAU without going back to events
+    sketches = {}
+    kpis = mtr.compute_kpis_by_date(
+        df, date_col="date", orders_action="checkout", confirmation_col=None,
+        approx_distinct=approx_distinct, precision=precision, sketches=sketches
+    )
+    return kpis, sketches
+
+
+def _top_paths_stage(df: pd.DataFrame) -> pd.DataFrame:
+    # 12a) top multi-step paths (3-5 actions) from search / mainpage for the Sankey tab
+    return pd.concat(
+        [mtr.compute_top_paths(df, length=n, start_actions=["search", "mainpage"], top_k=20).assign(length=n) for n in (3, 4, 5)],
+        ignore_index=True
+    )
+
+
+def _activity_bitmaps_stage(df: pd.DataFrame):
+    # 14a) per-day user bitmaps: DAU / WAU / MAU, stickiness, new vs returning, N-day retention
+    bitmaps = ab.build_activity_bitmaps(df, userid_col="userid", ts_col="timestamp")
+    return ab.daily_activity(bitmaps), ab.retention_by_day(bitmaps, periods=(1, 7, 30))
+
+
+def _ux_stage(df: pd.DataFrame, activity_users: pd.DataFrame, sessions: pd.DataFrame):
+    # 14b) UX: session duration / events per session percentiles per date and activity segment
+    # from mergeable quantile sketches; daily figures are merged segment sketches
+    session_users = df.drop_duplicates("sessionid").set_index("sessionid")["userid"]
+    user_segments = activity_users.set_index("userid")["activity_segment"]
+    ux_sessions = sessions.assign(
+        activity_segment=user_segments.reindex(session_users.reindex(sessions["sessionid"])).to_numpy()
+    )
+    ux_sketches = mtr.build_ux_sketches(ux_sessions, segment_col="activity_segment")
+    return mtr.ux_metrics_table(ux_sketches), mtr.ux_metrics_table(ux_sketches, keys=["date"]), ux_sketches
+
+
+def metric_stages(
+    steps: list,
+    sessions: pd.DataFrame,
+    label_events: bool = False,
+    approx_distinct: bool = False,
+    hll_precision: int = ds.DEFAULT_PRECISION
+) -> list:
+    """
+    Шаги 10-15 как граф этапов pipeline.run_pipeline: имя, функция, зависимости
+    и колонки событий, которые этап читает (в общую память попадают только они).
+    """
+    session_cols = ["sessionid", "userid", "timestamp", "action"]
+    activity_cols = ["userid", "sessionid", "timestamp", "date", "user_first_visit_date"]
+    stages = [
+        # 10) compute funnel (unique users per session-step in order)
+        pl.stage("funnel", mtr.compute_funnel, columns=session_cols,
+                 steps=steps, session_col="sessionid", userid_col="userid", ts_col="timestamp"),
+        # 10a) funnels with conversion windows: cart->checkout within 30 min, whole funnel within 24 h;
+        # per session and per user across sessions
+        pl.stage("funnel_windowed", mtr.compute_windowed_funnel, columns=session_cols,
+                 steps=steps, max_step_gap={"checkout": "30min"}, window="24h", by="session"),
+        pl.stage("funnel_users_windowed", mtr.compute_windowed_funnel, columns=session_cols,
+                 steps=steps, max_step_gap={"checkout": "30min"}, window="24h", by="user"),
+        pl.stage("kpis", _kpis_stage, columns=["date", "timestamp", "action", "checkout_value", "sessionid", "userid"],
+                 approx_distinct=approx_distinct, precision=hll_precision),
+        # 12) Sankey transitions (action->next_action) inside sessions
+        pl.stage("sankey", mtr.compute_sankey_transitions, columns=session_cols,
+                 step_map={action: i for i, action in enumerate(steps)},
+                 session_col="sessionid", ts_col="timestamp", require_step_increase=True),
+        pl.stage("top_paths", _top_paths_stage, columns=session_cols),
+        # 13) daily conversions across steps
+        pl.stage("conversion_daily", mtr.compute_conversion_daily, columns=["timestamp", "action", "userid"],
+                 steps=steps, date_col="date"),
+        # 14) user activity segments (New / Returning / Churn-risk / Active), one row per user
+        pl.stage("activity_users", coh.build_user_activity, columns=activity_cols,
+                 first_visit_col="user_first_visit_date", ts_col="timestamp"),
+        pl.stage("activity_bitmaps", _activity_bitmaps_stage, columns=["userid", "timestamp"]),
+        pl.stage("ux", _ux_stage, deps=["activity_users"], columns=["sessionid", "userid"], sessions=sessions),
+        # 15) cohort month retention
+        pl.stage("retention", coh.cohort_month_retention, columns=["userid", "timestamp"],
+                 userid_col="userid", ts_col="timestamp"),
+    ]
+    if label_events:
+        # segment labels joined back to every event: needs the whole frame
+        stages.append(pl.stage("activity_labeled", coh.label_user_activity_segment,
+                               first_visit_col="user_first_visit_date", ts_col="timestamp"))
+    return stages
+
+
+def main(
+    input_path: str,
+    output_dir: str,
+    chunksize: int = None,
+    memory_budget_mb: float = None,
+    compact: bool = False,
+    cache_dir: str = None,
+    session_gap: str = None,
+    max_session_duration: str = None,
+    workers: int = None,
+    state_dir: str = None,
+    label_events: bool = False,
+    approx_distinct: bool = False,
+    hll_precision: int = ds.DEFAULT_PRECISION,
+    profile: bool = False,
+    profile_alloc: bool = False,
+    output_format: str = "csv",
+    compression: str = None,
+    event_columns: list = None,
+    columns: list = None,
+    since: str = None,
+    until: str = None,
+    sorted_input: bool = False
+):
+    print(">>> Starting demo main.py")
+    ensure_output_dir(output_dir)
+    report = prof.new_report(
+        trace_alloc=profile_alloc, input=input_path, compact=compact, cache_dir=cache_dir, workers=workers, state_dir=state_dir,
+        label_events=label_events, approx_distinct=approx_distinct, output_format=output_format,
+        columns=columns, since=since, until=until
+    ) if profile or profile_alloc else None
+    if columns is not None:
+        columns = list(dict.fromkeys(REQUIRED_COLUMNS + list(columns)))
+
+    # 1-4) read & clean, either directly or through the parquet cache of cleaned events
+    if cache_dir:
+        print(f">>> Loading cleaned events for {input_path} (cache: {cache_dir})")
+        with prof.stage(report, "read_clean_cached") as st:
+            df, sessions, cache_hit = ec.load_clean_events(
+                input_path, cache_dir=cache_dir, compact=compact,
+                chunksize=chunksize, memory_budget_mb=memory_budget_mb,
+                session_gap=session_gap, max_session_duration=max_session_duration, workers=workers,
+                # в кэше уже есть производные колонки событий: date и session_duration
+                columns=None if columns is None else columns + ["date", "session_duration"], since=since, until=until
+            )
+            st["rows_out"] = len(df)
+        print("Cache hit." if cache_hit else "Cache miss: cleaned events written to cache.")
+        print("Events:", df.shape, "Sessions:", sessions.shape)
+    else:
+        df, sessions = read_and_clean(
+            input_path, chunksize=chunksize, memory_budget_mb=memory_budget_mb, compact=compact,
+            session_gap=session_gap, max_session_duration=max_session_duration, workers=workers,
+            report=report, columns=columns, since=since, until=until, sorted_input=sorted_input
+        )
 
     # 5) derive cart/checkout value columns (if they don't exist)
-    df = prepare_basic_event_values(df)
+    with prof.stage(report, "event_values", rows_in=len(df)) as st:
+        df = prepare_basic_event_values(df)
+        st["rows_out"] = len(df)
+
+    # 5a) incremental mode: input holds only new events, aggregates are kept in state_dir
+    if state_dir:
+        print(f">>> Updating incremental state in {state_dir}")
+        with prof.stage(report, "incremental_update", rows_in=len(df)) as st:
+            state = inc.update_state(df, state_dir, steps=FUNNEL_STEPS, orders_action="checkout")
+        print("State:", {name: len(table) for name, table in state.items() if isinstance(table, pd.DataFrame)})
+        with prof.stage(report, "save") as st:
+            save_outputs(inc.build_outputs(state, steps=FUNNEL_STEPS), output_dir, output_format=output_format, compression=compression)
+        write_profile(report, output_dir)
+        print(">>> Demo finished.")
+        return
 
     # 6) add session step numbers & shifts
-    df = fe.compute_session_step_number(df, session_col="sessionid", ts_col="timestamp")
-    df = fe.add_session_shifts(df, session_col="sessionid", ts_col="timestamp")
+    with prof.stage(report, "shifts", rows_in=len(df)) as st:
+        df = fe.compute_session_step_number(df, session_col="sessionid", ts_col="timestamp")
+        df = fe.add_session_shifts(df, session_col="sessionid", ts_col="timestamp")
+        st["rows_out"] = len(df)
     print("Added session step numbers and session-aware shifts.")
 
     # 7) compute basket size and avg time between cart and checkout
-    df = fe.compute_basket_size_and_avg_time(df, session_col="sessionid", ts_col="timestamp")
+    with prof.stage(report, "basket", rows_in=len(df)) as st:
+        df = fe.compute_basket_size_and_avg_time(df, session_col="sessionid", ts_col="timestamp")
+        st["rows_out"] = len(df)
     print("Computed basket_size and avg_time_between_cart_and_checkout. Sample:")
     print(df[["sessionid", "action", "product_to_cart", "basket_size", "avg_time_between_cart_and_checkout"]].head(10).to_string(index=False))
 
     # 8) product->cart transitions (list)
-    transitions = fe.product_to_cart_transitions(df, session_col="sessionid", ts_col="timestamp")
+    with prof.stage(report, "transitions", rows_in=len(df)) as st:
+        transitions = fe.product_to_cart_transitions(df, session_col="sessionid", ts_col="timestamp")
+        st["rows_out"] = len(transitions)
     print("Product -> Cart transitions (sample):")
     print(transitions.head(10).to_string(index=False))
 
     # 9) define funnel steps (order matters)
-    steps = ["search", "product", "category", "mainpage", "cart", "checkout", "confirmation"]
+    steps = FUNNEL_STEPS
 
-    # 10) compute funnel (unique users per session-step in order)
-    funnel = mtr.compute_funnel(df, steps=steps, session_col="sessionid", userid_col="userid", ts_col="timestamp")
+    # 10-15) metric stages: each reads only the prepared events (and results of its deps),
+    # independent stages run concurrently in a process pool over shared-memory columns
+    stages = metric_stages(steps, sessions, label_events=label_events, approx_distinct=approx_distinct, hll_precision=hll_precision)
+    timings = {}
+    stage_stats = {} if report is not None else None
+    with prof.stage(report, "metrics", rows_in=len(df)) as st:
+        results = pl.run_pipeline(stages, df, workers=workers, timings=timings, stats=stage_stats)
+    for name in results if stage_stats is not None else ():
+        prof.add_stage(report, dict(stage_stats[name], stage=f"metrics.{name}"))
+    print("Metric stages (s):", {name: round(timings[name], 2) for name in results})
+
+    funnel = results["funnel"]
     print("Funnel results:")
     print(funnel.to_string(index=False))
 
-    # 11) KPI by date
-    kpis = mtr.compute_kpis_by_date(df, date_col="date", orders_action="checkout", confirmation_col=None)
+    funnel_windowed, funnel_users_windowed = results["funnel_windowed"], results["funnel_users_windowed"]
+    print("Windowed funnel (sessions / users):")
+    print(funnel_windowed.to_string(index=False))
+    print(funnel_users_windowed.to_string(index=False))
+
+    kpis, sketches = results["kpis"]
     print("KPIs by date (sample):")
     print(kpis.head(10).to_string(index=False))
+    distinct_rollup = None
+    if approx_distinct:
+        for name, sketch in sketches.items():
+            ds.save_sketches(sketch, os.path.join(output_dir, f"sketches_{name}.npz"))
+        distinct_rollup = ds.rolling_estimates(sketches["dau"], windows=(1, 7, 30), date_col="date").rename(
+            columns={"distinct_1d": "dau", "distinct_7d": "wau", "distinct_30d": "mau"}
+        )
+        distinct_rollup[["dau", "wau", "mau"]] = distinct_rollup[["dau", "wau", "mau"]].round().astype("int64")
+        print("Approximate DAU / WAU / MAU (sample):")
+        print(distinct_rollup.head(10).to_string(index=False))
 
-    # 12) Sankey transitions (action->next_action) inside sessions
-    # create a step_map similar to ваш ноутбук
-    step_map = {action: i for i, action in enumerate(steps)}
-    sankey = mtr.compute_sankey_transitions(df, step_map=step_map, session_col="sessionid", ts_col="timestamp", require_step_increase=True)
+    sankey = results["sankey"]
     print("Sankey transitions (sample):")
     print(sankey.head(10).to_string(index=False))
 
-    # 13) daily conversions across steps
-    conversion_daily = mtr.compute_conversion_daily(df, steps=steps, date_col="date")
+    top_paths = results["top_paths"]
+    print("Top paths (sample):")
+    print(top_paths.head(10).to_string(index=False))
+
+    conversion_daily = results["conversion_daily"]
     print("Daily conversions (sample):")
     print(conversion_daily.head(10).to_string(index=False))
 
-    # 14) label user activity (New / Returning / Churn-risk / Active)
-    # this function will compute first_visit if it's not in df
-    labeled = coh.label_user_activity_segment(df, first_visit_col="user_first_visit_date", ts_col="timestamp")
+    activity_users = results["activity_users"]
     print("Activity segments sample:")
-    print(labeled[["userid", "first_visit_day", "last_visit_date", "n_sessions", "activity_segment"]].drop_duplicates(subset=["userid"]).head(10).to_string(index=False))
+    print(activity_users.head(10).to_string(index=False))
+    labeled = results.get("activity_labeled")
+
+    activity_daily, retention_daily = results["activity_bitmaps"]
+    print("Daily activity (sample):")
+    print(activity_daily.head(10).to_string(index=False))
+
+    ux_by_segment, ux_daily, ux_sketches = results["ux"]
+    for name, sketch in ux_sketches.items():
+        qs.save_quantile_sketches(sketch, os.path.join(output_dir, f"ux_sketches_{name}.npz"))
+    print("UX metrics by date (sample):")
+    print(ux_daily.head(10).to_string(index=False))
 
-    # 15) cohort month retention
-    retention = coh.cohort_month_retention(df, userid_col="userid", ts_col="timestamp")
+    retention = results["retention"]
     print("Retention (sample):")
     print(retention.head(10).to_string(index=False))
 
     # 16) Save some outputs
-    print(f">>> Saving outputs to {output_dir}")
     out_files = {
         "cleaned_events.csv": df,
         "sessions.csv": sessions,
         "transitions_product_to_cart.csv": transitions,
         "funnel.csv": funnel,
+        "funnel_windowed.csv": funnel_windowed,
+        "funnel_users_windowed.csv": funnel_users_windowed,
         "kpis_by_date.csv": kpis,
         "sankey.csv": sankey,
+        "top_paths.csv": top_paths,
         "conversion_daily.csv": conversion_daily,
-        "activity_labeled.csv": labeled,
-        "cohort_retention.csv": retention
+        "activity_users.csv": activity_users,
+        "cohort_retention.csv": retention,
+        "activity_daily.csv": activity_daily,
+        "retention_by_day.csv": retention_daily,
+        "ux_daily.csv": ux_daily,
+        "ux_by_segment.csv": ux_by_segment
     }
-    for fname, obj in out_files.items():
-        path = os.path.join(output_dir, fname)
-        try:
-            if isinstance(obj, pd.DataFrame):
-                obj.to_csv(path, index=False)
-            else:
-                # fallback: pretty print non-dataframes to text
-                with open(path, "w", encoding="utf-8") as f:
-                    f.write(str(obj))
-            print(f"  saved {fname}")
-        except Exception as e:
-            print(f"  failed to save {fname}: {e}")
+    if labeled is not None:
+        out_files["activity_labeled.csv"] = labeled
+    if distinct_rollup is not None:
+        out_files["active_users_approx.csv"] = distinct_rollup
+    with prof.stage(report, "save") as st:
+        save_outputs(out_files, output_dir, output_format=output_format, compression=compression, event_columns=event_columns)
+    write_profile(report, output_dir)
 
     print(">>> Demo finished.")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Demo runner for refactored telemetry modules")
-    parser.add_argument("--input", "-i", type=str, default="dataset_telemetry.csv", help="Path to telemetry CSV")
+    parser.add_argument("--input", "-i", type=str, default="dataset_telemetry.csv", help="Path to telemetry CSV, a directory or a glob of CSV shards")
     parser.add_argument("--output", "-o", type=str, default="./output", help="Output directory")
+    parser.add_argument("--chunksize", type=int, default=None, help="Read CSV in chunks of N rows")
+    parser.add_argument("--memory-budget-mb", type=float, default=None, help="Read CSV in chunks sized to this memory budget (MB)")
+    parser.add_argument("--compact", action="store_true", help="Use compact dtypes (categoricals, narrow ids, datetime64 date)")
+    parser.add_argument("--cache-dir", type=str, default=None, help="Directory for the parquet cache of cleaned events")
+    parser.add_argument("--session-gap", type=str, default=None, help="Rebuild sessions by inactivity gap, e.g. 30min")
+    parser.add_argument("--max-session-duration", type=str, default=None, help="Split sessions longer than this, e.g. 12h")
+    parser.add_argument("--workers", type=int, default=None, help="Processes for reading CSV shards and running metric stages (default: all cores, 1: sequential)")
+    parser.add_argument("--state-dir", type=str, default=None, help="Incremental mode: append input events to aggregates kept in this directory")
+    parser.add_argument("--label-events", action="store_true", help="Also write activity_labeled.csv with segments joined to every event")
+    parser.add_argument("--approx-distinct", action="store_true", help="Estimate daily distinct users / sessions / buyers with HyperLogLog sketches")
+    parser.add_argument("--profile", action="store_true", help="Write per-stage profile (profile.json / profile.csv) to the output directory")
+    parser.add_argument("--profile-alloc", action="store_true", help="Profile with peak allocated memory per stage (tracemalloc; slows Python-heavy stages)")
+    parser.add_argument("--hll-precision", type=int, default=ds.DEFAULT_PRECISION, help="HyperLogLog precision: 2**p registers, error ~1.04/sqrt(2**p)")
+    parser.add_argument("--format", type=str, default="csv", choices=ow.OUTPUT_FORMATS, help="Format of output tables")
+    parser.add_argument("--compression", type=str, default=None, help="Output compression (default: none for csv, zstd for parquet / feather)")
+    parser.add_argument("--event-columns", type=str, default=None, help="Comma-separated columns to write in event-level outputs (cleaned_events, activity_labeled)")
+    parser.add_argument("--columns", type=str, default=None, help="Comma-separated input columns to load (userid, sessionid, timestamp, action are always loaded)")
+    parser.add_argument("--since", type=str, default=None, help="Load only events at or after this time, e.g. 2024-03-01; sessions and their durations are computed from the loaded window only (same with and without --cache-dir)")
+    parser.add_argument("--until", type=str, default=None, help="Load only events up to this time; a date includes the whole day")
+    parser.add_argument("--sorted-input", action="store_true", help="Input files are sorted by timestamp: read only the --since/--until part of each file")
     args = parser.parse_args()
 
-    main(input_path=args.input, output_dir=args.output)
+    main(
+        input_path=args.input,
+        output_dir=args.output,
+        chunksize=args.chunksize,
+        memory_budget_mb=args.memory_budget_mb,
+        compact=args.compact,
+        cache_dir=args.cache_dir,
+        session_gap=args.session_gap,
+        max_session_duration=args.max_session_duration,
+        workers=args.workers,
+        state_dir=args.state_dir,
+        label_events=args.label_events,
+        approx_distinct=args.approx_distinct,
+        hll_precision=args.hll_precision,
+        profile=args.profile,
+        profile_alloc=args.profile_alloc,
+        output_format=args.format,
+        compression=args.compression,
+        event_columns=args.event_columns.split(",") if args.event_columns else None,
+        columns=args.columns.split(",") if args.columns else None,
+        since=args.since,
+        until=args.until,
+        sorted_input=args.sorted_input,
+    )
@@ -1,11 +1,16 @@
 """
 metrics.py
 
-Воронки (funnel), KPI, Sankey-переходы и дневные конверсии.
+Воронки (funnel), KPI, Sankey-переходы, дневные конверсии и UX-метрики сессий.
 """
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Union
+import numpy as np
 import pandas as pd
 
+import data_cleaning as dc
+import distinct_sketches as ds
+import quantile_sketches as qs
+
 
 def safe_divide(numerator: float, denominator: float) -> Optional[float]:
     """
@@ -20,6 +25,167 @@ def safe_divide(numerator: float, denominator: float) -> Optional[float]:
     return float(numerator) / d
 
 
+def funnel_depth(
+    session_codes: np.ndarray,
+    action_codes: np.ndarray,
+    step_codes: List[int],
+    n_sessions: int,
+    initial_depth: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """
+    Для каждой сессии возвращает число шагов воронки, пройденных по порядку
+    (жадный поиск подпоследовательности, как list.index(step, pos)).
+
+    session_codes — коды сессий 0..n_sessions-1, строки отсортированы по (сессия, время);
+    action_codes — код action для каждой строки (-1 если action не шаг воронки);
+    step_codes — код action для каждого шага воронки по порядку;
+    initial_depth — уже пройденная глубина сессий (продолжение воронки по новым событиям,
+    жадный поиск — автомат, его состояние — одна глубина).
+
+    Цикл идёт по шагам, а не по сессиям: на шаге j для сессий с глубиной j
+    ищется первое вхождение шага правее позиции предыдущего шага.
+    """
+    if initial_depth is None:
+        depth = np.zeros(n_sessions, dtype=np.int64)
+    else:
+        depth = np.asarray(initial_depth, dtype=np.int64).copy()
+    pos = np.full(n_sessions, -1, dtype=np.int64)
+    for j, code in enumerate(step_codes):
+        cand = np.flatnonzero(action_codes == code)
+        sess = session_codes[cand]
+        keep = (depth[sess] == j) & (cand > pos[sess])
+        cand, sess = cand[keep], sess[keep]
+        if len(cand) == 0:
+            if not (depth > j).any():
+                break
+            continue
+        # строки отсортированы по сессии и времени -> первое вхождение сессии = первый подходящий шаг
+        hit_sessions, first_idx = np.unique(sess, return_index=True)
+        pos[hit_sessions] = cand[first_idx]
+        depth[hit_sessions] = j + 1
+    return depth
+
+
+def _lower_bound(values: np.ndarray, lo: np.ndarray, hi: np.ndarray, threshold: np.ndarray) -> np.ndarray:
+    """
+    Векторный бинарный поиск: для каждого i — первый индекс k в [lo[i], hi[i])
+    с values[k] >= threshold[i] (hi[i], если такого нет); values на [lo, hi) не убывает.
+    """
+    lo, hi = lo.copy(), hi.copy()
+    while True:
+        active = lo < hi
+        if not active.any():
+            return lo
+        mid = (lo + hi) // 2
+        right = active & (values[np.minimum(mid, len(values) - 1)] < threshold)
+        lo = np.where(right, mid + 1, lo)
+        hi = np.where(active & ~right, mid, hi)
+
+
+def _range_max(values: np.ndarray, lo: np.ndarray, hi: np.ndarray, empty) -> np.ndarray:
+    """
+    max(values[lo[i]:hi[i]]) для каждого i (empty для пустых отрезков) по разреженной таблице:
+    уровень l хранит максимумы отрезков длины 2^l, отрезок запроса — объединение двух таких.
+    """
+    out = np.full(len(lo), empty, dtype=values.dtype)
+    length = hi - lo
+    has = length > 0
+    if not has.any():
+        return out
+    level = np.zeros(len(lo), dtype=np.int64)
+    level[has] = np.floor(np.log2(length[has])).astype(np.int64)
+    table = [values]
+    for l in range(1, int(level.max()) + 1):
+        half = 1 << (l - 1)
+        table.append(np.maximum(table[-1][:-half], table[-1][half:]))
+    for l in np.unique(level[has]):
+        sel = has & (level == l)
+        out[sel] = np.maximum(table[l][lo[sel]], table[l][hi[sel] - (1 << l)])
+    return out
+
+
+def windowed_funnel_depth(
+    entity_codes: np.ndarray,
+    action_codes: np.ndarray,
+    ts: np.ndarray,
+    step_codes: List[int],
+    n_entities: int,
+    step_gaps: Optional[List[Optional[np.timedelta64]]] = None,
+    window: Optional[np.timedelta64] = None
+) -> np.ndarray:
+    """
+    Глубина воронки с ограничениями по времени для каждой сущности (сессии или пользователя).
+
+    entity_codes / action_codes — как session_codes / action_codes в funnel_depth,
+    строки отсортированы по (сущность, время); ts — datetime64 время строк;
+    step_gaps[j] — максимум времени от шага j-1 до шага j (None — без ограничения);
+    window — максимум времени от первого шага до текущего.
+
+    Сущность проходит j+1 шагов, если у неё есть события шагов 0..j по порядку, в которых
+    каждый переход укладывается в step_gaps, а последний шаг — в window от первого.
+    Поиск идёт по шагам: для каждого события шага j хранится самый поздний старт цепочки,
+    доходящей до него (поздний старт оставляет больше окна, а ограничение перехода зависит
+    только от времени самого события). Событие шага j+1 достижимо из событий шага j той же
+    сущности левее него и не раньше чем за step_gaps[j+1]; его старт — максимум их стартов
+    (бинарный поиск границы и максимум на отрезке по разреженной таблице), и он должен
+    укладываться в window. События с NaT во времени засчитываются только как первый шаг.
+    """
+    times = pd.DatetimeIndex(ts)
+    valid = ~times.isna()
+    t = times.as_unit("ns").asi8
+    window_ns = pd.Timedelta(window).value if window is not None else None
+    missing = np.iinfo(np.int64).min
+    depth = np.zeros(n_entities, dtype=np.int64)
+    # первая строка каждой сущности (строки отсортированы по сущности)
+    entity_first_row = np.searchsorted(entity_codes, np.arange(n_entities), side="left")
+
+    first_step = action_codes == step_codes[0]
+    depth[entity_codes[first_step]] = 1
+    reached_pos = np.flatnonzero(first_step & valid)
+    reached_start = t[reached_pos]
+    for j in range(1, len(step_codes)):
+        if len(reached_pos) == 0:
+            break
+        cand = np.flatnonzero((action_codes == step_codes[j]) & valid)
+        # достигнутые события шага j-1 той же сущности левее кандидата: reached_pos[lo:hi]
+        lo = np.searchsorted(reached_pos, entity_first_row[entity_codes[cand]], side="left")
+        hi = np.searchsorted(reached_pos, cand, side="left")
+        gap = step_gaps[j] if step_gaps is not None else None
+        if gap is not None:
+            # время на reached_pos[lo:hi] не убывает — одна сущность, строки по времени
+            lo = _lower_bound(t[reached_pos], lo, hi, t[cand] - pd.Timedelta(gap).value)
+        start = _range_max(reached_start, lo, hi, missing)
+        ok = start != missing
+        if window_ns is not None:
+            ok &= (t[cand] - start) <= window_ns
+        reached_pos, reached_start = cand[ok], start[ok]
+        depth[entity_codes[reached_pos]] = j + 1
+    return depth
+
+
+def funnel_table(depth: np.ndarray, session_users: pd.Series, steps: List[str]) -> pd.DataFrame:
+    """
+    Итоговая таблица воронки по глубине сессий: step, sessions_reached, unique_users_reached.
+    session_users — userid сессии (позиционно совпадает с depth).
+    """
+    if not (depth > 0).any():
+        return pd.DataFrame({"step": [], "sessions_reached": [], "unique_users_reached": []})
+    session_users = pd.Series(np.asarray(session_users, dtype=object))
+    rows = []
+    for step in dict.fromkeys(steps):
+        # повтор шага в steps: сессия считается достигшей его по первому вхождению
+        reached = depth > steps.index(step)
+        n_reached = int(reached.sum())
+        if n_reached == 0:
+            continue
+        rows.append({
+            "step": step,
+            "sessions_reached": n_reached,
+            "unique_users_reached": int(session_users[reached].nunique()),
+        })
+    return pd.DataFrame(rows)
+
+
 def compute_funnel(
     df: pd.DataFrame,
     steps: List[str],
@@ -35,135 +201,209 @@ def compute_funnel(
     Логика:
       для каждой сессии мы проверяем, встречаются ли шаги в заданном порядке (не обязательно подряд),
       и если да — считаем сессию как достигшую соответствующих шагов.
+
+    Реализация векторная: action кодируется целыми числами, глубина воронки
+    считается массивами по отсортированному фрейму (см. funnel_depth), без цикла по сессиям.
     """
     if session_col not in df.columns:
         raise ValueError(f"{session_col} not found in df")
-    df_local = df.copy()
-    if ts_col in df_local.columns and not pd.api.types.is_datetime64_any_dtype(df_local[ts_col]):
-        df_local[ts_col] = pd.to_datetime(df_local[ts_col], errors="coerce")
-    df_local = df_local.sort_values([session_col, ts_col])
+    cols = [c for c in dict.fromkeys([session_col, ts_col, "action", userid_col]) if c in df.columns]
+    df_local = df[cols]
+    # groupby отбрасывает сессии с NaN — повторяем это поведение
+    if df_local[session_col].isna().any():
+        df_local = df_local[df_local[session_col].notna()]
+    df_local = dc.sort_by_session(df_local, session_col=session_col, ts_col=ts_col)
+
+    # уникальные шаги в порядке первого появления; повторный шаг матчится по тому же коду
+    unique_steps = list(dict.fromkeys(steps))
+    session_codes, _ = pd.factorize(df_local[session_col], sort=True)
+    n_sessions = int(session_codes.max()) + 1 if len(session_codes) else 0
+    action_codes = encode_actions(df_local["action"], unique_steps)
+    step_codes = [unique_steps.index(s) for s in steps]
+
+    depth = funnel_depth(session_codes, action_codes, step_codes, n_sessions)
+
+    # пользователь сессии — userid первого события сессии
+    if userid_col in df_local.columns:
+        starts = np.flatnonzero(np.r_[True, session_codes[1:] != session_codes[:-1]])
+        session_users = pd.Series(df_local[userid_col].to_numpy()[starts])
+    else:
+        session_users = pd.Series([None] * n_sessions, dtype=object)
+    return funnel_table(depth, session_users, steps)
 
-    rows = []
-    # Для каждой сессии проверяем последовательность
-    for sid, sgrp in df_local.groupby(session_col):
-        actions = list(sgrp["action"])
-        user = sgrp[userid_col].iloc[0] if userid_col in sgrp.columns else None
-        pos = 0
-        reached = list()
-        for step in steps:
-            try:
-                i = actions.index(step, pos)
-                reached.append(step)
-                pos = i + 1
-            except ValueError:
-                break
-        for step in reached:
-            rows.append({"sessionid": sid, "userid": user, "step": step})
 
-    if not rows:
-        return pd.DataFrame({"step": [], "sessions_reached": [], "unique_users_reached": []})
+def compute_windowed_funnel(
+    df: pd.DataFrame,
+    steps: List[str],
+    max_step_gap: Union[None, str, pd.Timedelta, Dict[str, Union[str, pd.Timedelta]]] = None,
+    window: Union[None, str, pd.Timedelta] = None,
+    by: str = "session",
+    session_col: str = "sessionid",
+    userid_col: str = "userid",
+    ts_col: str = "timestamp"
+) -> pd.DataFrame:
+    """
+    Воронка с окнами конверсии, см. windowed_funnel_depth.
+
+    max_step_gap — максимум времени между соседними шагами: одно значение для всех
+    переходов или словарь {шаг: время от предыдущего шага}, например {"checkout": "30min"};
+    window — общее окно от первого шага, например "24h".
+    by="session" — цепочки внутри сессии, результат как у compute_funnel
+    (step, sessions_reached, unique_users_reached);
+    by="user" — цепочки по всем событиям пользователя через границы сессий,
+    результат step, users_reached.
+    Без max_step_gap и window by="session" совпадает с compute_funnel.
+    """
+    if by not in ("session", "user"):
+        raise ValueError("by must be 'session' or 'user'")
+    entity_col = session_col if by == "session" else userid_col
+    if entity_col not in df.columns:
+        raise ValueError(f"{entity_col} not found in df")
+    if isinstance(max_step_gap, dict):
+        unknown = set(max_step_gap) - set(steps[1:])
+        if unknown:
+            raise ValueError(f"max_step_gap has steps that are not in steps[1:]: {sorted(unknown)}")
+        step_gaps = [None] + [
+            pd.Timedelta(max_step_gap[s]).to_timedelta64() if s in max_step_gap else None for s in steps[1:]
+        ]
+    elif max_step_gap is not None:
+        step_gaps = [None] + [pd.Timedelta(max_step_gap).to_timedelta64()] * (len(steps) - 1)
+    else:
+        step_gaps = None
+    window = pd.Timedelta(window).to_timedelta64() if window is not None else None
+
+    cols = [c for c in dict.fromkeys([entity_col, ts_col, "action", userid_col]) if c in df.columns]
+    df_local = df[cols]
+    if df_local[entity_col].isna().any():
+        df_local = df_local[df_local[entity_col].notna()]
+    df_local = dc.sort_by_session(df_local, session_col=entity_col, ts_col=ts_col)
+
+    unique_steps = list(dict.fromkeys(steps))
+    entity_codes, _ = pd.factorize(df_local[entity_col], sort=True)
+    n_entities = int(entity_codes.max()) + 1 if len(entity_codes) else 0
+    action_codes = encode_actions(df_local["action"], unique_steps)
+    step_codes = [unique_steps.index(s) for s in steps]
+    ts = df_local[ts_col].to_numpy()
+
+    if step_gaps is None and window is None:
+        depth = funnel_depth(entity_codes, action_codes, step_codes, n_entities)
+    else:
+        depth = windowed_funnel_depth(entity_codes, action_codes, ts, step_codes, n_entities, step_gaps, window)
 
-    reached_df = pd.DataFrame(rows)
-    agg = (
-        reached_df.groupby("step")
-        .agg(sessions_reached=("sessionid", "nunique"), unique_users_reached=("userid", "nunique"))
-        .reset_index()
-    )
-    # сохранить порядок шагов
-    agg["step_number"] = agg["step"].apply(lambda s: steps.index(s) if s in steps else -1)
-    agg = agg.sort_values("step_number").drop(columns="step_number")
-    return agg
+    starts = np.flatnonzero(np.r_[True, entity_codes[1:] != entity_codes[:-1]]) if len(entity_codes) else np.zeros(0, dtype=np.int64)
+    if userid_col in df_local.columns:
+        entity_users = pd.Series(df_local[userid_col].to_numpy()[starts])
+    else:
+        entity_users = pd.Series([None] * n_entities, dtype=object)
+    table = funnel_table(depth, entity_users, steps)
+    if by == "user":
+        table = table[["step", "unique_users_reached"]].rename(columns={"unique_users_reached": "users_reached"})
+    return table
 
 
 def compute_kpis_by_date(
     df: pd.DataFrame,
     date_col: str = "date",
     orders_action: str = "checkout",
-    confirmation_col: Optional[str] = "confirmation"
+    confirmation_col: Optional[str] = "confirmation",
+    approx_distinct: bool = False,
+    precision: int = ds.DEFAULT_PRECISION,
+    sketches: Optional[Dict[str, dict]] = None
 ) -> pd.DataFrame:
+    """
+    Дневные KPI: date, orders_count, gmv, sessions_count, buyers_count, dau, aov.
+
+    Все показатели считаются одним groupby по дате: заказы и покупатели
+    размечаются построчными признаками, после чего sum/nunique считаются
+    за один проход по данным. aov = gmv / orders_count (NaN, если заказов нет).
 
-    df_local = df.copy()
+    Дата-колонка в виде datetime64 (компактная схема) группируется как есть,
+    в python date переводится только итоговая колонка date.
+
+    approx_distinct=True — sessions_count / buyers_count / dau оцениваются по дневным
+    HyperLogLog-скетчам (distinct_sketches, точность precision) вместо nunique.
+    Если передан словарь sketches, в него кладутся скетчи по ключам
+    "sessions_count", "buyers_count", "dau" для последующих объединений (WAU / MAU, диапазоны).
+    """
+    # берём только нужные колонки, без копии всего фрейма
+    cols = [c for c in (date_col, "timestamp", "action", "checkout_value", "sessionid", "userid", confirmation_col) if c and c in df.columns]
+    df_local = df[cols]
 
     if date_col in df_local.columns and pd.api.types.is_datetime64_any_dtype(df_local[date_col]):
-        df_local[date_col] = df_local[date_col].dt.date
+        df_local = df_local.assign(**{date_col: df_local[date_col].dt.normalize()})
     elif date_col not in df_local.columns and "timestamp" in df_local.columns:
-        df_local[date_col] = df_local["timestamp"].dt.date
+        df_local = df_local.assign(**{date_col: df_local["timestamp"].dt.normalize()})
 
     if confirmation_col and confirmation_col in df_local.columns:
         orders_mask = df_local[confirmation_col].astype(bool)
-        orders = (
-            df_local.loc[orders_mask]
-            .groupby(date_col)
-            .size()
-            .rename("orders_count")
+    else:
+        orders_mask = df_local["action"] == orders_action
+
+    df_local = df_local.assign(
+        _is_order=orders_mask.astype("int64"),
+        _buyer=df_local["userid"].where(orders_mask),
+    )
+
+    if approx_distinct:
+        kpis = (
+            df_local.groupby(date_col)
+            .agg(orders_count=("_is_order", "sum"), gmv=("checkout_value", "sum"))
             .reset_index()
         )
+        built = {
+            "sessions_count": ds.build_sketches(df_local, "sessionid", date_col, precision=precision),
+            "buyers_count": ds.build_sketches(df_local, "userid", date_col, precision=precision, mask=orders_mask),
+            "dau": ds.build_sketches(df_local, "userid", date_col, precision=precision),
+        }
+        for name, sketch in built.items():
+            est = ds.estimate(sketch).set_index(date_col)["estimate"]
+            kpis[name] = est.reindex(kpis[date_col]).fillna(0).round().astype("int64").to_numpy()
+        if sketches is not None:
+            sketches.update(built)
     else:
-        orders = (
+        kpis = (
             df_local.groupby(date_col)
-            .apply(lambda g: (g["action"] == orders_action).sum())
-            .rename("orders_count")
+            .agg(
+                orders_count=("_is_order", "sum"),
+                gmv=("checkout_value", "sum"),
+                sessions_count=("sessionid", "nunique"),
+                buyers_count=("_buyer", "nunique"),
+                dau=("userid", "nunique"),
+            )
             .reset_index()
         )
+    if pd.api.types.is_datetime64_any_dtype(kpis[date_col]):
+        kpis[date_col] = kpis[date_col].dt.date
 
-    gmv = (
-        df_local.groupby(date_col)["checkout_value"]
-        .sum()
-        .reset_index(name="gmv")
-    )
-
-    sessions = (
-        df_local.groupby(date_col)["sessionid"]
-        .nunique()
-        .reset_index(name="sessions_count")
-    )
-
-    if confirmation_col and confirmation_col in df_local.columns:
-        buyers_mask = df_local[confirmation_col].astype(bool)
-    else:
-        buyers_mask = df_local["action"] == orders_action
-
-    buyers = (
-        df_local.loc[buyers_mask]
-        .groupby(date_col)["userid"]
-        .nunique()
-        .reset_index(name="buyers_count")
-    )
-
-    dau = (
-        df_local.groupby(date_col)["userid"]
-        .nunique()
-        .reset_index(name="dau")
-    )
-
-    kpis = (
-        orders.merge(gmv, on=date_col, how="outer")
-        .merge(sessions, on=date_col, how="outer")
-        .merge(buyers, on=date_col, how="outer")
-        .merge(dau, on=date_col, how="outer")
-    )
-
-    kpis = kpis.fillna({
-        "orders_count": 0,
-        "gmv": 0,
-        "sessions_count": 0,
-        "buyers_count": 0,
-        "dau": 0,
-    })
-
-    kpis["aov"] = kpis.apply(lambda r: safe_divide(r["gmv"], r["orders_count"]), axis=1)
+    orders = kpis["orders_count"]
+    kpis["aov"] = (kpis["gmv"] / orders.where(orders > 0)).astype(float)
 
     return kpis
 
 
+def encode_actions(actions: pd.Series, keys: List[str]) -> np.ndarray:
+    """
+    Коды action: позиция в keys, -1 если action не из keys (или NaN).
+    Строки сопоставляются с keys только по уникальным значениям (категориям).
+    """
+    if isinstance(actions.dtype, pd.CategoricalDtype):
+        codes, uniques = actions.cat.codes.to_numpy(), actions.cat.categories
+    else:
+        codes, uniques = pd.factorize(actions)
+    if len(uniques) == 0:
+        return np.full(len(codes), -1, dtype=np.intp)
+    unique_codes = pd.Index(keys).get_indexer(uniques)
+    return np.where(codes >= 0, unique_codes[codes], -1)
+
 
 def compute_sankey_transitions(
     df: pd.DataFrame,
     step_map: Dict[str, int],
     session_col: str = "sessionid",
     ts_col: str = "timestamp",
-    require_step_increase: bool = True
-) -> pd.DataFrame:
+    require_step_increase: bool = True,
+    with_matrix: bool = False
+):
     """
     Считает переходы (action -> next_action) внутри сессий (только соседние события).
     Возвращает DataFrame columns=['action','next_action','users'] — число уникальных пользователей,
@@ -171,64 +411,336 @@ def compute_sankey_transitions(
 
     Если require_step_increase=True, то учитываются только переходы, где mapped(next) >= mapped(current),
     чтобы поддержать идею "продвижения по воронке". Можно выставить False, если нужны все переходы.
+
+    with_matrix=True — дополнительно вернуть плотную матрицу K x K (K = len(step_map)):
+    (sankey, matrix), см. sankey_transition_counts.
+    """
+    counts, matrix = sankey_transition_counts(
+        df, step_map, session_col=session_col, ts_col=ts_col, require_step_increase=require_step_increase
+    )
+    sankey = counts[["action", "next_action", "users"]]
+    if with_matrix:
+        return sankey, matrix
+    return sankey
+
+
+def sankey_transition_counts(
+    df: pd.DataFrame,
+    step_map: Dict[str, int],
+    session_col: str = "sessionid",
+    ts_col: str = "timestamp",
+    require_step_increase: bool = True,
+    matrix_values: str = "users"
+):
+    """
+    Переходы между соседними событиями сессии на целочисленных ключах.
+
+    action кодируется позицией в step_map (K значений), пара (from, to) — числом from * K + to;
+    число событий считается np.bincount по парам, уникальные пользователи —
+    bincount по уникальным ключам (пара, код пользователя). Промежуточные колонки
+    (next_action, шаги) в df не создаются.
+
+    Возвращает (counts, matrix):
+      counts — DataFrame ['action','next_action','events','users'], отсортирован по (action, next_action);
+      matrix — DataFrame K x K (index=action, columns=next_action в порядке step_map)
+               со значениями matrix_values ('users' или 'events').
     """
     if session_col not in df.columns:
         raise ValueError(f"{session_col} not found in df")
-    df_local = df.copy()
-    if ts_col in df_local.columns and not pd.api.types.is_datetime64_any_dtype(df_local[ts_col]):
-        df_local[ts_col] = pd.to_datetime(df_local[ts_col], errors="coerce")
-    df_local = df_local.sort_values([session_col, ts_col])
-    df_local["next_action"] = df_local.groupby(session_col)["action"].shift(-1)
-    df_local["current_step"] = df_local["action"].map(step_map)
-    df_local["next_step"] = df_local["next_action"].map(step_map)
-    # drop where mapping failed
-    df_local = df_local[df_local["next_step"].notna() & df_local["current_step"].notna()]
+    if matrix_values not in ("users", "events"):
+        raise ValueError("matrix_values must be 'users' or 'events'")
+    df_local = dc.sort_by_session(df[[session_col, ts_col, "action", "userid"]], session_col=session_col, ts_col=ts_col)
+
+    keys = list(step_map)
+    n_keys = len(keys)
+    step_values = np.array([step_map[k] for k in keys], dtype=float)
+    codes = encode_actions(df_local["action"], keys)
+
+    # соседние события одной сессии; события без сессии (код -1) не попадают
+    session_codes, _ = pd.factorize(df_local[session_col])
+    valid = (session_codes[1:] == session_codes[:-1]) & (session_codes[1:] >= 0)
+    src, dst = codes[:-1], codes[1:]
+    valid &= (src >= 0) & (dst >= 0)
     if require_step_increase:
-        df_local = df_local[df_local["next_step"] >= df_local["current_step"]]
-    sankey = df_local.groupby(["action", "next_action"])["userid"].nunique().reset_index(name="users")
-    sankey = sankey.sort_values(["action", "next_action"]).reset_index(drop=True)
-    return sankey
+        valid &= step_values[dst] >= step_values[src]
+
+    pair = src[valid].astype(np.int64) * n_keys + dst[valid]
+    events = np.bincount(pair, minlength=n_keys * n_keys)
+
+    user_codes, uniques = pd.factorize(df_local["userid"].to_numpy()[:-1][valid])
+    known = user_codes >= 0
+    n_users = max(len(uniques), 1)
+    user_keys = pair[known] * n_users + user_codes[known]
+    if n_keys * n_keys * n_users <= max(8 * len(user_keys), 1 << 24):
+        # битовая карта (пара, пользователь) дешевле хэширования ключей
+        seen = np.zeros(n_keys * n_keys * n_users, dtype=bool)
+        seen[user_keys] = True
+        users = seen.reshape(n_keys * n_keys, n_users).sum(axis=1)
+    else:
+        users = np.bincount(np.unique(user_keys) // n_users, minlength=n_keys * n_keys)
+
+    present = np.flatnonzero(events)
+    action = np.asarray(keys, dtype=object)
+    counts = pd.DataFrame({
+        "action": action[present // n_keys],
+        "next_action": action[present % n_keys],
+        "events": events[present],
+        "users": users[present],
+    })
+    if isinstance(df_local["action"].dtype, pd.CategoricalDtype):
+        counts["action"] = counts["action"].astype(df_local["action"].dtype)
+        counts["next_action"] = counts["next_action"].astype(df_local["action"].dtype)
+    counts = counts.sort_values(["action", "next_action"]).reset_index(drop=True)
+
+    values = users if matrix_values == "users" else events
+    matrix = pd.DataFrame(values.reshape(n_keys, n_keys), index=pd.Index(keys, name="action"), columns=pd.Index(keys, name="next_action"))
+    return counts, matrix
+
+
+def _path_chunks(
+    session_codes: np.ndarray,
+    action_codes: np.ndarray,
+    start_mask: np.ndarray,
+    length: int,
+    base: int,
+    chunk_rows: int,
+    group_codes: Optional[np.ndarray] = None
+):
+    """
+    По кускам из целых сессий (не меньше chunk_rows строк) выдаёт
+    (lo, positions, path_codes): позиции начала n-грамм в куске и их коды.
+    group_codes — куски режутся только там, где меняется группа (по умолчанию сессия).
 
+    Код пути — полиномиальный хэш a0 * base^(n-1) + ... + a(n-1), считается
+    скользящим окном по массиву (умножение на base и сдвиг на одну позицию),
+    и без коллизий однозначно декодируется обратно в действия.
+    """
+    n = len(session_codes)
+    if group_codes is None:
+        group_codes = session_codes
+    boundaries = np.flatnonzero(group_codes[1:] != group_codes[:-1]) + 1
+    lo = 0
+    while lo < n:
+        cut = np.searchsorted(boundaries, lo + chunk_rows)
+        hi = int(boundaries[cut]) if cut < len(boundaries) else n
+        m = hi - lo - length + 1
+        if m > 0:
+            sess = session_codes[lo:hi]
+            acts = action_codes[lo:hi]
+            valid = start_mask[lo:lo + m] & (sess[:m] >= 0)
+            code = np.zeros(m, dtype=np.int64)
+            for j in range(length):
+                window = acts[j:j + m]
+                valid &= (window >= 0) & (sess[j:j + m] == sess[:m])
+                code = code * base + window
+            positions = np.flatnonzero(valid)
+            yield lo, positions, code[positions]
+        lo = hi
+
+
+def _count_distinct_pairs(keys: np.ndarray, groups: np.ndarray):
+    """
+    Для каждого ключа — число различных groups (например, сессий), где он встретился.
+    Сортировкой, а не хэшированием: np.unique на int64 ключах заметно медленнее.
+    Возвращает (отсортированные уникальные ключи, счётчики).
+    """
+    if len(keys) == 0:
+        return keys, np.empty(0, dtype=np.int64)
+    order = np.argsort(keys, kind="stable")
+    keys, groups = keys[order], groups[order]
+    new_key = np.r_[True, keys[1:] != keys[:-1]]
+    new_pair = new_key | np.r_[True, groups[1:] != groups[:-1]]
+    key_starts = np.flatnonzero(new_key)
+    return keys[key_starts], np.add.reduceat(new_pair.astype(np.int64), key_starts)
 
-def compute_conversion_daily(
+
+def _merge_heavy_hitters(keys: np.ndarray, counts: np.ndarray, capacity: int):
+    """
+    Слияние сводок Misra-Gries: суммирует счётчики одинаковых ключей и, если ключей
+    больше capacity, вычитает (capacity+1)-й по величине счётчик, оставляя положительные.
+    Любой ключ с частотой больше total / (capacity + 1) гарантированно остаётся в сводке.
+    """
+    if len(keys) == 0:
+        return keys, counts
+    order = np.argsort(keys, kind="stable")
+    keys, counts = keys[order], counts[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    keys, counts = keys[starts], np.add.reduceat(counts, starts)
+    if len(keys) > capacity:
+        threshold = np.partition(counts, len(counts) - capacity - 1)[len(counts) - capacity - 1]
+        keep = counts > threshold
+        keys, counts = keys[keep], counts[keep] - threshold
+    return keys, counts
+
+
+def compute_top_paths(
     df: pd.DataFrame,
-    steps: List[str],
-    date_col: str = "date",
-    ts_col: str = "timestamp"
+    length: int = 3,
+    start_actions: Optional[List[str]] = ("search", "mainpage"),
+    top_k: int = 20,
+    collapse_repeats: bool = False,
+    session_col: str = "sessionid",
+    userid_col: str = "userid",
+    ts_col: str = "timestamp",
+    candidates: Optional[int] = None,
+    chunk_rows: int = 1_000_000
 ) -> pd.DataFrame:
+    """
+    Топ-K путей из length подряд идущих действий внутри сессии (n-граммы action),
+    начинающихся с одного из start_actions (None — с любого действия).
 
-    df_local = df.copy()
-    df_local[ts_col] = pd.to_datetime(df_local[ts_col])
-    df_local[date_col] = df_local[ts_col].dt.date
-
-    df_f = df_local[df_local["action"].isin(steps)].copy()
+    Возвращает DataFrame columns=['path','sessions','users'], path — действия через ' > ',
+    sessions — число сессий, где путь встретился, users — уникальных userid среди них;
+    сортировка по sessions, users (по убыванию), затем по path.
 
-    first_step = steps[0]
+    collapse_repeats=True — подряд идущие одинаковые действия сессии схлопываются в одно
+    (search, search, product -> search, product).
 
-    df_first = df_f[df_f["action"] == first_step].copy()
-    df_first = df_first.sort_values(ts_col)
+    Память на подсчёт ограничена K, а не числом различных путей: первый проход по кускам
+    сессий держит сводку Misra-Gries на candidates ключей (по умолчанию max(10 * top_k, 1000)),
+    второй проход точно считает sessions и users только для этих кандидатов.
+    Пути, встречающиеся больше чем в 1 / (candidates + 1) доле сессий, в кандидаты попадают всегда.
+    """
+    if session_col not in df.columns:
+        raise ValueError(f"{session_col} not found in df")
+    if length < 1:
+        raise ValueError("length must be >= 1")
+    candidates = max(candidates or max(10 * top_k, 1000), top_k)
+    cols = [c for c in dict.fromkeys([session_col, ts_col, "action", userid_col]) if c in df.columns]
+    df_local = dc.sort_by_session(df[cols], session_col=session_col, ts_col=ts_col)
+
+    session_codes, _ = pd.factorize(df_local[session_col])
+    action_codes, actions = pd.factorize(df_local["action"])
+    if userid_col in df_local.columns:
+        user_codes, users = pd.factorize(df_local[userid_col])
+    else:
+        user_codes, users = np.full(len(df_local), -1, dtype=np.intp), []
+    if collapse_repeats and len(action_codes):
+        keep = np.r_[True, (action_codes[1:] != action_codes[:-1]) | (session_codes[1:] != session_codes[:-1])]
+        session_codes, action_codes, user_codes = session_codes[keep], action_codes[keep], user_codes[keep]
+    # сессии одного пользователя (по первому событию сессии) ставятся подряд, чтобы
+    # во втором проходе пары (путь, пользователь) дедуплицировались внутри куска
+    starts = np.flatnonzero(np.r_[len(session_codes) > 0, session_codes[1:] != session_codes[:-1]])
+    owner = np.repeat(user_codes[starts], np.diff(np.r_[starts, len(session_codes)]))
+    order = np.argsort(owner, kind="stable")
+    session_codes, action_codes, user_codes, owner = session_codes[order], action_codes[order], user_codes[order], owner[order]
+
+    base = max(len(actions), 1)
+    if base ** length >= 2 ** 63:
+        raise ValueError(f"{base} distinct actions ^ length {length} does not fit into int64 path codes")
+    if start_actions is None:
+        start_mask = action_codes >= 0
+    else:
+        start_mask = np.isin(action_codes, pd.Index(actions).get_indexer(list(start_actions)))
+    n_sessions = int(session_codes.max()) + 1 if len(session_codes) else 1
+
+    # 1) кандидаты: сессии на путь в каждом куске (сессии не пересекают куски) -> сводка Misra-Gries
+    keys = np.empty(0, dtype=np.int64)
+    counts = np.empty(0, dtype=np.int64)
+    for lo, positions, codes in _path_chunks(session_codes, action_codes, start_mask, length, base, chunk_rows):
+        # сессии в куске упорядочены, поэтому стабильная сортировка по пути ставит пары (путь, сессия) рядом
+        chunk_keys, chunk_counts = _count_distinct_pairs(codes, session_codes[lo + positions])
+        keys, counts = _merge_heavy_hitters(np.r_[keys, chunk_keys], np.r_[counts, chunk_counts], candidates)
+
+    # 2) точные sessions / users для кандидатов
+    # куски режутся по границам владельцев: все события пользователя в своих сессиях
+    # попадают в один кусок, и его пары (кандидат, пользователь) считаются сразу;
+    # пользователи, встречающиеся и в чужих сессиях, копятся отдельно до конца прохода
+    n_users = max(len(users), 1)
+    shared = np.zeros(n_users, dtype=bool)
+    shared[user_codes[(user_codes >= 0) & (user_codes != owner)]] = True
+    sessions_reached = np.zeros(len(keys), dtype=np.int64)
+    users_reached = np.zeros(len(keys), dtype=np.int64)
+    shared_keys = np.empty(0, dtype=np.int64)
+    chunks = _path_chunks(session_codes, action_codes, start_mask, length, base, chunk_rows, group_codes=owner)
+    for lo, positions, codes in chunks:
+        idx = np.minimum(np.searchsorted(keys, codes), max(len(keys) - 1, 0))
+        hit = keys[idx] == codes if len(keys) else np.zeros(len(codes), dtype=bool)
+        idx, rows = idx[hit], lo + positions[hit]
+        hit_keys, hit_sessions = _count_distinct_pairs(idx, session_codes[rows])
+        sessions_reached[hit_keys] += hit_sessions
+        row_users = user_codes[rows]
+        known = row_users >= 0
+        pair_keys = idx[known].astype(np.int64) * n_users + row_users[known]
+        local = ~shared[row_users[known]]
+        users_reached += np.bincount(np.unique(pair_keys[local]) // n_users, minlength=len(keys))
+        shared_keys = np.unique(np.r_[shared_keys, pair_keys[~local]])
+    users_reached += np.bincount(shared_keys // n_users, minlength=len(keys))
+
+    # декодирование кода пути обратно в действия
+    digits = keys[:, None] // base ** np.arange(length - 1, -1, -1) % base
+    names = np.asarray(actions, dtype=object)
+    paths = pd.DataFrame({
+        "path": [" > ".join(names[row]) for row in digits],
+        "sessions": sessions_reached,
+        "users": users_reached,
+    })
+    paths = paths.sort_values(["sessions", "users", "path"], ascending=[False, False, True])
+    return paths.head(top_k).reset_index(drop=True)
 
-    # timestamp + cohort date
-    first_ts = df_first.groupby("userid")[ts_col].first().reset_index()
-    first_day = df_first.groupby("userid")[date_col].first().reset_index()
 
-    cohort = (
-        first_ts.merge(first_day, on="userid")
-        .rename(columns={
-            ts_col: "first_ts",
-            date_col: "cohort_date"     # <-- Исправлено
-        })
-    )
+def compute_conversion_daily(
+    df: pd.DataFrame,
+    steps: List[str],
+    date_col: str = "date",
+    ts_col: str = "timestamp",
+    window: Union[None, str, pd.Timedelta] = None
+) -> pd.DataFrame:
+    """
+    Дневные конверсии по когортам первого шага (см. conversion_table).
+    window — учитывать только шаги не позже window от первого шага пользователя (например "24h").
+
+    Когорта пользователя — день его первого события steps[0]. Время первого шага
+    считается группировкой по коду пользователя и раздаётся событиям через take,
+    без merge событий с таблицей когорт; затем тройки (день когорты, шаг, пользователь)
+    дедуплицируются на целочисленных ключах. date_col не используется: день
+    считается из ts_col (параметр оставлен для совместимости).
+    """
+    ts = df[ts_col]
+    if not pd.api.types.is_datetime64_any_dtype(ts):
+        ts = dc.normalize_timestamps(ts)[0]
+    unique_steps = list(dict.fromkeys(steps))
+    step_codes = encode_actions(df["action"], unique_steps)
+    in_steps = step_codes >= 0
+    step_codes = step_codes[in_steps]
+    ts = ts[in_steps].array
+
+    # groupby отбрасывает пользователей с NaN — у них нет когорты
+    user_codes, users = pd.factorize(df["userid"][in_steps])
+    first_step_ts = pd.Series(ts).where(step_codes == 0)
+    first_ts = first_step_ts.groupby(user_codes).min().reindex(range(len(users)))
+    first_ts = first_ts.array.take(np.maximum(user_codes, 0))
+
+    # только события не раньше первого шага (NaT в сравнении -> False)
+    keep = (user_codes >= 0) & np.asarray(ts >= first_ts)
+    if window is not None:
+        keep &= np.asarray((ts - first_ts) <= pd.Timedelta(window))
+    day_codes, days = pd.factorize(first_ts[keep].normalize())
+
+    # уникальные тройки (день когорты, шаг, пользователь) одним int64-ключом
+    n_steps, n_users = len(unique_steps), max(len(users), 1)
+    key = (day_codes.astype(np.int64) * n_steps + step_codes[keep]) * n_users + user_codes[keep]
+    key = np.sort(key)
+    key = key[np.r_[True, key[1:] != key[:-1]]] if len(key) else key
+    reached = pd.DataFrame({
+        "cohort_date": days.take(key // n_users // n_steps),
+        "action": np.asarray(unique_steps, dtype=object)[key // n_users % n_steps],
+        "userid": key % n_users,
+    })
+    return conversion_table(reached, steps)
 
-    # merge all events of cohort users
-    df_join = df_f.merge(cohort, on="userid")
 
-    # keep only events after first step
-    df_join = df_join[df_join[ts_col] >= df_join["first_ts"]]
+def conversion_table(reached: pd.DataFrame, steps: List[str]) -> pd.DataFrame:
+    """
+    Итоговая таблица дневных конверсий: cohort_date, шаги (уникальные пользователи), cr_*.
+    reached — события шагов (cohort_date как datetime64, action, userid)
+    пользователей не раньше их первого шага.
+    """
+    first_step = steps[0]
 
     # true conversion: by cohort_date
     res = (
-        df_join.groupby(["cohort_date", "action"])["userid"]
+        reached.groupby(["cohort_date", "action"], observed=True)["userid"]
         .nunique()
         .unstack(fill_value=0)
     )
@@ -239,11 +751,67 @@ def compute_conversion_daily(
             res[s] = 0
 
     res = res[steps].reset_index()
+    res["cohort_date"] = res["cohort_date"].dt.date
 
-    # ratios
+    # ratios; шаг без пользователей в знаменателе -> NaN, а не inf
     for a, b in zip(steps[:-1], steps[1:]):
-        res[f"cr_{a}_to_{b}"] = res[b] / res[a]
+        res[f"cr_{a}_to_{b}"] = res[b] / res[a].where(res[a] > 0)
 
-    res["cr_full"] = res[steps[-1]] / res[first_step]
+    res["cr_full"] = res[steps[-1]] / res[first_step].where(res[first_step] > 0)
 
     return res
+
+
+
+def build_ux_sketches(
+    sessions: pd.DataFrame,
+    value_cols: List[str] = ("session_duration", "events_count"),
+    date_col: str = "date",
+    start_col: str = "session_start",
+    segment_col: Optional[str] = None,
+    relative_accuracy: float = qs.DEFAULT_RELATIVE_ACCURACY
+) -> Dict[str, dict]:
+    """
+    Скетчи квантилей (quantile_sketches) по каждой колонке value_cols таблицы сессий
+    (compute_session_aggregates) по дням и, если задан segment_col, по сегментам.
+    Дата сессии — date_col, если колонка есть, иначе день start_col.
+
+    Дневные / сегментные скетчи сливаются в любой диапазон дат (ux_metrics_table,
+    quantile_sketches.range_summary) без повторного прохода по сессиям.
+    """
+    keys = [date_col] + ([segment_col] if segment_col else [])
+    cols = [c for c in list(value_cols) + keys if c in sessions.columns]
+    local = sessions[cols]
+    if date_col not in local.columns:
+        local = local.assign(**{date_col: sessions[start_col].dt.normalize()})
+    return {
+        col: qs.build_quantile_sketches(local, col, keys, relative_accuracy=relative_accuracy)
+        for col in value_cols
+    }
+
+
+def ux_metrics_table(
+    sketches: Dict[str, dict],
+    keys: Optional[List[str]] = None,
+    quantiles: List[float] = (0.5, 0.95, 0.99)
+) -> pd.DataFrame:
+    """
+    UX-таблица из скетчей build_ux_sketches: ключи, sessions_count и по каждой метрике
+    {метрика}_mean, {метрика}_p50, {метрика}_p95, {метрика}_p99.
+    keys — колонки, по которым сливаются скетчи (например, ["date"] из скетчей по
+    дате и сегменту); None — исходные ключи скетчей.
+    """
+    result = None
+    for col, sketch in sketches.items():
+        if keys is not None:
+            sketch = qs.union_quantile_sketches(sketch, keys)
+        table = qs.summarize(sketch, quantiles, prefix=f"{col}_")
+        if result is None:
+            result = table.rename(columns={f"{col}_count": "sessions_count"})
+        else:
+            result = pd.concat([result, table.drop(columns=list(sketch["keys"].columns) + [f"{col}_count"])], axis=1)
+    if result is not None:
+        for col in result.columns:
+            if pd.api.types.is_datetime64_any_dtype(result[col]):
+                result[col] = result[col].dt.date
+    return result
@@ -0,0 +1,160 @@
+"""
+output_writers.py
+
+Запись результатов main.py в CSV, Parquet или Feather.
+
+Файлы пишутся одновременно в пуле потоков: кодирование и сжатие Parquet /
+Feather выполняются в pyarrow без GIL, а запись на диск — ввод-вывод
+(форматирование CSV держит GIL, для CSV пул почти не ускоряет запись). Таблица
+пишется кусками по chunk_rows строк (группы строк Parquet, батчи Feather, куски
+CSV), поэтому копия в формате arrow / текст никогда не держится в памяти
+целиком — это важно для событийных выходов (cleaned_events, activity_labeled),
+где строк столько же, сколько событий.
+
+Каждый файл пишется во временный и переименовывается, чтобы прерванный запуск
+не оставил наполовину записанный результат.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Sequence
+import pandas as pd
+
+
+OUTPUT_FORMATS = ("csv", "parquet", "feather")
+FORMAT_EXTENSIONS = {"csv": ".csv", "parquet": ".parquet", "feather": ".feather"}
+# сжатие по умолчанию: CSV — без сжатия (как раньше), колоночные форматы — zstd
+DEFAULT_COMPRESSION = {"csv": None, "parquet": "zstd", "feather": "zstd"}
+CSV_COMPRESSION_SUFFIXES = {"gzip": ".gz", "bz2": ".bz2", "zstd": ".zst", "xz": ".xz"}
+# строк в куске: группа строк Parquet / батч Feather; кусок CSV форматируется в python-строки
+# (~1 КБ памяти на строку события), поэтому он меньше
+DEFAULT_CHUNK_ROWS = {"csv": 100_000, "parquet": 1_000_000, "feather": 1_000_000}
+
+
+def output_name(name: str, fmt: str = "csv", compression: Optional[str] = None) -> str:
+    """
+    Имя файла результата в формате fmt: расширение name заменяется на расширение
+    формата (events.csv -> events.parquet); у сжатого CSV добавляется суффикс (.gz, ...).
+    """
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f"fmt must be one of {OUTPUT_FORMATS}")
+    name = os.path.splitext(name)[0] + FORMAT_EXTENSIONS[fmt]
+    if fmt == "csv" and compression:
+        name += CSV_COMPRESSION_SUFFIXES.get(compression, "")
+    return name
+
+
+def _chunks(df: pd.DataFrame, chunk_rows: int):
+    for start in range(0, max(len(df), 1), chunk_rows):
+        yield df.iloc[start:start + chunk_rows]
+
+
+def _write_csv(df: pd.DataFrame, path: str, compression: Optional[str], chunk_rows: int) -> None:
+    df.to_csv(path, index=False, chunksize=chunk_rows, compression=compression)
+
+
+def _write_parquet(df: pd.DataFrame, path: str, compression: Optional[str], chunk_rows: int) -> None:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # схема по всему фрейму: в отдельном куске object-колонка может оказаться целиком из None
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    with pq.ParquetWriter(path, schema, compression=compression or "none") as writer:
+        for chunk in _chunks(df, chunk_rows):
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False), row_group_size=chunk_rows)
+
+
+def _write_feather(df: pd.DataFrame, path: str, compression: Optional[str], chunk_rows: int) -> None:
+    import pyarrow as pa
+
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    options = pa.ipc.IpcWriteOptions(compression=compression)
+    # Feather v2 — файл формата Arrow IPC, читается pd.read_feather
+    with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, schema, options=options) as writer:
+        for chunk in _chunks(df, chunk_rows):
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False), max_chunksize=chunk_rows)
+
+
+_WRITERS = {"csv": _write_csv, "parquet": _write_parquet, "feather": _write_feather}
+
+
+def write_table(
+    df: pd.DataFrame,
+    path: str,
+    fmt: str = "csv",
+    compression: Optional[str] = None,
+    columns: Optional[Sequence[str]] = None,
+    chunk_rows: Optional[int] = None
+) -> str:
+    """
+    Пишет df в path (атомарно, через временный файл) в формате fmt кусками по chunk_rows строк
+    (None — DEFAULT_CHUNK_ROWS формата).
+    columns — записать только эти колонки (отсутствующие в df пропускаются).
+    compression: для CSV — как в DataFrame.to_csv (None — без сжатия),
+    для Parquet — кодек pyarrow (zstd, snappy, gzip, ...), для Feather — zstd / lz4 / None.
+    """
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f"fmt must be one of {OUTPUT_FORMATS}")
+    chunk_rows = chunk_rows or DEFAULT_CHUNK_ROWS[fmt]
+    if chunk_rows < 1:
+        raise ValueError("chunk_rows must be positive")
+    if columns is not None:
+        df = df[[c for c in columns if c in df.columns]]
+    tmp_path = path + ".tmp"
+    try:
+        _WRITERS[fmt](df, tmp_path, compression, chunk_rows)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+    return path
+
+
+def _write_object(obj, path: str) -> str:
+    # не таблицы — текстом (как раньше в main.save_outputs)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(str(obj))
+    return path
+
+
+def save_outputs(
+    out_files: dict,
+    output_dir: str,
+    fmt: str = "csv",
+    compression: Optional[str] = None,
+    columns: Optional[Dict[str, Sequence[str]]] = None,
+    workers: Optional[int] = None,
+    chunk_rows: Optional[int] = None
+) -> Dict[str, str]:
+    """
+    Сохраняет результаты {имя файла: объект} в output_dir одновременно в пуле из workers
+    потоков (None — по числу файлов, не больше числа ядер + 4). DataFrame пишутся
+    в формате fmt (имя меняется через output_name), остальное — текстом под исходным именем.
+    compression=None — сжатие формата по умолчанию (DEFAULT_COMPRESSION);
+    columns — {исходное имя файла: колонки} для выборочной записи колонок.
+    Ошибка записи одного файла печатается и не мешает остальным.
+    Возвращает {исходное имя: путь записанного файла}.
+    """
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f"fmt must be one of {OUTPUT_FORMATS}")
+    compression = compression if compression is not None else DEFAULT_COMPRESSION[fmt]
+    columns = columns or {}
+    print(f">>> Saving outputs to {output_dir} ({fmt})")
+    workers = workers or min(len(out_files), (os.cpu_count() or 1) + 4) or 1
+    saved = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for fname, obj in out_files.items():
+            if isinstance(obj, pd.DataFrame):
+                path = os.path.join(output_dir, output_name(fname, fmt, compression))
+                futures[fname] = pool.submit(write_table, obj, path, fmt, compression, columns.get(fname), chunk_rows)
+            else:
+                futures[fname] = pool.submit(_write_object, obj, os.path.join(output_dir, fname))
+        # сообщения — в порядке out_files, а не завершения
+        for fname, future in futures.items():
+            try:
+                saved[fname] = future.result()
+                print(f"  saved {os.path.basename(saved[fname])}")
+            except Exception as e:
+                print(f"  failed to save {fname}: {e}")
+    return saved
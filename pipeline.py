@@ -0,0 +1,269 @@
+"""
+pipeline.py
+
+Выполнение этапов расчёта метрик как графа зависимостей.
+
+Этап — словарь (см. stage):
+  - name:    имя этапа, ключ результата
+  - func:    func(events, **результаты deps, **kwargs) -> результат
+  - deps:    этапы, результаты которых нужны func (передаются по имени этапа)
+  - columns: колонки событий, которые может читать func (отсутствующие во фрейме
+             пропускаются; None — все)
+  - kwargs:  остальные аргументы func
+
+Независимые этапы выполняются одновременно в пуле процессов. Колонки
+подготовленного фрейма событий один раз копируются в общую память
+(multiprocessing.shared_memory): процессы собирают из неё фрейм без pickling
+событий — числовые колонки и даты как представления общей памяти (только
+чтение), строковые и прочие — через целочисленные коды и словарь уникальных
+значений. func и её результат должны сериализоваться pickle.
+"""
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import shared_memory
+from typing import Callable, Dict, List, Optional, Sequence
+import numpy as np
+import pandas as pd
+
+import profiling as prof
+
+
+# блоки общей памяти, к которым уже подключился процесс-исполнитель (по имени блока)
+_ATTACHED: Dict[str, shared_memory.SharedMemory] = {}
+
+
+def stage(
+    name: str,
+    func: Callable,
+    deps: Sequence[str] = (),
+    columns: Optional[Sequence[str]] = None,
+    **kwargs
+) -> dict:
+    """
+    Описание этапа для run_pipeline.
+    """
+    return {"name": name, "func": func, "deps": list(deps), "columns": None if columns is None else list(columns), "kwargs": kwargs}
+
+
+def topological_order(stages: List[dict]) -> List[str]:
+    """
+    Имена этапов в порядке, где каждый этап идёт после своих зависимостей
+    (при прочих равных — в порядке объявления). ValueError при повторных именах,
+    неизвестных зависимостях и циклах.
+    """
+    names = [s["name"] for s in stages]
+    if len(set(names)) != len(names):
+        raise ValueError("stage names must be unique")
+    deps = {s["name"]: s["deps"] for s in stages}
+    unknown = {d for ds_ in deps.values() for d in ds_} - set(names)
+    if unknown:
+        raise ValueError(f"unknown stage dependencies: {sorted(unknown)}")
+    order, done = [], set()
+    while len(order) < len(names):
+        ready = [n for n in names if n not in done and all(d in done for d in deps[n])]
+        if not ready:
+            raise ValueError(f"dependency cycle between stages: {sorted(set(names) - done)}")
+        order.extend(ready)
+        done.update(ready)
+    return order
+
+
+def _share_array(values: np.ndarray, blocks: list) -> dict:
+    values = np.ascontiguousarray(values)
+    shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+    blocks.append(shm)
+    np.ndarray(values.shape, dtype=values.dtype, buffer=shm.buf)[...] = values
+    return {"shm": shm.name, "dtype": values.dtype.str, "shape": values.shape}
+
+
+def _narrow_codes(codes: np.ndarray, n_uniques: int) -> np.ndarray:
+    for dtype in (np.int8, np.int16, np.int32):
+        if n_uniques < np.iinfo(dtype).max:
+            return codes.astype(dtype)
+    return codes
+
+
+def _share_values(values: pd.Series, blocks: list) -> dict:
+    dtype = values.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        return {"kind": "categorical", "codes": _share_array(values.cat.codes.to_numpy(), blocks),
+                "categories": dtype.categories, "ordered": dtype.ordered}
+    if isinstance(dtype, pd.DatetimeTZDtype):
+        return {"kind": "datetimetz", "values": _share_array(values.dt.tz_convert("UTC").dt.tz_localize(None).to_numpy(), blocks),
+                "tz": dtype.tz}
+    if isinstance(dtype, np.dtype) and dtype.kind in "biufcmM":
+        return {"kind": "array", "values": _share_array(values.to_numpy(), blocks)}
+    # строки, object и nullable-типы: коды + уникальные значения в исходном типе
+    codes, uniques = pd.factorize(values)
+    uniques = pd.Index(uniques, dtype=uniques.dtype).array
+    missing = codes < 0
+    if pd.api.types.is_object_dtype(uniques.dtype) and missing.any():
+        # take заполняет пропуски NaN: пропуск object-колонки (None) кладётся отдельным значением
+        uniques = pd.array(np.r_[uniques.to_numpy(), values.to_numpy()[missing][:1]], dtype=object)
+        codes = np.where(missing, len(uniques) - 1, codes)
+    return {"kind": "factorized", "codes": _share_array(_narrow_codes(codes, len(uniques)), blocks), "uniques": uniques}
+
+
+def share_events(events: pd.DataFrame, columns: Optional[Sequence[str]] = None):
+    """
+    Копирует колонки events (все или columns) и индекс в общую память.
+    Возвращает (blocks, spec): blocks — созданные SharedMemory (закрыть и unlink
+    вызывающему, см. release_shared), spec — описание для events_from_shared.
+    """
+    columns = list(events.columns) if columns is None else list(columns)
+    blocks = []
+    try:
+        spec = {
+            "columns": {col: _share_values(events[col], blocks) for col in columns},
+            "order": columns,
+        }
+        index = events.index
+        if isinstance(index, pd.RangeIndex):
+            spec["index"] = {"kind": "range", "start": index.start, "stop": index.stop, "step": index.step, "name": index.name}
+        else:
+            spec["index"] = dict(_share_values(index.to_series(), blocks), name=index.name)
+    except BaseException:
+        release_shared(blocks)
+        raise
+    return blocks, spec
+
+
+def release_shared(blocks: list) -> None:
+    """
+    Закрывает и удаляет блоки общей памяти, созданные share_events.
+    """
+    for shm in blocks:
+        shm.close()
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _attached_array(desc: dict) -> np.ndarray:
+    shm = _ATTACHED.get(desc["shm"])
+    if shm is None:
+        # трекер ресурсов общий с родителем (пул — дочерние процессы), повторная регистрация
+        # блока ничего не меняет; удаляет блок только создатель (release_shared)
+        shm = shared_memory.SharedMemory(name=desc["shm"])
+        _ATTACHED[desc["shm"]] = shm
+    values = np.ndarray(desc["shape"], dtype=np.dtype(desc["dtype"]), buffer=shm.buf)
+    values.flags.writeable = False
+    return values
+
+
+def _restore_values(desc: dict):
+    kind = desc["kind"]
+    if kind == "array":
+        return _attached_array(desc["values"])
+    if kind == "categorical":
+        return pd.Categorical.from_codes(_attached_array(desc["codes"]), categories=desc["categories"], ordered=desc["ordered"])
+    if kind == "datetimetz":
+        return pd.DatetimeIndex(_attached_array(desc["values"])).tz_localize("UTC").tz_convert(desc["tz"]).array
+    return desc["uniques"].take(_attached_array(desc["codes"]).astype(np.intp), allow_fill=True)
+
+
+def events_from_shared(spec: dict, columns: Optional[Sequence[str]] = None) -> pd.DataFrame:
+    """
+    Фрейм событий из общей памяти (описание spec из share_events), только колонки columns.
+    """
+    columns = spec["order"] if columns is None else list(columns)
+    index_desc = spec["index"]
+    if index_desc["kind"] == "range":
+        index = pd.RangeIndex(index_desc["start"], index_desc["stop"], index_desc["step"], name=index_desc["name"])
+    else:
+        values = _restore_values(index_desc)
+        index = pd.Index(values, dtype=values.dtype, name=index_desc["name"])
+    # dtype задаётся явно: иначе pandas >= 3 выводит str для object-колонок со строками
+    return pd.DataFrame({
+        col: pd.Series(values, index=index, dtype=values.dtype, copy=False)
+        for col, values in ((col, _restore_values(spec["columns"][col])) for col in columns)
+    }, copy=False)
+
+
+def _project(events: pd.DataFrame, columns: Optional[List[str]]) -> pd.DataFrame:
+    return events if columns is None else events[columns]
+
+
+def _call_stage(func: Callable, events: pd.DataFrame, deps: dict, kwargs: dict, name: str, profile: bool):
+    # результат и замеры этапа: полный профиль (profiling.measure) или только wall время
+    if profile:
+        return prof.measure(func, events, stage_name=name, rows_in=len(events), **deps, **kwargs)
+    start = time.perf_counter()
+    result = func(events, **deps, **kwargs)
+    return result, {"stage": name, "wall_s": time.perf_counter() - start}
+
+
+def _run_shared_stage(func: Callable, spec: dict, columns: Optional[List[str]], deps: dict, kwargs: dict, name: str, profile: bool):
+    return _call_stage(func, events_from_shared(spec, columns), deps, kwargs, name, profile)
+
+
+def _record(stage_stats: dict, timings: Optional[dict], stats: Optional[dict]) -> None:
+    if timings is not None:
+        timings[stage_stats["stage"]] = stage_stats["wall_s"]
+    if stats is not None:
+        stats[stage_stats["stage"]] = stage_stats
+
+
+def run_pipeline(
+    stages: List[dict],
+    events: pd.DataFrame,
+    workers: Optional[int] = None,
+    timings: Optional[Dict[str, float]] = None,
+    stats: Optional[Dict[str, dict]] = None
+) -> dict:
+    """
+    Выполняет этапы и возвращает {имя этапа: результат}.
+
+    workers — число процессов (None — по числу ядер, 1 — последовательно в текущем
+    процессе, без пула и общей памяти). Этап запускается, как только готовы его
+    зависимости, поэтому время всего графа стремится к самому длинному пути,
+    а не к сумме этапов. timings, если передан, заполняется временем каждого этапа (с),
+    stats — полными замерами этапов (profiling.measure, в процессе, где этап выполнялся).
+    """
+    order = topological_order(stages)
+    by_name = {
+        s["name"]: dict(s, columns=None if s["columns"] is None else [c for c in s["columns"] if c in events.columns])
+        for s in stages
+    }
+    workers = workers or os.cpu_count() or 1
+    results = {}
+
+    if workers == 1 or len(stages) <= 1:
+        for name in order:
+            s = by_name[name]
+            results[name], stage_stats = _call_stage(
+                s["func"], _project(events, s["columns"]), {d: results[d] for d in s["deps"]}, s["kwargs"], name, stats is not None
+            )
+            _record(stage_stats, timings, stats)
+        return results
+
+    # в общую память — только колонки, которые читает хотя бы один этап
+    if any(s["columns"] is None for s in by_name.values()):
+        columns = None
+    else:
+        columns = list(dict.fromkeys(c for s in by_name.values() for c in s["columns"]))
+    blocks, spec = share_events(events, columns)
+    try:
+        with ProcessPoolExecutor(max_workers=min(workers, len(stages))) as pool:
+            running = {}
+            pending = list(order)
+            while pending or running:
+                ready = [n for n in pending if all(d in results for d in by_name[n]["deps"])]
+                for name in ready:
+                    s = by_name[name]
+                    future = pool.submit(
+                        _run_shared_stage, s["func"], spec, s["columns"], {d: results[d] for d in s["deps"]}, s["kwargs"],
+                        name, stats is not None
+                    )
+                    running[future] = name
+                    pending.remove(name)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    results[name], stage_stats = future.result()
+                    _record(stage_stats, timings, stats)
+    finally:
+        release_shared(blocks)
+    return {name: results[name] for name in order}
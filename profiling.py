@@ -0,0 +1,239 @@
+"""
+profiling.py
+
+Профиль запуска по этапам: wall и CPU время, рост пикового RSS, строки на входе
+и выходе и (по запросу) пик выделенной памяти через tracemalloc.
+
+tracemalloc перехватывает каждое выделение памяти и замедляет этапы с большим
+числом python-объектов (запись CSV — в разы), поэтому он включается отдельно
+(new_report(trace_alloc=True)), а сравнение с прошлым запуском делается только
+между отчётами одного режима.
+
+Отчёт — словарь {"meta": {...}, "stages": [...]}; этапы записываются контекстом
+stage(report, name) или функцией measure (в т.ч. в процессах пула, см.
+pipeline.run_pipeline) и сохраняются в JSON и CSV (save_report) вместе со
+сравнением с предыдущим отчётом в том же каталоге.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Optional
+import numpy as np
+import pandas as pd
+
+import data_cleaning as dc
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+PROFILE_COLUMNS = ["stage", "wall_s", "cpu_s", "rss_peak_delta_mb", "alloc_peak_mb", "rows_in", "rows_out"]
+
+# открытые этапы текущего процесса (вложенные stage / measure): база и пик tracemalloc
+_OPEN = []
+
+
+def _cpu_seconds() -> float:
+    # процесс и его завершённые дочерние процессы (пул чтения шардов, пул этапов);
+    # без resource (Windows) — только текущий процесс
+    total = time.process_time()
+    if resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+def count_rows(obj) -> Optional[int]:
+    """
+    Число строк результата этапа: len для DataFrame / Series, сумма по таблицам
+    в tuple / list; None, если таблиц нет.
+    """
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return len(obj)
+    if isinstance(obj, (tuple, list)):
+        counts = [n for n in (count_rows(item) for item in obj) if n is not None]
+        return sum(counts) if counts else None
+    return None
+
+
+def _start() -> dict:
+    # без tracemalloc пик выделений не считается (alloc_peak_mb = None)
+    current = None
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        if _OPEN and _OPEN[-1]["alloc_base"] is not None:
+            _OPEN[-1]["alloc_peak"] = max(_OPEN[-1]["alloc_peak"], peak)
+        tracemalloc.reset_peak()
+    frame = {
+        "alloc_base": current, "alloc_peak": current,
+        "wall": time.perf_counter(), "cpu": _cpu_seconds(), "rss": dc.peak_rss_mb(),
+    }
+    _OPEN.append(frame)
+    return frame
+
+
+def _finish(frame: dict, name: str, rows_in: Optional[int], rows_out: Optional[int]) -> dict:
+    _OPEN.remove(frame)
+    alloc_peak_mb = None
+    if frame["alloc_base"] is not None and tracemalloc.is_tracing():
+        peak = max(frame["alloc_peak"], tracemalloc.get_traced_memory()[1])
+        alloc_peak_mb = (peak - frame["alloc_base"]) / 1024 ** 2
+        # пик вложенного этапа — и пик объемлющего (reset_peak сбросил его счётчик)
+        if _OPEN and _OPEN[-1]["alloc_base"] is not None:
+            _OPEN[-1]["alloc_peak"] = max(_OPEN[-1]["alloc_peak"], peak)
+    return {
+        "stage": name,
+        "wall_s": time.perf_counter() - frame["wall"],
+        "cpu_s": _cpu_seconds() - frame["cpu"],
+        "rss_peak_delta_mb": dc.peak_rss_mb() - frame["rss"],
+        "alloc_peak_mb": alloc_peak_mb,
+        "rows_in": rows_in,
+        "rows_out": rows_out,
+    }
+
+
+def new_report(trace_alloc: bool = False, **meta) -> dict:
+    """
+    Пустой отчёт; meta — параметры запуска (вход, флаги), к ним добавляются время
+    старта и версии python / pandas / numpy. trace_alloc=True включает tracemalloc
+    (колонка alloc_peak_mb; процессы пула, запущенные fork, наследуют трассировку).
+    """
+    if trace_alloc and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    meta = dict(
+        meta,
+        trace_alloc=trace_alloc,
+        started_at=datetime.now().isoformat(timespec="seconds"),
+        python=platform.python_version(),
+        pandas=pd.__version__,
+        numpy=np.__version__,
+        platform=sys.platform,
+        cpu_count=os.cpu_count(),
+    )
+    return {"meta": meta, "stages": [], "_start": {"wall": time.perf_counter(), "cpu": _cpu_seconds()}}
+
+
+@contextmanager
+def stage(report: Optional[dict], name: str, rows_in: Optional[int] = None):
+    """
+    Замер блока кода как этапа name. Отдаёт словарь, в который можно записать
+    rows_out (и при необходимости поправить rows_in). report=None — без замеров.
+    """
+    info = {"rows_in": rows_in, "rows_out": None}
+    if report is None:
+        yield info
+        return
+    frame = _start()
+    try:
+        yield info
+    except BaseException:
+        _OPEN.remove(frame)
+        raise
+    report["stages"].append(_finish(frame, name, info["rows_in"], info["rows_out"]))
+
+
+def measure(func: Callable, *args, stage_name: str = "", rows_in: Optional[int] = None, **kwargs):
+    """
+    Вызывает func(*args, **kwargs) и возвращает (результат, замеры этапа);
+    rows_out — count_rows(результат). Работает и в процессе пула.
+    """
+    frame = _start()
+    try:
+        result = func(*args, **kwargs)
+    except BaseException:
+        _OPEN.remove(frame)
+        raise
+    return result, _finish(frame, stage_name, rows_in, count_rows(result))
+
+
+def add_stage(report: Optional[dict], stats: dict) -> None:
+    """
+    Добавляет в отчёт замеры этапа, сделанные measure (например, в процессе пула).
+    """
+    if report is not None:
+        report["stages"].append(dict(stats))
+
+
+def report_table(report: dict) -> pd.DataFrame:
+    """
+    Этапы отчёта таблицей PROFILE_COLUMNS + share_wall (доля от общего wall времени).
+    """
+    table = pd.DataFrame(report["stages"], columns=PROFILE_COLUMNS)
+    table[["rows_in", "rows_out"]] = table[["rows_in", "rows_out"]].astype("Int64")
+    table["alloc_peak_mb"] = table["alloc_peak_mb"].astype(float)
+    total = report["meta"].get("total_wall_s")
+    table["share_wall"] = table["wall_s"] / total if total else np.nan
+    return table
+
+
+def finish_report(report: dict) -> None:
+    """
+    Записывает в meta общее wall / CPU время и пиковый RSS процесса, выключает tracemalloc.
+    """
+    start = report.pop("_start", None)
+    if start is not None:
+        report["meta"]["total_wall_s"] = time.perf_counter() - start["wall"]
+        report["meta"]["total_cpu_s"] = _cpu_seconds() - start["cpu"]
+    report["meta"]["peak_rss_mb"] = dc.peak_rss_mb()
+    if report["meta"].get("trace_alloc") and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def compare_reports(current: pd.DataFrame, previous: pd.DataFrame) -> pd.DataFrame:
+    """
+    Текущая таблица этапов с wall_s предыдущего запуска (prev_wall_s) и изменением
+    wall_change = wall_s / prev_wall_s - 1 (NaN для новых этапов).
+    """
+    prev = previous.drop_duplicates("stage").set_index("stage")["wall_s"]
+    result = current.copy()
+    result["prev_wall_s"] = prev.reindex(result["stage"]).to_numpy()
+    result["wall_change"] = result["wall_s"] / result["prev_wall_s"].where(result["prev_wall_s"] > 0) - 1
+    return result
+
+
+def save_report(report: dict, output_dir: str, name: str = "profile") -> pd.DataFrame:
+    """
+    Сохраняет {name}.json (meta + этапы) и {name}.csv (таблица этапов) в output_dir.
+    Если там уже есть отчёт прошлого запуска в том же режиме trace_alloc, итоговая
+    таблица (она же возвращается) дополняется сравнением с ним (compare_reports).
+    Прошлый отчёт переименовывается в {name}.prev.csv / {name}.prev.json.
+    """
+    if "total_wall_s" not in report["meta"]:
+        finish_report(report)
+    table = report_table(report)
+    csv_path = os.path.join(output_dir, f"{name}.csv")
+    json_path = os.path.join(output_dir, f"{name}.json")
+    if os.path.exists(csv_path) and os.path.exists(json_path):
+        with open(json_path, encoding="utf-8") as f:
+            prev_meta = json.load(f).get("meta", {})
+        if prev_meta.get("trace_alloc", False) == report["meta"]["trace_alloc"]:
+            table = compare_reports(table, pd.read_csv(csv_path))
+        os.replace(csv_path, os.path.join(output_dir, f"{name}.prev.csv"))
+        os.replace(json_path, os.path.join(output_dir, f"{name}.prev.json"))
+    table[PROFILE_COLUMNS + ["share_wall"]].to_csv(csv_path, index=False)
+    payload = {"meta": report["meta"], "stages": report["stages"]}
+    with open(json_path, "w", encoding="utf-8") as f:
+        json.dump(payload, f, ensure_ascii=False, indent=2, default=str)
+    return table
+
+
+def summary_table(table: pd.DataFrame) -> str:
+    """
+    Текстовая сводка таблицы этапов (для печати).
+    """
+    view = table.copy()
+    for col in ("wall_s", "cpu_s", "rss_peak_delta_mb", "alloc_peak_mb", "prev_wall_s"):
+        if col in view.columns:
+            view[col] = view[col].round(3)
+    for col in ("share_wall", "wall_change"):
+        if col in view.columns:
+            view[col] = (view[col] * 100).round(1).astype(str).str.replace("nan", "") + "%"
+            view.loc[view[col] == "%", col] = ""
+    return view.to_string(index=False)
@@ -0,0 +1,250 @@
+"""
+quantile_sketches.py
+
+Сливаемые скетчи квантилей (DDSketch) для UX-метрик: длительность сессии,
+число событий в сессии.
+
+Положительные значения раскладываются по логарифмическим корзинам
+[gamma^(k-1), gamma^k), gamma = (1 + a) / (1 - a); нули (и значения меньше
+min_value) — в отдельную нулевую корзину. Любой квантиль восстанавливается
+с относительной ошибкой не больше a (relative_accuracy). Корзины фиксированы,
+поэтому скетчи разных дней / сегментов объединяются простым сложением
+счётчиков, а p50 / p95 / p99 за любой диапазон дат считаются по слитым
+скетчам без повторного прохода по сессиям. Сумма, минимум и максимум хранятся
+точно (среднее и крайние значения без ошибки).
+
+Набор скетчей — словарь:
+  - keys:   pd.DataFrame ключей групп (по строке на группу)
+  - counts: np.ndarray int64 формы (число групп, число корзин), корзина 0 — нулевая
+  - sum, min, max: np.ndarray float64 по группам
+  - params: relative_accuracy, min_value, max_value
+"""
+from datetime import date
+from typing import List, Optional, Sequence, Union
+import numpy as np
+import pandas as pd
+
+import sketch_storage as ss
+
+
+DEFAULT_RELATIVE_ACCURACY = 0.01
+DEFAULT_MIN_VALUE = 1e-3
+DEFAULT_MAX_VALUE = 1e9
+
+
+def _gamma(params: dict) -> float:
+    a = params["relative_accuracy"]
+    return (1 + a) / (1 - a)
+
+
+def _bin_offset(params: dict) -> int:
+    # номер корзины min_value; корзины 1.. идут подряд от неё
+    return int(np.ceil(np.log(params["min_value"]) / np.log(_gamma(params)))) - 1
+
+
+def _n_bins(params: dict) -> int:
+    log_gamma = np.log(_gamma(params))
+    return int(np.ceil(np.log(params["max_value"]) / log_gamma)) - _bin_offset(params) + 1
+
+
+def bin_index(values: np.ndarray, params: dict) -> np.ndarray:
+    """
+    Номер корзины для каждого значения: 0 — нулевая (значения < min_value),
+    значения больше max_value попадают в последнюю корзину.
+    """
+    values = np.asarray(values, dtype=float)
+    n_bins = _n_bins(params)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        k = np.ceil(np.log(values) / np.log(_gamma(params))) - _bin_offset(params)
+    k = np.where(values >= params["min_value"], k, 0)
+    return np.clip(k, 0, n_bins - 1).astype(np.int64)
+
+
+def bin_values(params: dict) -> np.ndarray:
+    """
+    Представитель каждой корзины: 2 * gamma^k / (gamma + 1) — значение с
+    относительной ошибкой не больше relative_accuracy для всей корзины; у нулевой — 0.
+    """
+    gamma = _gamma(params)
+    k = np.arange(_n_bins(params)) + _bin_offset(params)
+    values = 2 * gamma ** k.astype(float) / (gamma + 1)
+    values[0] = 0.0
+    return values
+
+
+def build_quantile_sketches(
+    df: pd.DataFrame,
+    value_col: str,
+    keys: Union[str, List[str]] = "date",
+    relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY,
+    min_value: float = DEFAULT_MIN_VALUE,
+    max_value: float = DEFAULT_MAX_VALUE
+) -> dict:
+    """
+    Скетчи распределения value_col (неотрицательные значения) по группам keys
+    (отсортированы по ключам). Строки с NaN в value_col или в ключах не учитываются.
+    """
+    if not 0 < relative_accuracy < 1:
+        raise ValueError("relative_accuracy must be in (0, 1)")
+    if not 0 < min_value < max_value:
+        raise ValueError("min_value must be positive and less than max_value")
+    params = {"relative_accuracy": float(relative_accuracy), "min_value": float(min_value), "max_value": float(max_value)}
+    keys = [keys] if isinstance(keys, str) else list(keys)
+    grouped = df.groupby(keys, sort=True, observed=True, dropna=True)
+    # строки с NaN в ключах получают NaN вместо номера группы
+    codes = grouped.ngroup().fillna(-1).to_numpy(dtype=np.int64)
+    key_frame = grouped.size().index.to_frame(index=False)
+
+    values = df[value_col].to_numpy(dtype=float, na_value=np.nan)
+    valid = (codes >= 0) & ~np.isnan(values)
+    if not valid.all():
+        codes, values = codes[valid], values[valid]
+
+    n_groups, n_bins = len(key_frame), _n_bins(params)
+    counts = np.bincount(codes * n_bins + bin_index(values, params), minlength=n_groups * n_bins).reshape(n_groups, n_bins)
+    mins = np.full(n_groups, np.inf)
+    maxs = np.full(n_groups, -np.inf)
+    np.minimum.at(mins, codes, values)
+    np.maximum.at(maxs, codes, values)
+    return {
+        "keys": key_frame,
+        "counts": counts.astype(np.int64),
+        "sum": np.bincount(codes, weights=values, minlength=n_groups),
+        "min": mins,
+        "max": maxs,
+        "params": params,
+    }
+
+
+def union_quantile_sketches(sketches: dict, keys: Optional[List[str]] = None) -> dict:
+    """
+    Объединяет скетчи групп с одинаковыми значениями keys (подмножество колонок ключей),
+    например keys=["date"] сворачивает скетчи (date, segment) в дневные.
+    keys=None или [] — один скетч на весь набор.
+    """
+    if keys:
+        grouped = sketches["keys"].groupby(keys, sort=True, observed=True, dropna=False)
+        codes = grouped.ngroup().to_numpy()
+        key_frame = grouped.size().index.to_frame(index=False)
+    else:
+        codes = np.zeros(len(sketches["keys"]), dtype=np.int64)
+        key_frame = pd.DataFrame(index=range(1))
+    n_groups = len(key_frame)
+    counts = np.zeros((n_groups, sketches["counts"].shape[1]), dtype=np.int64)
+    np.add.at(counts, codes, sketches["counts"])
+    mins = np.full(n_groups, np.inf)
+    maxs = np.full(n_groups, -np.inf)
+    np.minimum.at(mins, codes, sketches["min"])
+    np.maximum.at(maxs, codes, sketches["max"])
+    return {
+        "keys": key_frame,
+        "counts": counts,
+        "sum": np.bincount(codes, weights=sketches["sum"], minlength=n_groups),
+        "min": mins,
+        "max": maxs,
+        "params": dict(sketches["params"]),
+    }
+
+
+def merge_quantile_sketches(a: dict, b: dict) -> dict:
+    """
+    Объединение двух наборов скетчей с одинаковыми колонками ключей и параметрами корзин:
+    группы с совпадающими ключами сливаются, остальные добавляются.
+    """
+    if a["params"] != b["params"]:
+        raise ValueError("sketches have different bin parameters")
+    keys = pd.concat([a["keys"], b["keys"]], ignore_index=True)
+    stacked = {
+        "keys": keys,
+        "counts": np.concatenate([a["counts"], b["counts"]]),
+        "sum": np.concatenate([a["sum"], b["sum"]]),
+        "min": np.concatenate([a["min"], b["min"]]),
+        "max": np.concatenate([a["max"], b["max"]]),
+        "params": a["params"],
+    }
+    return union_quantile_sketches(stacked, list(keys.columns))
+
+
+def sketch_quantiles(sketches: dict, quantiles: Sequence[float] = (0.5, 0.95, 0.99)) -> np.ndarray:
+    """
+    Квантили по каждой группе, форма (число групп, len(quantiles)); NaN для пустых групп.
+    Ранг квантиля q — q * (n - 1), как у np.quantile(method="lower"); значение корзины
+    ограничивается точными min / max группы.
+    """
+    counts = sketches["counts"]
+    total = counts.sum(axis=1)
+    cumulative = counts.cumsum(axis=1)
+    values = bin_values(sketches["params"])
+    result = np.full((len(counts), len(quantiles)), np.nan)
+    nonempty = total > 0
+    for j, q in enumerate(quantiles):
+        rank = np.floor(q * (total - 1))
+        # первая корзина, где накопленное число значений больше ранга
+        idx = (cumulative <= rank[:, None]).sum(axis=1)
+        idx = np.minimum(idx, counts.shape[1] - 1)
+        result[nonempty, j] = np.clip(values[idx], sketches["min"], sketches["max"])[nonempty]
+    return result
+
+
+def summarize(
+    sketches: dict,
+    quantiles: Sequence[float] = (0.5, 0.95, 0.99),
+    prefix: str = ""
+) -> pd.DataFrame:
+    """
+    Ключи групп, count, mean и квантили (колонки {prefix}p50, {prefix}p95, ...).
+    """
+    result = sketches["keys"].copy()
+    total = sketches["counts"].sum(axis=1)
+    result[f"{prefix}count"] = total
+    result[f"{prefix}mean"] = sketches["sum"] / np.where(total > 0, total, np.nan)
+    values = sketch_quantiles(sketches, quantiles)
+    for j, q in enumerate(quantiles):
+        result[f"{prefix}p{round(q * 100):g}"] = values[:, j]
+    return result
+
+
+def range_summary(
+    sketches: dict,
+    start: Union[str, date, pd.Timestamp],
+    end: Union[str, date, pd.Timestamp],
+    quantiles: Sequence[float] = (0.5, 0.95, 0.99),
+    date_col: str = "date",
+    keys: Optional[List[str]] = None
+) -> pd.DataFrame:
+    """
+    count / mean / квантили за дни [start, end] (включительно), слиянием дневных скетчей;
+    keys — дополнительные колонки, по которым результат остаётся разбит (например, сегмент).
+    """
+    dates = pd.to_datetime(sketches["keys"][date_col])
+    in_range = ((dates >= pd.Timestamp(start)) & (dates <= pd.Timestamp(end))).to_numpy()
+    selected = {
+        "keys": sketches["keys"][in_range].reset_index(drop=True),
+        "counts": sketches["counts"][in_range],
+        "sum": sketches["sum"][in_range],
+        "min": sketches["min"][in_range],
+        "max": sketches["max"][in_range],
+        "params": sketches["params"],
+    }
+    return summarize(union_quantile_sketches(selected, keys), quantiles)
+
+
+def save_quantile_sketches(sketches: dict, path: str) -> None:
+    """
+    Сохраняет набор скетчей в .npz (формат — см. sketch_storage);
+    параметры корзин хранятся как param_<имя>.
+    """
+    arrays = {name: sketches[name] for name in ("counts", "sum", "min", "max")}
+    arrays.update({f"param_{name}": np.float64(value) for name, value in sketches["params"].items()})
+    ss.save_sketch_arrays(path, sketches["keys"], arrays)
+
+
+def load_quantile_sketches(path: str) -> dict:
+    """
+    Загружает набор скетчей, сохранённый save_quantile_sketches.
+    """
+    keys, arrays = ss.load_sketch_arrays(path)
+    sketches = {name: arrays[name] for name in ("counts", "sum", "min", "max")}
+    sketches["keys"] = keys
+    sketches["params"] = {name[len("param_"):]: float(value) for name, value in arrays.items() if name.startswith("param_")}
+    return sketches
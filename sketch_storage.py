@@ -0,0 +1,45 @@
+"""
+sketch_storage.py
+
+Общий формат хранения наборов скетчей (distinct_sketches, quantile_sketches) в .npz.
+
+Набор скетчей — DataFrame ключей групп и массивы по группам. Колонки ключей хранятся
+как key_<имя>: строки — как str, даты — datetime64[us]; остальные массивы — под своими
+именами. Файл пишется атомарно, через временный.
+"""
+import os
+from datetime import date
+from typing import Dict, Tuple
+import numpy as np
+import pandas as pd
+
+
+KEY_PREFIX = "key_"
+
+
+def _key_array(values: pd.Series) -> np.ndarray:
+    if pd.api.types.is_datetime64_any_dtype(values) or isinstance(values.iloc[0] if len(values) else None, date):
+        return pd.to_datetime(values).to_numpy().astype("datetime64[us]")
+    array = values.to_numpy()
+    return array.astype(str) if array.dtype == object else array
+
+
+def save_sketch_arrays(path: str, keys: pd.DataFrame, arrays: Dict[str, np.ndarray]) -> None:
+    """
+    Сохраняет ключи групп keys и массивы arrays (имена не должны начинаться с key_) в path.
+    """
+    stored = dict(arrays)
+    stored.update({f"{KEY_PREFIX}{col}": _key_array(keys[col]) for col in keys.columns})
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path, **stored)
+    os.replace(tmp_path, path)
+
+
+def load_sketch_arrays(path: str) -> Tuple[pd.DataFrame, Dict[str, np.ndarray]]:
+    """
+    Загружает файл save_sketch_arrays: (ключи групп, {имя: массив}).
+    """
+    with np.load(path, allow_pickle=False) as data:
+        keys = pd.DataFrame({name[len(KEY_PREFIX):]: data[name] for name in data.files if name.startswith(KEY_PREFIX)})
+        arrays = {name: data[name] for name in data.files if not name.startswith(KEY_PREFIX)}
+    return keys, arrays
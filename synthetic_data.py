@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""
+synthetic_data.py
+
+Генератор синтетической телеметрии в формате исходного датасета
+(Unnamed: 0, userid, sessionid, timestamp, action, value, category, age, gender, city)
+для бенчмарков и проверок на больших объёмах.
+
+Модель данных:
+  - у пользователя постоянные age / gender / city, день прихода и «срок жизни»
+    (экспоненциальный), активность по сессиям — с тяжёлым хвостом (Парето);
+  - начало сессии: день в пределах срока жизни с недельной сезонностью,
+    час — по суточному профилю;
+  - действия сессии идут по цепочке шагов main.FUNNEL_STEPS от входа (search или
+    mainpage) до глубины, определяемой вероятностями перехода к следующему шагу,
+    с возвратами на пройденные шаги и действиями "other"; паузы между событиями
+    экспоненциальные;
+  - value — логнормальная цена, category — a / b / пропуск.
+
+События генерируются кусками (chunk_events событий), каждый кусок — из своего
+зерна (seed, номер куска) и со своими диапазонами userid / sessionid, поэтому
+куски независимы: их можно писать шардами параллельно, а объём ограничен только
+диском (100K ... 500M событий и больше).
+
+Usage:
+    python synthetic_data.py --events 1M --output synthetic_1M.csv
+    python synthetic_data.py --events 500M --output ./synthetic_500M --shard-events 5M --workers 8
+"""
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Iterator, List, Optional
+import numpy as np
+import pandas as pd
+
+
+# цепочка шагов воронки (как main.FUNNEL_STEPS) и вероятность перейти с шага на следующий
+STEP_CHAIN = ["search", "product", "category", "mainpage", "cart", "checkout", "confirmation"]
+CONTINUE_PROBS = [0.75, 0.6, 0.7, 0.55, 0.5, 0.8]
+# вход в сессию: индекс шага в STEP_CHAIN и его вероятность
+ENTRY_STEPS = {0: 0.6, 3: 0.4}
+
+CATEGORIES = ["a", "b", None]
+CITIES = ["X", "Y", "Z"]
+GENDERS = ["m", "f"]
+
+# суточный профиль активности (доля сессий по часам) и недельная сезонность (пн..вс)
+HOUR_WEIGHTS = np.array([2, 1, 1, 1, 1, 2, 3, 5, 6, 6, 6, 6, 7, 6, 6, 6, 6, 7, 8, 9, 9, 8, 6, 4], dtype=float)
+WEEKDAY_WEIGHTS = np.array([1.0, 1.0, 1.0, 1.0, 1.1, 1.3, 1.2])
+
+DEFAULT_CHUNK_EVENTS = 2_000_000
+
+
+def parse_size(value: str) -> int:
+    """
+    Размер вида 100K / 1.5M / 500M / 2G / 12345 -> число.
+    """
+    value = str(value).strip().upper().replace("_", "")
+    scale = {"K": 10 ** 3, "M": 10 ** 6, "G": 10 ** 9, "B": 10 ** 9}.get(value[-1:], 1)
+    number = value[:-1] if value[-1:] in "KMGB" else value
+    return int(float(number) * scale)
+
+
+def _weighted_choice(rng: np.random.Generator, weights: np.ndarray, size: int) -> np.ndarray:
+    # выбор индексов по весам через searchsorted (быстрее rng.choice(p=...) на больших n)
+    cdf = np.cumsum(weights, dtype=float)
+    cdf /= cdf[-1]
+    return np.minimum(np.searchsorted(cdf, rng.random(size), side="right"), len(weights) - 1)
+
+
+def _chunk_rng(seed: int, chunk: int) -> np.random.Generator:
+    return np.random.default_rng(np.random.SeedSequence([seed, chunk]))
+
+
+def generate_chunk(
+    chunk: int,
+    n_events: int,
+    seed: int = 0,
+    start_date: str = "2024-01-01",
+    days: int = 365,
+    events_per_user: float = 40.0,
+    mean_session_events: float = 8.0,
+    bad_timestamp_share: float = 0.0,
+    shuffle: bool = True
+) -> pd.DataFrame:
+    """
+    Кусок номер chunk из n_events событий. userid и sessionid куска лежат в своих
+    диапазонах [chunk * n_events, (chunk + 1) * n_events), поэтому куски не пересекаются.
+    timestamp — строка "%Y-%m-%d %H:%M:%S"; доля bad_timestamp_share заменяется мусором.
+    """
+    rng = _chunk_rng(seed, chunk)
+    id_offset = chunk * n_events
+
+    # сессии: длины (>= 1) набираем до n_events событий, последнюю обрезаем
+    n_sessions_guess = int(n_events / mean_session_events * 1.2) + 16
+    lengths = rng.geometric(1 / mean_session_events, n_sessions_guess)
+    ends = np.cumsum(lengths)
+    while ends[-1] < n_events:
+        lengths = np.concatenate([lengths, rng.geometric(1 / mean_session_events, n_sessions_guess)])
+        ends = np.cumsum(lengths)
+    n_sessions = int(np.searchsorted(ends, n_events) + 1)
+    lengths = lengths[:n_sessions]
+    lengths[-1] -= int(ends[n_sessions - 1] - n_events)
+
+    # пользователи: атрибуты, день прихода, срок жизни и вес активности
+    n_users = max(int(n_events / events_per_user), 1)
+    join_day = rng.integers(0, days, n_users)
+    lifetime = rng.exponential(days / 4, n_users)
+    activity = rng.pareto(1.5, n_users) + 1
+    user_of_session = _weighted_choice(rng, activity, n_sessions)
+
+    # день сессии: в пределах срока жизни пользователя, недельная сезонность — отбором
+    # (отвергнутые дни перевыбираются, несколько раундов)
+    first_day = np.datetime64(start_date, "D").astype(np.int64)
+    session_join = join_day[user_of_session]
+    # срок жизни обрезается концом периода, чтобы сессии не скапливались в последнем дне
+    session_lifetime = np.minimum(lifetime[user_of_session] + 1, days - session_join)
+    day = np.minimum(session_join + np.floor(rng.random(n_sessions) * session_lifetime).astype(np.int64), days - 1)
+    redraw = np.arange(n_sessions)
+    for _ in range(4):
+        weekday = (first_day + day[redraw] + 3) % 7  # 1970-01-01 — четверг
+        redraw = redraw[rng.random(len(redraw)) >= WEEKDAY_WEIGHTS[weekday] / WEEKDAY_WEIGHTS.max()]
+        offset = np.floor(rng.random(len(redraw)) * session_lifetime[redraw]).astype(np.int64)
+        day[redraw] = np.minimum(session_join[redraw] + offset, days - 1)
+    hour = _weighted_choice(rng, HOUR_WEIGHTS, n_sessions)
+    session_start = (
+        np.datetime64(start_date, "s")
+        + day * 86400 + hour * 3600 + rng.integers(0, 3600, n_sessions)
+    )
+
+    # глубина сессии по цепочке шагов: вход + переходы с вероятностями CONTINUE_PROBS
+    entry_steps = np.array(list(ENTRY_STEPS))
+    entry = entry_steps[_weighted_choice(rng, np.array(list(ENTRY_STEPS.values())), n_sessions)]
+    depth = entry.copy()
+    going = np.ones(n_sessions, dtype=bool)
+    for step, prob in enumerate(CONTINUE_PROBS):
+        advance = going & (depth == step) & (rng.random(n_sessions) < prob)
+        going &= (depth > step) | advance
+        depth = np.where(advance, step + 1, depth)
+
+    # события: позиция в сессии -> шаг между входом и глубиной (неубывающе),
+    # часть событий — возврат на пройденный шаг или "other"
+    session_of_event = np.repeat(np.arange(n_sessions), lengths)
+    starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    position = np.arange(n_events) - starts
+    length_ev = lengths[session_of_event]
+    entry_ev, depth_ev = entry[session_of_event], depth[session_of_event]
+    span = depth_ev - entry_ev + 1
+    step_idx = entry_ev + np.minimum(position * span // length_ev, span - 1)
+    # последнее событие сессии — самый глубокий шаг
+    step_idx = np.where(position == length_ev - 1, depth_ev, step_idx)
+    noise = rng.random(n_events)
+    back = (noise < 0.08) & (step_idx > entry_ev)
+    step_idx = np.where(back, entry_ev + (rng.random(n_events) * (step_idx - entry_ev)).astype(np.int64), step_idx)
+    actions = np.array(STEP_CHAIN + ["other"], dtype=object)[step_idx]
+    actions[(noise >= 0.08) & (noise < 0.14)] = "other"
+
+    # время событий: начало сессии + накопленные экспоненциальные паузы
+    gaps = rng.exponential(45.0, n_events).astype(np.int64)
+    gaps[position == 0] = 0
+    within = np.cumsum(gaps) - np.repeat(np.cumsum(gaps)[np.cumsum(lengths) - lengths], lengths)
+    timestamps = session_start[session_of_event] + within
+    ts_text = pd.Series(pd.DatetimeIndex(timestamps).strftime("%Y-%m-%d %H:%M:%S"), dtype=object)
+    if bad_timestamp_share > 0:
+        ts_text[rng.random(n_events) < bad_timestamp_share] = "garbage"
+
+    users = user_of_session[session_of_event]
+    df = pd.DataFrame({
+        "Unnamed: 0": id_offset + np.arange(n_events),
+        "userid": id_offset + users,
+        "sessionid": id_offset + session_of_event,
+        "timestamp": ts_text,
+        "action": actions,
+        "value": np.round(rng.lognormal(3.5, 0.8, n_events), 2),
+        "category": np.array(CATEGORIES, dtype=object)[rng.integers(0, len(CATEGORIES), n_events)],
+        "age": rng.integers(18, 70, n_users)[users],
+        "gender": np.array(GENDERS, dtype=object)[rng.integers(0, len(GENDERS), n_users)][users],
+        "city": np.array(CITIES, dtype=object)[rng.integers(0, len(CITIES), n_users)][users],
+    })
+    if shuffle:
+        df = df.take(rng.permutation(n_events)).reset_index(drop=True)
+    return df
+
+
+def chunk_sizes(n_events: int, chunk_events: int = DEFAULT_CHUNK_EVENTS) -> List[int]:
+    """
+    Размеры кусков для n_events событий (все по chunk_events, последний — остаток).
+    """
+    full, rest = divmod(n_events, chunk_events)
+    return [chunk_events] * full + ([rest] if rest else [])
+
+
+def iter_synthetic_events(
+    n_events: int,
+    chunk_events: int = DEFAULT_CHUNK_EVENTS,
+    seed: int = 0,
+    **chunk_kwargs
+) -> Iterator[pd.DataFrame]:
+    """
+    Итератор кусков синтетических событий (см. generate_chunk), всего n_events.
+    """
+    for chunk, size in enumerate(chunk_sizes(n_events, chunk_events)):
+        yield generate_chunk(chunk, size, seed=seed, **chunk_kwargs)
+
+
+def generate_events(n_events: int, seed: int = 0, chunk_events: int = DEFAULT_CHUNK_EVENTS, **chunk_kwargs) -> pd.DataFrame:
+    """
+    Все n_events событий одним фреймом (для объёмов, помещающихся в память).
+    """
+    chunks = list(iter_synthetic_events(n_events, chunk_events=chunk_events, seed=seed, **chunk_kwargs))
+    return chunks[0] if len(chunks) == 1 else pd.concat(chunks, ignore_index=True)
+
+
+def _write_shard(args, output_dir: str, seed: int, chunk_kwargs: dict) -> str:
+    chunk, size = args
+    path = os.path.join(output_dir, f"part-{chunk:05d}.csv")
+    tmp_path = path + ".tmp"
+    generate_chunk(chunk, size, seed=seed, **chunk_kwargs).to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    return path
+
+
+def write_synthetic_csv(
+    output: str,
+    n_events: int,
+    shard_events: Optional[int] = None,
+    seed: int = 0,
+    workers: Optional[int] = None,
+    **chunk_kwargs
+) -> List[str]:
+    """
+    Пишет n_events синтетических событий в CSV. shard_events=None — один файл output
+    (куски дописываются по очереди); иначе output — каталог шардов part-NNNNN.csv
+    по shard_events событий, которые пишутся в пуле из workers процессов
+    (None — по числу ядер, 1 — последовательно). Возвращает список записанных файлов.
+    """
+    if shard_events is None:
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        tmp_path = output + ".tmp"
+        for i, chunk in enumerate(iter_synthetic_events(n_events, seed=seed, **chunk_kwargs)):
+            chunk.to_csv(tmp_path, index=False, mode="w" if i == 0 else "a", header=i == 0)
+        os.replace(tmp_path, output)
+        return [output]
+
+    os.makedirs(output, exist_ok=True)
+    shards = list(enumerate(chunk_sizes(n_events, shard_events)))
+    writer = partial(_write_shard, output_dir=output, seed=seed, chunk_kwargs=chunk_kwargs)
+    if len(shards) == 1 or workers == 1:
+        return [writer(s) for s in shards]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(writer, shards))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Synthetic telemetry generator")
+    parser.add_argument("--events", "-n", type=str, default="1M", help="Number of events, e.g. 100K, 1M, 500M")
+    parser.add_argument("--output", "-o", type=str, default="synthetic_telemetry.csv", help="Output CSV file (or directory with --shard-events)")
+    parser.add_argument("--shard-events", type=str, default=None, help="Write a directory of CSV shards of this many events each")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--days", type=int, default=365, help="Number of days covered by the data")
+    parser.add_argument("--start-date", type=str, default="2024-01-01", help="First day of the data")
+    parser.add_argument("--events-per-user", type=float, default=40.0, help="Average events per user")
+    parser.add_argument("--bad-timestamp-share", type=float, default=0.0, help="Share of unparsable timestamps")
+    parser.add_argument("--workers", type=int, default=None, help="Processes for writing shards (default: all cores)")
+    args = parser.parse_args()
+
+    files = write_synthetic_csv(
+        args.output, parse_size(args.events),
+        shard_events=parse_size(args.shard_events) if args.shard_events else None,
+        seed=args.seed, workers=args.workers, days=args.days, start_date=args.start_date,
+        events_per_user=args.events_per_user, bad_timestamp_share=args.bad_timestamp_share,
+    )
+    print(f"Written {len(files)} file(s) to {args.output}")
@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import activity_bitmaps as ab
+
+
+def random_events(seed, n=3000, n_users=200, n_days=45):
+    rng = np.random.default_rng(seed)
+    # дни с пропусками: часть дат без событий
+    days = rng.choice(np.setdiff1d(np.arange(n_days), [10, 11, 30]), n)
+    df = pd.DataFrame({
+        "userid": pd.Series([f"u{u}" for u in rng.integers(0, n_users, n)], dtype=object),
+        "timestamp": pd.Timestamp("2024-01-01") + pd.to_timedelta(days, unit="D") + pd.to_timedelta(rng.integers(0, 86400, n), unit="s"),
+    })
+    df.loc[rng.random(n) < 0.02, "userid"] = None
+    df.loc[rng.random(n) < 0.02, "timestamp"] = pd.NaT
+    return df
+
+
+def active_sets(df):
+    """Множество пользователей по каждому дню непрерывного диапазона."""
+    df = df.dropna(subset=["userid", "timestamp"])
+    day = df["timestamp"].dt.normalize()
+    dates = pd.date_range(day.min(), day.max(), freq="D")
+    sets = {d: set() for d in dates}
+    for d, user in zip(day, df["userid"]):
+        sets[d].add(user)
+    return dates, [sets[d] for d in dates]
+
+
+def reference_daily_activity(df, wau_days=7, mau_days=30):
+    dates, active = active_sets(df)
+    rows, seen = [], set()
+    for i, users in enumerate(active):
+        wau = set().union(*active[max(i - wau_days + 1, 0):i + 1])
+        mau = set().union(*active[max(i - mau_days + 1, 0):i + 1])
+        rows.append({"date": dates[i], "dau": len(users), "wau": len(wau), "mau": len(mau), "new_users": len(users - seen)})
+        seen |= users
+    return pd.DataFrame(rows)
+
+
+def reference_retention(df, periods, rolling, cohort):
+    dates, active = active_sets(df)
+    result = {f"retention_{n}d": [] for n in periods}
+    cohort_users, seen = [], set()
+    for i, users in enumerate(active):
+        base = users - seen if cohort == "new" else users
+        seen |= users
+        cohort_users.append(len(base))
+        for n in periods:
+            if i + n >= len(active) or not base:
+                value = np.nan
+            else:
+                later = set().union(*active[i + n:]) if rolling else active[i + n]
+                value = len(base & later) / len(base)
+            result[f"retention_{n}d"].append(value)
+    return pd.DataFrame({"date": dates, "cohort_users": cohort_users, **result})
+
+
+def test_daily_activity_matches_sets():
+    df = random_events(0)
+    result = ab.daily_activity(ab.build_activity_bitmaps(df))
+    expected = reference_daily_activity(df)
+    pd.testing.assert_frame_equal(result[expected.columns], expected, check_dtype=False, check_names=False)
+    np.testing.assert_array_equal(result["returning_users"], result["dau"] - result["new_users"])
+    np.testing.assert_allclose(result["stickiness"], result["dau"] / result["mau"])
+
+
+@pytest.mark.parametrize("rolling", [False, True])
+@pytest.mark.parametrize("cohort", ["new", "active"])
+def test_retention_matches_sets(rolling, cohort):
+    df = random_events(1)
+    periods = (1, 7, 30)
+    result = ab.retention_by_day(ab.build_activity_bitmaps(df), periods=periods, rolling=rolling, cohort=cohort)
+    expected = reference_retention(df, periods, rolling, cohort)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False, check_names=False)
+
+
+def test_active_users_matches_sets():
+    df = random_events(2)
+    bitmaps = ab.build_activity_bitmaps(df)
+    dates, active = active_sets(df)
+    for start, end in [(0, 0), (3, 9), (0, len(dates) - 1), (10, 11)]:
+        assert ab.active_users(bitmaps, dates[start], dates[end]) == len(set().union(*active[start:end + 1]))
+    assert ab.active_users(bitmaps, dates[-1] + pd.Timedelta(days=1), dates[-1] + pd.Timedelta(days=5)) == 0
+
+
+def test_saved_days_across_batches_equal_one_shot_build(tmp_path):
+    df = random_events(3).sort_values("timestamp", na_position="first").reset_index(drop=True)
+    # вторая порция дописывает события в уже сохранённые дни, третья — новых пользователей и более ранние дни
+    batches = [df.iloc[:1000], pd.concat([df.iloc[1000:2000], df.iloc[:1000].sample(100, random_state=0)]), df.iloc[2000:]]
+    batches[2] = pd.concat([batches[2], pd.DataFrame({"userid": ["new1", "new2"], "timestamp": pd.to_datetime(["2023-12-20", "2023-12-25"])})])
+
+    directory = str(tmp_path / "activity_bitmaps")
+    for batch in batches:
+        bitmaps = ab.load_activity_bitmap_days(directory) if (tmp_path / "activity_bitmaps").exists() else ab.empty_activity_bitmaps()
+        bitmaps = ab.update_activity_bitmaps(bitmaps, batch)
+        # как в incremental: пишутся только дни, затронутые порцией
+        ab.save_activity_bitmap_days(bitmaps, directory, days=set(batch["timestamp"].dropna().dt.normalize()))
+
+    loaded = ab.load_activity_bitmap_days(directory)
+    whole = ab.build_activity_bitmaps(pd.concat(batches, ignore_index=True))
+    assert loaded["first_day"] == whole["first_day"]
+    pd.testing.assert_index_equal(loaded["users"], whole["users"], exact=False)
+    np.testing.assert_array_equal(loaded["bits"], whole["bits"])
+    pd.testing.assert_frame_equal(ab.daily_activity(loaded), ab.daily_activity(whole))
+    pd.testing.assert_frame_equal(ab.retention_by_day(loaded), ab.retention_by_day(whole))
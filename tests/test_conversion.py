@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import metrics
+
+
+STEPS = ["search", "product", "cart", "checkout"]
+
+
+def merge_conversion_daily(df, steps, ts_col="timestamp", window=None):
+    """Исходная версия compute_conversion_daily: merge событий шагов с когортами пользователей."""
+    df_local = df.copy()
+    df_local["date"] = df_local[ts_col].dt.normalize()
+    df_f = df_local[df_local["action"].isin(steps)].copy()
+    df_first = df_f[df_f["action"] == steps[0]].sort_values(ts_col)
+    first_ts = df_first.groupby("userid", observed=True)[ts_col].first().reset_index()
+    first_day = df_first.groupby("userid", observed=True)["date"].first().reset_index()
+    cohort = first_ts.merge(first_day, on="userid").rename(columns={ts_col: "first_ts", "date": "cohort_date"})
+    df_join = df_f.merge(cohort, on="userid")
+    df_join = df_join[df_join[ts_col] >= df_join["first_ts"]]
+    if window is not None:
+        df_join = df_join[df_join[ts_col] - df_join["first_ts"] <= pd.Timedelta(window)]
+    return metrics.conversion_table(df_join, steps)
+
+
+def random_events(seed, n=3000):
+    rng = np.random.default_rng(seed)
+    userid = rng.integers(0, 200, n).astype(float)
+    userid[rng.random(n) < 0.02] = np.nan
+    return pd.DataFrame({
+        "userid": userid,
+        "action": rng.choice(STEPS + ["mainpage"], n),
+        "timestamp": pd.Timestamp("2024-01-01") + pd.to_timedelta(rng.integers(0, 14 * 86400, n), unit="s"),
+    })
+
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("window", [None, "24h"])
+def test_matches_merge_implementation(seed, window):
+    df = random_events(seed)
+    expected = merge_conversion_daily(df, STEPS, window=window)
+    result = metrics.compute_conversion_daily(df, STEPS, window=window)
+    pd.testing.assert_frame_equal(result.reset_index(drop=True), expected.reset_index(drop=True), check_dtype=False)
+
+
+def test_tz_aware_and_compact_inputs():
+    df = random_events(4)
+    df["timestamp"] = df["timestamp"].dt.tz_localize("Europe/Moscow")
+    df["action"] = df["action"].astype("category")
+    expected = merge_conversion_daily(df, STEPS)
+    result = metrics.compute_conversion_daily(df, STEPS)
+    pd.testing.assert_frame_equal(result.reset_index(drop=True), expected.reset_index(drop=True), check_dtype=False)
@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import distinct_sketches as ds
+
+
+def groups_with_cardinalities(cardinalities, seed=0, repeats=3):
+    """По группе на каждую мощность: n различных userid, каждый повторён repeats раз."""
+    rng = np.random.default_rng(seed)
+    frames = []
+    for g, n in enumerate(cardinalities):
+        users = rng.choice(10 ** 12, n, replace=False)
+        frames.append(pd.DataFrame({"group": g, "userid": np.repeat(users, repeats)}))
+    return pd.concat(frames, ignore_index=True)
+
+
+@pytest.mark.parametrize("precision", [10, 12, 14])
+def test_relative_error_within_standard_error(precision):
+    cardinalities = [5_000, 20_000, 50_000] * 20
+    df = groups_with_cardinalities(cardinalities, seed=precision, repeats=1)
+    estimates = ds.estimate(ds.build_sketches(df, "userid", keys="group", precision=precision))["estimate"].to_numpy()
+    rel_error = estimates / np.array(cardinalities) - 1
+    std_error = 1.04 / np.sqrt(2 ** precision)
+    # среднеквадратичная ошибка — порядка 1.04 / sqrt(m), отдельные оценки — в пределах 5 сигм (хвосты HLL при малом m тяжелее нормальных)
+    assert np.sqrt(np.mean(rel_error ** 2)) < 1.3 * std_error
+    assert np.abs(rel_error).max() < 5 * std_error
+
+
+def test_small_cardinalities_are_nearly_exact():
+    cardinalities = [1, 10, 100, 1000]
+    df = groups_with_cardinalities(cardinalities)
+    estimates = ds.estimate(ds.build_sketches(df, "userid", keys="group"))["estimate"].to_numpy()
+    np.testing.assert_allclose(estimates, cardinalities, rtol=0.01)
+    empty = ds.build_sketches(df.iloc[:0], "userid", keys="group")
+    assert len(ds.estimate(empty)) == 0
+
+
+def test_merge_equals_sketch_of_concatenation():
+    rng = np.random.default_rng(1)
+    df = pd.DataFrame({
+        "date": pd.Timestamp("2024-01-01") + pd.to_timedelta(rng.integers(0, 10, 20_000), unit="D"),
+        "category": rng.choice(["a", "b", "c"], 20_000),
+        "userid": rng.integers(0, 5_000, 20_000),
+    })
+    # части пересекаются по ключам групп и по пользователям
+    first, second = df.iloc[:12_000], df.iloc[12_000:]
+    second = second[second["date"] > pd.Timestamp("2024-01-03")]
+    keys = ["date", "category"]
+    merged = ds.merge_sketches(ds.build_sketches(first, "userid", keys), ds.build_sketches(second, "userid", keys))
+    whole = ds.build_sketches(pd.concat([first, second]), "userid", keys)
+    pd.testing.assert_frame_equal(merged["keys"], whole["keys"])
+    np.testing.assert_array_equal(merged["registers"], whole["registers"])
+
+    daily = ds.union_sketches(whole, ["date"])
+    np.testing.assert_array_equal(daily["registers"], ds.build_sketches(pd.concat([first, second]), "userid", "date")["registers"])
+
+
+def test_merge_rejects_different_precision():
+    df = groups_with_cardinalities([100])
+    with pytest.raises(ValueError):
+        ds.merge_sketches(ds.build_sketches(df, "userid", "group", precision=10), ds.build_sketches(df, "userid", "group", precision=12))
+
+
+def test_save_load_roundtrip(tmp_path):
+    rng = np.random.default_rng(2)
+    df = pd.DataFrame({
+        "date": pd.Timestamp("2024-01-01") + pd.to_timedelta(rng.integers(0, 5, 1000), unit="D"),
+        "category": rng.choice(["a", "b"], 1000),
+        "userid": rng.integers(0, 300, 1000),
+    })
+    sketches = ds.build_sketches(df, "userid", ["date", "category"], precision=8)
+    path = str(tmp_path / "sketches.npz")
+    ds.save_sketches(sketches, path)
+    loaded = ds.load_sketches(path)
+    pd.testing.assert_frame_equal(loaded["keys"], sketches["keys"], check_dtype=False)
+    np.testing.assert_array_equal(loaded["registers"], sketches["registers"])
+
+
+def test_integral_float_ids_hash_like_int64():
+    ids = pd.Series([1, 2, -5, 10 ** 9], dtype=np.int64)
+    expected = ds.hash_values(ids)
+    variants = (np.float64, "Float64", np.int32, "Int64", "category")
+    for values in [ids.astype(t) for t in variants] + [ids.astype(np.float64).astype("category"), ids.astype(np.int32).astype("category")]:
+        np.testing.assert_array_equal(ds.hash_values(values), expected)
+    assert ds.hash_values(pd.Series([1.5]))[0] != ds.hash_values(pd.Series([1]))[0]
+
+    # userid с пропусками читается как float64: скетч тот же, что у целых id
+    df = groups_with_cardinalities([1000])
+    with_missing = pd.concat([df, pd.DataFrame({"group": [0], "userid": [np.nan]})], ignore_index=True)
+    np.testing.assert_array_equal(
+        ds.build_sketches(with_missing, "userid", keys="group")["registers"],
+        ds.build_sketches(df, "userid", keys="group")["registers"],
+    )
@@ -0,0 +1,111 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import metrics
+
+
+STEPS = ["search", "product", "category", "mainpage", "cart", "checkout", "confirmation"]
+
+
+def original_compute_funnel(df, steps, session_col="sessionid", userid_col="userid", ts_col="timestamp"):
+    """Цикл по сессиям из исходной версии compute_funnel."""
+    df_local = df.copy()
+    if ts_col in df_local.columns and not pd.api.types.is_datetime64_any_dtype(df_local[ts_col]):
+        df_local[ts_col] = pd.to_datetime(df_local[ts_col], errors="coerce")
+    df_local = df_local.sort_values([session_col, ts_col])
+
+    rows = []
+    for sid, sgrp in df_local.groupby(session_col):
+        actions = list(sgrp["action"])
+        user = sgrp[userid_col].iloc[0] if userid_col in sgrp.columns else None
+        pos = 0
+        reached = list()
+        for step in steps:
+            try:
+                i = actions.index(step, pos)
+                reached.append(step)
+                pos = i + 1
+            except ValueError:
+                break
+        for step in reached:
+            rows.append({"sessionid": sid, "userid": user, "step": step})
+
+    if not rows:
+        return pd.DataFrame({"step": [], "sessions_reached": [], "unique_users_reached": []})
+
+    reached_df = pd.DataFrame(rows)
+    agg = (
+        reached_df.groupby("step")
+        .agg(sessions_reached=("sessionid", "nunique"), unique_users_reached=("userid", "nunique"))
+        .reset_index()
+    )
+    agg["step_number"] = agg["step"].apply(lambda s: steps.index(s) if s in steps else -1)
+    agg = agg.sort_values("step_number").drop(columns="step_number")
+    return agg
+
+
+def random_events(seed, n=2000, nat_share=0.0):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        "sessionid": rng.integers(0, 150, n),
+        "userid": rng.integers(0, 40, n),
+        # шаги в случайном порядке, с повторами и посторонними действиями
+        "action": rng.choice(STEPS + ["other"], n),
+        "timestamp": pd.Timestamp("2024-01-01") + pd.to_timedelta(rng.integers(0, 3600, n), unit="s"),
+    })
+    if nat_share:
+        df.loc[rng.random(n) < nat_share, "timestamp"] = pd.NaT
+    return df
+
+
+def assert_same_funnel(df, steps):
+    expected = original_compute_funnel(df, steps).reset_index(drop=True)
+    result = metrics.compute_funnel(df, steps).reset_index(drop=True)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_out_of_order_steps(seed):
+    assert_same_funnel(random_events(seed), STEPS)
+
+
+@pytest.mark.parametrize("steps", [
+    ["search", "product", "search", "cart"],
+    ["cart", "cart", "checkout"],
+    ["product", "search", "product", "search", "checkout"],
+])
+def test_repeated_steps(steps):
+    assert_same_funnel(random_events(11), steps)
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_nat_timestamps(seed):
+    assert_same_funnel(random_events(seed, nat_share=0.1), STEPS)
+
+
+def test_string_timestamps_and_no_matches():
+    df = random_events(5)
+    df["timestamp"] = df["timestamp"].dt.strftime("%Y-%m-%d %H:%M:%S")
+    assert_same_funnel(df, STEPS)
+    assert_same_funnel(df, ["missing", "search"])
+
+
+def test_funnel_depth_matches_greedy_loop():
+    df = random_events(3).sort_values(["sessionid", "timestamp"], kind="stable")
+    steps = ["search", "product", "search", "cart", "checkout"]
+    session_codes, sessions = pd.factorize(df["sessionid"], sort=True)
+    unique_steps = list(dict.fromkeys(steps))
+    action_codes = metrics.encode_actions(df["action"], unique_steps)
+    depth = metrics.funnel_depth(session_codes, action_codes, [unique_steps.index(s) for s in steps], len(sessions))
+
+    expected = []
+    for _, actions in df.groupby("sessionid", sort=True)["action"]:
+        actions, pos, reached = list(actions), 0, 0
+        for step in steps:
+            if step not in actions[pos:]:
+                break
+            pos = actions.index(step, pos) + 1
+            reached += 1
+        expected.append(reached)
+    np.testing.assert_array_equal(depth, expected)
@@ -0,0 +1,84 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import output_writers as ow
+
+
+def events_frame(n=1000, seed=0):
+    rng = np.random.default_rng(seed)
+    category = pd.Series(rng.choice(["a", "b"], n), dtype=object)
+    # в первом куске object-колонка целиком из None: схема должна браться по всему фрейму
+    category[:300] = None
+    return pd.DataFrame({
+        "userid": rng.integers(0, 100, n),
+        "sessionid": pd.Series(rng.integers(0, 300, n).astype(str), dtype="string"),
+        "action": pd.Categorical(rng.choice(["search", "product", "cart"], n)),
+        "timestamp": pd.Timestamp("2024-01-01", tz="UTC") + pd.to_timedelta(rng.integers(0, 10 ** 6, n), unit="s"),
+        "price": np.where(rng.random(n) < 0.1, np.nan, rng.random(n)),
+        "category": category,
+    })
+
+
+def read_back(path, fmt):
+    return pd.read_parquet(path) if fmt == "parquet" else pd.read_feather(path)
+
+
+def as_read(df):
+    # строки без метаданных pandas (object) читаются обратно как str
+    return df.astype({"category": "str"})
+
+
+@pytest.mark.parametrize("fmt", ["parquet", "feather"])
+@pytest.mark.parametrize("compression", [None, "zstd"])
+def test_columnar_roundtrip_in_chunks(tmp_path, fmt, compression):
+    df = events_frame()
+    path = ow.write_table(df, str(tmp_path / ow.output_name("events.csv", fmt)), fmt, compression, chunk_rows=300)
+    pd.testing.assert_frame_equal(read_back(path, fmt), as_read(df))
+    assert os.listdir(tmp_path) == [os.path.basename(path)]
+
+
+def test_csv_in_chunks_equals_one_shot(tmp_path):
+    df = events_frame()
+    path = ow.write_table(df, str(tmp_path / "events.csv"), "csv", chunk_rows=7)
+    with open(path, encoding="utf-8") as f:
+        assert f.read() == df.to_csv(index=False)
+    gz = ow.write_table(df, str(tmp_path / ow.output_name("events.csv", "csv", "gzip")), "csv", "gzip", chunk_rows=300)
+    assert gz.endswith("events.csv.gz")
+    pd.testing.assert_frame_equal(pd.read_csv(gz), pd.read_csv(path))
+
+
+def test_columns_subset_and_empty_frame(tmp_path):
+    df = events_frame()
+    path = ow.write_table(df, str(tmp_path / "events.parquet"), "parquet", columns=["action", "missing", "userid"], chunk_rows=300)
+    pd.testing.assert_frame_equal(pd.read_parquet(path), df[["action", "userid"]])
+    path = ow.write_table(df.iloc[:0], str(tmp_path / "empty.feather"), "feather")
+    assert list(pd.read_feather(path).columns) == list(df.columns)
+    with pytest.raises(ValueError):
+        ow.write_table(df, str(tmp_path / "events.csv"), "csv", chunk_rows=-1)
+
+
+def test_save_outputs_same_files_for_any_worker_count(tmp_path):
+    out_files = {f"table_{i}.csv": events_frame(seed=i) for i in range(4)}
+    out_files["note.txt"] = "not a table"
+    os.makedirs(tmp_path / "one")
+    os.makedirs(tmp_path / "four")
+    saved_one = ow.save_outputs(out_files, str(tmp_path / "one"), fmt="parquet", workers=1, chunk_rows=300)
+    saved_four = ow.save_outputs(out_files, str(tmp_path / "four"), fmt="parquet", workers=4, chunk_rows=300)
+    assert list(saved_one) == list(saved_four) == list(out_files)
+    for fname, path in saved_four.items():
+        with open(path, "rb") as a, open(saved_one[fname], "rb") as b:
+            assert a.read() == b.read()
+    assert os.path.basename(saved_four["table_0.csv"]) == "table_0.parquet"
+    assert os.path.basename(saved_four["note.txt"]) == "note.txt"
+
+
+def test_failed_write_leaves_no_temp_file_and_others_are_saved(tmp_path, capsys):
+    # колонка из python-объектов, которые pyarrow не сериализует
+    bad = pd.DataFrame({"x": [object(), object()]})
+    saved = ow.save_outputs({"bad.csv": bad, "good.csv": events_frame()}, str(tmp_path), fmt="parquet", workers=2)
+    assert list(saved) == ["good.csv"]
+    assert "failed to save bad.csv" in capsys.readouterr().out
+    assert sorted(os.listdir(tmp_path)) == ["good.parquet"]
@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import pipeline as pl
+
+
+def mixed_events(n=500, seed=0):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        "userid": rng.integers(0, 50, n),
+        "sessionid": pd.Series(rng.integers(0, 120, n).astype(str), dtype="string"),
+        "action": pd.Categorical(rng.choice(["search", "product", "cart"], n), categories=["search", "product", "cart", "checkout"]),
+        "timestamp": pd.Timestamp("2024-03-30", tz="Europe/Moscow") + pd.to_timedelta(rng.integers(0, 10 ** 6, n), unit="s"),
+        "naive_ts": pd.Timestamp("2024-01-01") + pd.to_timedelta(rng.integers(0, 10 ** 6, n), unit="s"),
+        "price": np.where(rng.random(n) < 0.1, np.nan, rng.random(n) * 100),
+        "quantity": pd.array(np.where(rng.random(n) < 0.1, None, rng.integers(1, 5, n)), dtype="Int64"),
+        "category": pd.Series(np.where(rng.random(n) < 0.1, None, rng.choice(["a", "b"], n)), dtype=object),
+        "is_new": rng.random(n) < 0.5,
+    })
+    df.loc[rng.random(n) < 0.05, "sessionid"] = pd.NA
+    df.loc[rng.random(n) < 0.05, "timestamp"] = pd.NaT
+    # индекс не RangeIndex: после фильтрации и перестановки строк
+    return df.iloc[rng.permutation(n)[: n - 37]].set_axis(pd.Index(rng.permutation(n)[: n - 37] * 3, name="row"))
+
+
+def identity(events):
+    return events.copy()
+
+
+def session_summary(events):
+    return events.groupby("sessionid", observed=True).agg(
+        events=("action", "size"), first_ts=("timestamp", "min"), revenue=("price", "sum"), actions=("action", "nunique"),
+    )
+
+
+def action_counts(events, frame):
+    return frame["action"].value_counts().to_frame().join(events.groupby("action", observed=False)["quantity"].sum())
+
+
+def stages():
+    return [
+        pl.stage("frame", identity),
+        pl.stage("sessions", session_summary, columns=["sessionid", "action", "timestamp", "price", "missing"]),
+        pl.stage("actions", action_counts, deps=["frame"], columns=["action", "quantity"]),
+    ]
+
+
+def test_shared_events_roundtrip():
+    events = mixed_events()
+    blocks, spec = pl.share_events(events)
+    try:
+        pd.testing.assert_frame_equal(pl.events_from_shared(spec), events)
+        pd.testing.assert_frame_equal(pl.events_from_shared(spec, ["action", "quantity"]), events[["action", "quantity"]])
+    finally:
+        pl.release_shared(blocks)
+
+
+@pytest.mark.parametrize("range_index", [False, True])
+def test_two_workers_match_sequential(range_index):
+    events = mixed_events(seed=1)
+    if range_index:
+        events = events.reset_index(drop=True)
+    sequential = pl.run_pipeline(stages(), events, workers=1)
+    parallel = pl.run_pipeline(stages(), events, workers=2)
+    assert list(parallel) == list(sequential) == ["frame", "sessions", "actions"]
+    for name in sequential:
+        pd.testing.assert_frame_equal(parallel[name], sequential[name])
+    pd.testing.assert_frame_equal(parallel["frame"], events)
+
+
+def test_stage_order_and_errors():
+    assert pl.topological_order(stages()) == ["frame", "sessions", "actions"]
+    with pytest.raises(ValueError, match="unknown"):
+        pl.topological_order([pl.stage("a", identity, deps=["b"])])
+    with pytest.raises(ValueError, match="cycle"):
+        pl.topological_order([pl.stage("a", identity, deps=["b"]), pl.stage("b", identity, deps=["a"])])
@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import quantile_sketches as qs
+
+
+QUANTILES = (0.01, 0.25, 0.5, 0.9, 0.95, 0.99, 1.0)
+
+
+def random_values(seed, n_groups=20, n=2_000):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "date": pd.Timestamp("2024-01-01") + pd.to_timedelta(rng.integers(0, n_groups, n_groups * n), unit="D"),
+        "segment": rng.choice(["new", "returning"], n_groups * n),
+        "value": rng.lognormal(mean=4, sigma=2, size=n_groups * n) + qs.DEFAULT_MIN_VALUE,
+    })
+
+
+@pytest.mark.parametrize("relative_accuracy", [0.01, 0.02, 0.05])
+def test_quantiles_within_relative_accuracy(relative_accuracy):
+    df = random_values(int(relative_accuracy * 100))
+    sketches = qs.build_quantile_sketches(df, "value", keys="date", relative_accuracy=relative_accuracy)
+    approx = qs.sketch_quantiles(sketches, QUANTILES)
+    exact = np.array([
+        np.quantile(g["value"].to_numpy(), QUANTILES, method="lower") for _, g in df.groupby("date", sort=True)
+    ])
+    assert np.all(np.abs(approx - exact) <= relative_accuracy * exact * (1 + 1e-9))
+
+
+def test_zeros_and_values_below_min_value():
+    values = np.r_[np.zeros(500), np.full(100, qs.DEFAULT_MIN_VALUE / 10), np.linspace(1, 100, 400)]
+    sketches = qs.build_quantile_sketches(pd.DataFrame({"date": 0, "value": values}), "value")
+    approx = qs.sketch_quantiles(sketches, QUANTILES)[0]
+    exact = np.quantile(values, QUANTILES, method="lower")
+    assert np.all(np.abs(approx - exact) <= np.maximum(qs.DEFAULT_RELATIVE_ACCURACY * exact, qs.DEFAULT_MIN_VALUE))
+
+
+def test_merge_equals_sketch_of_concatenation():
+    df = random_values(1)
+    first, second = df.iloc[:15_000], df.iloc[15_000:]
+    second = second[second["date"] > pd.Timestamp("2024-01-05")]
+    keys = ["date", "segment"]
+    merged = qs.merge_quantile_sketches(qs.build_quantile_sketches(first, "value", keys), qs.build_quantile_sketches(second, "value", keys))
+    whole = qs.build_quantile_sketches(pd.concat([first, second]), "value", keys)
+    pd.testing.assert_frame_equal(merged["keys"], whole["keys"])
+    np.testing.assert_array_equal(merged["counts"], whole["counts"])
+    np.testing.assert_allclose(merged["sum"], whole["sum"])
+    np.testing.assert_array_equal(merged["min"], whole["min"])
+    np.testing.assert_array_equal(merged["max"], whole["max"])
+    pd.testing.assert_frame_equal(qs.summarize(merged), qs.summarize(whole))
+
+
+def test_merge_rejects_different_parameters():
+    df = random_values(2, n_groups=2, n=100)
+    with pytest.raises(ValueError):
+        qs.merge_quantile_sketches(
+            qs.build_quantile_sketches(df, "value", relative_accuracy=0.01),
+            qs.build_quantile_sketches(df, "value", relative_accuracy=0.02),
+        )
+
+
+def test_save_load_roundtrip(tmp_path):
+    sketches = qs.build_quantile_sketches(random_values(3, n_groups=4, n=200), "value", ["date", "segment"], relative_accuracy=0.02)
+    path = str(tmp_path / "ux_sketches.npz")
+    qs.save_quantile_sketches(sketches, path)
+    loaded = qs.load_quantile_sketches(path)
+    pd.testing.assert_frame_equal(loaded["keys"], sketches["keys"], check_dtype=False)
+    for name in ("counts", "sum", "min", "max"):
+        np.testing.assert_array_equal(loaded[name], sketches[name])
+    assert loaded["params"] == sketches["params"]
@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import metrics
+
+
+STEP_MAP = {"search": 0, "mainpage": 0, "product": 1, "category": 1, "cart": 2, "checkout": 3}
+
+
+def groupby_sankey(df, step_map, session_col="sessionid", ts_col="timestamp", require_step_increase=True):
+    """Исходная версия compute_sankey_transitions: groupby.shift по сессии."""
+    df_local = df.copy().sort_values([session_col, ts_col])
+    df_local["next_action"] = df_local.groupby(session_col)["action"].shift(-1)
+    df_local["current_step"] = df_local["action"].map(step_map)
+    df_local["next_step"] = df_local["next_action"].map(step_map)
+    df_local = df_local[df_local["next_step"].notna() & df_local["current_step"].notna()]
+    if require_step_increase:
+        df_local = df_local[df_local["next_step"] >= df_local["current_step"]]
+    sankey = df_local.groupby(["action", "next_action"])["userid"].nunique().reset_index(name="users")
+    return sankey.sort_values(["action", "next_action"]).reset_index(drop=True)
+
+
+def random_events(seed, n=5000, session_dtype=object, na_share=0.1):
+    rng = np.random.default_rng(seed)
+    sessions = rng.integers(0, 300, n).astype(str).astype(object)
+    sessions[rng.random(n) < na_share] = None
+    df = pd.DataFrame({
+        "sessionid": pd.Series(sessions, dtype=session_dtype),
+        "userid": rng.integers(0, 80, n),
+        "action": rng.choice(list(STEP_MAP) + ["other"], n),
+        # без совпадающих времён: порядок внутри сессии однозначен
+        "timestamp": pd.Timestamp("2024-01-01") + pd.to_timedelta(rng.permutation(n), unit="s"),
+    })
+    return df
+
+
+def assert_same_sankey(df, require_step_increase):
+    expected = groupby_sankey(df, STEP_MAP, require_step_increase=require_step_increase)
+    result = metrics.compute_sankey_transitions(df, STEP_MAP, require_step_increase=require_step_increase)
+    pd.testing.assert_frame_equal(result.astype({"action": object, "next_action": object}), expected, check_dtype=False)
+
+
+@pytest.mark.parametrize("session_dtype", [object, "string", "category"])
+@pytest.mark.parametrize("require_step_increase", [True, False])
+def test_matches_groupby_with_missing_sessions(session_dtype, require_step_increase):
+    assert_same_sankey(random_events(0, session_dtype=session_dtype), require_step_increase)
+
+
+def test_events_without_session_are_not_paired():
+    df = pd.DataFrame({
+        "sessionid": pd.Series(["s1", None, None, "s2", None, None], dtype="string"),
+        "userid": [1, 1, 2, 2, 3, 3],
+        "action": ["search", "mainpage", "search", "mainpage", "mainpage", "search"],
+        "timestamp": pd.date_range("2024-01-01", periods=6, freq="min"),
+    })
+    assert_same_sankey(df, require_step_increase=False)
+    assert metrics.compute_sankey_transitions(df, STEP_MAP, require_step_increase=False).empty
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_matches_groupby_without_missing_sessions(seed):
+    df = random_events(seed, na_share=0)
+    assert_same_sankey(df, require_step_increase=True)
+    assert_same_sankey(df, require_step_increase=False)
@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+
+import data_cleaning as dc
+
+
+def test_first_and_last_action_keep_missing_values():
+    df = pd.DataFrame({
+        "sessionid": ["s1", "s1", "s1", "s2", "s2", "s3", None],
+        "timestamp": pd.to_datetime([
+            "2024-01-01 10:02", "2024-01-01 10:00", "2024-01-01 10:05",
+            "2024-01-01 11:00", "2024-01-01 11:01", "2024-01-01 12:00", "2024-01-01 13:00",
+        ]),
+        "action": ["product", None, "cart", "search", None, "mainpage", "checkout"],
+    })
+    _, sessions = dc.compute_session_aggregates(df, keep_events=False, with_actions=True)
+    sessions = sessions.set_index("sessionid")
+    # первое событие s1 и последнее событие s2 — без action, это не пропускается
+    assert pd.isna(sessions.loc["s1", "first_action"])
+    assert sessions.loc["s1", "last_action"] == "cart"
+    assert sessions.loc["s2", "first_action"] == "search"
+    assert pd.isna(sessions.loc["s2", "last_action"])
+    assert sessions.loc["s3", "first_action"] == sessions.loc["s3", "last_action"] == "mainpage"
+    assert len(sessions) == 3
+
+
+def test_first_and_last_action_match_sorted_groupby():
+    rng = np.random.default_rng(0)
+    n = 5000
+    df = pd.DataFrame({
+        "sessionid": rng.integers(0, 400, n),
+        "timestamp": pd.Timestamp("2024-01-01") + pd.to_timedelta(rng.permutation(n), unit="s"),
+        "action": rng.choice(["search", "product", "cart", "checkout"], n),
+    })
+    df["sessionid"] = df["sessionid"].astype("category")
+    _, sessions = dc.compute_session_aggregates(df, keep_events=False, with_actions=True)
+    expected = df.sort_values("timestamp").groupby("sessionid", observed=True)["action"].agg(["first", "last"])
+    np.testing.assert_array_equal(sessions["first_action"].to_numpy(), expected["first"].to_numpy())
+    np.testing.assert_array_equal(sessions["last_action"].to_numpy(), expected["last"].to_numpy())
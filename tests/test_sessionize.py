@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import data_cleaning as dc
+
+
+def loop_sessionize(df, key_col, gap, max_duration):
+    """Цикл по пользователям (сессиям) в порядке времени: новая сессия при паузе > gap и при смене окна max_duration."""
+    ids = pd.Series(pd.NA, index=df.index, dtype="Int64")
+    valid = df[df[key_col].notna() & df["timestamp"].notna()]
+    next_id = 0
+    for _, events in valid.sort_values("timestamp", kind="stable").groupby(key_col, sort=True):
+        prev = start = window = None
+        for idx, t in events["timestamp"].items():
+            new = prev is None or (gap is not None and t - prev > pd.Timedelta(gap))
+            if new:
+                start = t
+            if max_duration is not None:
+                w = (t - start) // pd.Timedelta(max_duration)
+                new |= w != window
+                window = w
+            if new and prev is not None:
+                next_id += 1
+            ids[idx] = next_id
+            prev = t
+        next_id += 1
+    return ids
+
+
+def random_events(seed, n=3000, unit="us", tz=None):
+    rng = np.random.default_rng(seed)
+    # паузы разной длины, включая ровно gap (не режет сессию) и повторы времени
+    steps = rng.choice([0, 60, 600, 1800, 1801, 7200, 40000], n, p=[0.05, 0.4, 0.25, 0.1, 0.05, 0.1, 0.05])
+    userid = rng.integers(0, 40, n).astype(float)
+    userid[rng.random(n) < 0.02] = np.nan
+    ts = pd.Series(pd.Timestamp("2024-01-01") + pd.to_timedelta(np.cumsum(steps), unit="s")).astype(f"datetime64[{unit}]")
+    if tz is not None:
+        ts = ts.dt.tz_localize(tz)
+    ts[rng.random(n) < 0.02] = pd.NaT
+    df = pd.DataFrame({"userid": userid, "timestamp": ts, "sessionid": rng.integers(0, 100, n)})
+    return df.iloc[rng.permutation(n)]
+
+
+@pytest.mark.parametrize("gap, max_duration", [("30min", None), ("30min", "2h"), ("5min", "15min"), ("2h", None)])
+@pytest.mark.parametrize("unit, tz", [("us", None), ("ns", None), ("s", "Europe/Moscow")])
+def test_matches_loop_by_user(gap, max_duration, unit, tz):
+    df = random_events(0, unit=unit, tz=tz)
+    result = dc.sessionize_by_inactivity(df, gap=gap, max_duration=max_duration)
+    expected = loop_sessionize(df, "userid", gap, max_duration)
+    pd.testing.assert_series_equal(result["sessionid"], expected, check_names=False, check_dtype=False)
+
+
+@pytest.mark.parametrize("gap, max_duration", [(None, "1h"), ("30min", None), ("10min", "30min")])
+def test_split_existing_matches_loop_by_session(gap, max_duration):
+    df = random_events(1)
+    result = dc.sessionize_by_inactivity(df, gap=gap, max_duration=max_duration, split_existing=True)
+    expected = loop_sessionize(df, "sessionid", gap, max_duration)
+    pd.testing.assert_series_equal(result["sessionid"], expected, check_names=False, check_dtype=False)
+
+
+def test_string_timestamps_and_complete_rows():
+    df = random_events(2).dropna()
+    original = df["sessionid"].copy()
+    as_text = df.assign(timestamp=df["timestamp"].dt.strftime("%Y-%m-%d %H:%M:%S"))
+    result = dc.sessionize_by_inactivity(as_text)
+    # без пропусков — обычный int64, не nullable
+    assert result["sessionid"].dtype == np.int64
+    pd.testing.assert_series_equal(result["sessionid"], dc.sessionize_by_inactivity(df)["sessionid"])
+    # исходный фрейм не меняется
+    pd.testing.assert_series_equal(df["sessionid"], original)
+
+
+def test_ensure_sessions_branches():
+    df = random_events(3)
+    pd.testing.assert_frame_equal(dc.ensure_sessions(df), df)
+    rebuilt = dc.ensure_sessions(df.drop(columns="sessionid"))
+    pd.testing.assert_series_equal(rebuilt["sessionid"], loop_sessionize(df, "userid", "30min", None), check_names=False, check_dtype=False)
+    regapped = dc.ensure_sessions(df, gap="10min")
+    pd.testing.assert_series_equal(regapped["sessionid"], loop_sessionize(df, "userid", "10min", None), check_names=False, check_dtype=False)
+    split = dc.ensure_sessions(df, max_duration="1h")
+    pd.testing.assert_series_equal(split["sessionid"], loop_sessionize(df, "sessionid", None, "1h"), check_names=False, check_dtype=False)
+    with pytest.raises(ValueError):
+        dc.sessionize_by_inactivity(df.drop(columns="userid"))
@@ -0,0 +1,69 @@
+import os
+
+import pandas as pd
+import pytest
+
+import data_cleaning as dc
+import main
+import synthetic_data as sd
+
+
+SINCE, UNTIL = "2024-01-20 14:07:00", "2024-02-03 19:30"
+
+
+@pytest.fixture(scope="module")
+def events_csv(tmp_path_factory):
+    raw = sd.generate_chunk(0, 20_000, seed=5, days=40)
+    raw["timestamp"] = pd.to_datetime(raw["timestamp"], errors="coerce")
+    raw = raw.sort_values("timestamp", kind="stable")
+    raw["timestamp"] = raw["timestamp"].dt.strftime("%Y-%m-%d %H:%M:%S")
+    path = str(tmp_path_factory.mktemp("input") / "events.csv")
+    raw.to_csv(path, index=False)
+    return path
+
+
+def filtered_full_read(path, since, until, **kwargs):
+    df = dc.read_telemetry_csv(path, **kwargs)
+    return df[dc.time_range_mask(df["timestamp"], since, until)].reset_index(drop=True)
+
+
+@pytest.mark.parametrize("since, until", [(SINCE, UNTIL), (None, UNTIL), (SINCE, None), ("2030-01-01", None)])
+def test_sorted_seek_equals_filtered_full_read(events_csv, monkeypatch, since, until):
+    # маленький блок — двоичный поиск по смещениям делает несколько шагов и на небольшом файле
+    monkeypatch.setattr(dc, "_SEEK_BLOCK_BYTES", 256)
+    expected = filtered_full_read(events_csv, since, until)
+    result = dc.read_telemetry_csv(events_csv, since=since, until=until, time_sorted=True, chunksize=700)
+    pd.testing.assert_frame_equal(result.reset_index(drop=True), expected, check_dtype=False)
+
+
+def test_parquet_filter_equals_filtered_full_read(events_csv, tmp_path):
+    full = dc.read_telemetry_csv(events_csv)
+    path = str(tmp_path / "events.parquet")
+    full.drop(columns=["date"]).to_parquet(path, index=False, row_group_size=1_000)
+    expected = filtered_full_read(events_csv, SINCE, UNTIL)
+    result = dc.read_telemetry_parquet(path, since=SINCE, until=UNTIL, columns=["userid", "sessionid", "action", "timestamp"])
+    pd.testing.assert_frame_equal(result.reset_index(drop=True), expected[list(result.columns)], check_dtype=False)
+
+
+def read_outputs(output_dir):
+    outputs = {}
+    for name in sorted(os.listdir(output_dir)):
+        with open(os.path.join(output_dir, name), "rb") as f:
+            outputs[name] = f.read()
+    return outputs
+
+
+@pytest.mark.parametrize("session_gap, max_session_duration", [(None, None), ("20min", None), (None, "5min")])
+def test_since_gives_same_outputs_with_and_without_cache(events_csv, tmp_path, session_gap, max_session_duration):
+    kwargs = dict(
+        since=SINCE, until=UNTIL, session_gap=session_gap, max_session_duration=max_session_duration,
+        workers=1, label_events=True
+    )
+    main.main(events_csv, str(tmp_path / "direct"), **kwargs)
+    expected = read_outputs(tmp_path / "direct")
+    # промах кэша (кэш пишется по всему входу) и попадание
+    for run in ("miss", "hit"):
+        main.main(events_csv, str(tmp_path / run), cache_dir=str(tmp_path / "cache"), **kwargs)
+        outputs = read_outputs(tmp_path / run)
+        assert outputs.keys() == expected.keys()
+        assert [name for name in expected if outputs[name] != expected[name]] == []
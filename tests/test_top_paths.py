@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import metrics
+
+
+ACTIONS = ["search", "mainpage", "product", "category", "cart", "checkout"]
+
+
+def brute_force_paths(df, length, start_actions, collapse_repeats):
+    """Перебор n-грамм по каждой сессии на чистом Python."""
+    sessions, users = {}, {}
+    df_local = df[df["sessionid"].notna()].sort_values(["sessionid", "timestamp"])
+    for _, group in df_local.groupby("sessionid", sort=False):
+        events = list(zip(group["action"], group["userid"]))
+        if collapse_repeats:
+            events = [e for i, e in enumerate(events) if i == 0 or e[0] != events[i - 1][0]]
+        for i in range(len(events) - length + 1):
+            path = tuple(a for a, _ in events[i:i + length])
+            if start_actions is not None and path[0] not in start_actions:
+                continue
+            key = " > ".join(path)
+            sessions.setdefault(key, set()).add(group["sessionid"].iloc[0])
+            if pd.notna(events[i][1]):
+                users.setdefault(key, set()).add(events[i][1])
+    paths = pd.DataFrame({
+        "path": list(sessions),
+        "sessions": [len(v) for v in sessions.values()],
+        "users": [len(users.get(k, ())) for k in sessions],
+    })
+    paths = paths.sort_values(["sessions", "users", "path"], ascending=[False, False, True])
+    return paths.reset_index(drop=True)
+
+
+def random_events(seed, n=4000):
+    rng = np.random.default_rng(seed)
+    session = rng.integers(0, 400, n)
+    # пользователь обычно один на сессию, но часть событий — от чужих пользователей и без userid
+    userid = (session // 3).astype(float)
+    foreign = rng.random(n) < 0.05
+    userid[foreign] = rng.integers(0, 150, foreign.sum())
+    userid[rng.random(n) < 0.03] = np.nan
+    return pd.DataFrame({
+        "sessionid": session,
+        "userid": userid,
+        # мало действий и повторы подряд, чтобы collapse_repeats что-то менял
+        "action": rng.choice(ACTIONS[:4], n, p=[0.4, 0.3, 0.2, 0.1]),
+        "timestamp": pd.Timestamp("2024-01-01") + pd.to_timedelta(rng.permutation(n), unit="s"),
+    })
+
+
+@pytest.mark.parametrize("collapse_repeats", [False, True])
+@pytest.mark.parametrize("length", [1, 3])
+@pytest.mark.parametrize("start_actions", [None, ("search", "mainpage")])
+def test_matches_brute_force_with_small_chunks(collapse_repeats, length, start_actions):
+    df = random_events(0)
+    expected = brute_force_paths(df, length, start_actions, collapse_repeats)
+    result = metrics.compute_top_paths(
+        df, length=length, start_actions=start_actions, top_k=10_000,
+        collapse_repeats=collapse_repeats, candidates=10_000, chunk_rows=100,
+    )
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+def test_chunk_size_does_not_change_result():
+    df = random_events(1)
+    whole = metrics.compute_top_paths(df, length=3, top_k=50, chunk_rows=len(df) + 1)
+    for chunk_rows in (1, 37, 500):
+        pd.testing.assert_frame_equal(metrics.compute_top_paths(df, length=3, top_k=50, chunk_rows=chunk_rows), whole)
@@ -0,0 +1,103 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import metrics
+
+
+STEPS = ["search", "product", "cart", "checkout"]
+
+
+def brute_force_depth(df, steps, step_gaps, window, entity_col="sessionid"):
+    """Перебор всех цепочек событий сущности: максимум пройденных шагов."""
+    result = {}
+    for entity, g in df.sort_values([entity_col, "timestamp"], kind="stable").groupby(entity_col, sort=True):
+        actions = g["action"].tolist()
+        times = g["timestamp"].tolist()
+
+        def extend(j, prev, start):
+            best = j
+            if j == len(steps):
+                return best
+            for k in range(prev + 1, len(actions)):
+                if actions[k] != steps[j]:
+                    continue
+                if pd.isna(times[k]):
+                    # событие без времени засчитывается только как первый шаг
+                    best = max(best, 1) if j == 0 else best
+                    continue
+                if j > 0 and step_gaps is not None and step_gaps[j] is not None and times[k] - times[prev] > step_gaps[j]:
+                    continue
+                if j > 0 and window is not None and times[k] - start > window:
+                    continue
+                best = max(best, extend(j + 1, k, times[k] if j == 0 else start))
+            return best
+
+        result[entity] = extend(0, -1, None)
+    return result
+
+
+def run_depth(df, steps, step_gaps, window, entity_col="sessionid"):
+    df = df.sort_values([entity_col, "timestamp"], kind="stable")
+    entity_codes, entities = pd.factorize(df[entity_col], sort=True)
+    unique_steps = list(dict.fromkeys(steps))
+    action_codes = metrics.encode_actions(df["action"], unique_steps)
+    step_codes = [unique_steps.index(s) for s in steps]
+    depth = metrics.windowed_funnel_depth(
+        entity_codes, action_codes, df["timestamp"].to_numpy(), step_codes, len(entities), step_gaps, window
+    )
+    return dict(zip(entities, depth.tolist()))
+
+
+def test_later_occurrence_of_previous_step_is_used():
+    base = pd.Timestamp("2024-01-01")
+    actions = ["search", "product", "category", "mainpage", "cart", "cart", "checkout"]
+    minutes = [0, 1, 2, 3, 4, 64, 74]
+    df = pd.DataFrame({
+        "sessionid": "s1",
+        "userid": "u1",
+        "action": actions,
+        "timestamp": [base + pd.Timedelta(minutes=m) for m in minutes],
+    })
+    table = metrics.compute_windowed_funnel(df, STEPS, max_step_gap={"checkout": "30min"}, window="24h")
+    assert table["step"].tolist() == STEPS
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_matches_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    n = 300
+    steps = ["a", "b", "c", "b", "d"]
+    df = pd.DataFrame({
+        "sessionid": rng.integers(0, 25, n),
+        "action": rng.choice(["a", "b", "c", "d", "x"], n),
+        "timestamp": pd.Timestamp("2024-01-01") + pd.to_timedelta(rng.integers(0, 240, n), unit="min"),
+    })
+    df.loc[rng.random(n) < 0.03, "timestamp"] = pd.NaT
+    gap = np.timedelta64(20, "m")
+    step_gaps = [None, gap, None, gap, np.timedelta64(45, "m")]
+    for gaps, window in [(step_gaps, None), (None, np.timedelta64(90, "m")), (step_gaps, np.timedelta64(120, "m"))]:
+        assert run_depth(df, steps, gaps, window) == brute_force_depth(df, steps, gaps, window)
+
+
+def test_without_limits_matches_compute_funnel():
+    rng = np.random.default_rng(7)
+    n = 500
+    df = pd.DataFrame({
+        "sessionid": rng.integers(0, 40, n),
+        "userid": rng.integers(0, 10, n),
+        "action": rng.choice(STEPS + ["mainpage"], n),
+        "timestamp": pd.Timestamp("2024-01-01") + pd.to_timedelta(rng.integers(0, 10_000, n), unit="s"),
+    })
+    windowed = metrics.windowed_funnel_depth(
+        *_codes(df), [0, 1, 2, 3], df["sessionid"].nunique(), None, np.timedelta64(365, "D")
+    )
+    plain = metrics.funnel_depth(*_codes(df)[:2], [0, 1, 2, 3], df["sessionid"].nunique())
+    np.testing.assert_array_equal(windowed, plain)
+
+
+def _codes(df):
+    df = df.sort_values(["sessionid", "timestamp"], kind="stable")
+    entity_codes, _ = pd.factorize(df["sessionid"], sort=True)
+    action_codes = metrics.encode_actions(df["action"], STEPS)
+    return entity_codes, action_codes, df["timestamp"].to_numpy()